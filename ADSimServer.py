@@ -6,6 +6,12 @@ import numpy as np
 import os, os.path
 import pvaccess as pva
 import fabio
+import h5py
+from framePacer import FramePacer
+from frameSource import H5FrameSource, RawFrameSource, ImageDirFrameSource
+from codecAD import DTYPE_CODEC_TYPE_MAP
+from codecEncoder import CodecEncoder
+from syntheticPeaks import SyntheticPeakGenerator, concat_truth, write_truth
 
 # modified version of ADSimServer.py by @vbanakha
 __version__ = pva.__version__
@@ -27,7 +33,8 @@ class AdSimServer(threading.Thread):
         np.dtype('float64') : 'doubleValue'
     }
 
-    def __init__(self, input_directory, frame_rate, nf, nx, ny, runtime, channel_name, start_delay, report_frequency):
+    def __init__(self, input_directory, frame_rate, nf, nx, ny, runtime, channel_name, start_delay, report_frequency, \
+                 cache=False, input_file=None, burst_size=0, burst_pause=0.0, spin_time=0.002, peak_density=0, truth_file=None, codec=''):
         threading.Thread.__init__(self)
         self.arraySize = None
         self.delta_t = 0
@@ -49,11 +56,21 @@ class AdSimServer(threading.Thread):
         self.files = queue.Queue(maxsize=-1)
         self.nfiles = 0
         self.random_frames = False
-        if self.in_directory is not None:
+        self.cache = cache
+        self.input_file = input_file
+        self.nf = nf
+        if self.in_directory is not None and not self.cache:
             self.get_files()
-        else:
+        elif self.in_directory is None and self.input_file is None:
             print("No input directory: generating random frames")
             self.random_frames = True
+        # synthetic bragg peak frames instead of uniform noise, with ground truth
+        # ('frame' is the cache index in cached mode, the uniqueId otherwise)
+        self.peak_generator = None
+        self.truths = []
+        self.truth_file = truth_file
+        if peak_density > 0:
+            self.peak_generator = SyntheticPeakGenerator(nx=nx, ny=ny, density=peak_density)
         # frames from files for publishing
         # self.frames = queue.Queue(maxsize=-1)
         # self.n_input_frames = 0
@@ -98,6 +115,22 @@ class AdSimServer(threading.Thread):
         self.start_delay = start_delay
         self.is_done = False
 
+        # compressed frames are published as ubyte arrays with the codec name
+        # and data type, as areaDetector does; in cached mode every frame is
+        # compressed once, when the cache is built
+        self.codec = codec
+        self.encoder = CodecEncoder()
+        self.n_published_bytes = 0
+        self.n_uncompressed_bytes = 0
+
+        # cached mode: frames are decoded (or memory-mapped) and turned into
+        # NtNdArrays once, then published from a single pacing thread
+        self.frame_cache = []
+        self.frame_cache_nbytes = []
+        self.pacer = FramePacer(frame_rate, burst_size, burst_pause, spin_time)
+        if self.cache:
+            self.build_frame_cache()
+
     def get_files(self):
         input_files = []
         if self.in_directory is not None:
@@ -125,19 +158,27 @@ class AdSimServer(threading.Thread):
 
 
         nda['uniqueId'] = id
-        nda['codec'] = pva.PvCodec('pvapyc', pva.PvInt(5))
-        # nda['codec'] = pva.PvCodec('', pva.PvInt(5))
+        if self.codec:
+            payload = self.encoder.compress(frame, self.codec)
+            nda['codec'] = pva.PvCodec(self.codec, pva.PvInt(DTYPE_CODEC_TYPE_MAP[np.dtype(frame.dtype)]))
+            nda['compressedSize'] = payload.nbytes
+        else:
+            nda['codec'] = pva.PvCodec('pvapyc', pva.PvInt(5))
+            # nda['codec'] = pva.PvCodec('', pva.PvInt(5))
+            nda['compressedSize'] = frame.nbytes
         dims = [pva.PvDimension(self.rows, 0, self.rows, 1, False), \
                 pva.PvDimension(self.cols, 0, self.cols, 1, False)]
         nda['dimension'] = dims
-        nda['compressedSize'] = self.rows*self.cols
-        nda['uncompressedSize'] = self.rows*self.cols
+        nda['uncompressedSize'] = frame.nbytes
         ts = self.get_timestamp()
         nda['timeStamp'] = ts
         nda['dataTimeStamp'] = ts
         nda['descriptor'] = 'PvaPy Simulated Image'
         # nda['value'] = {self.pva_type_key : self.frames[frame_id].flatten()}
-        nda['value'] = {self.pva_type_key: frame.flatten()}
+        if self.codec:
+            nda['value'] = {'ubyteValue': payload}
+        else:
+            nda['value'] = {self.pva_type_key: frame.flatten()}
         attrs = [pva.NtAttribute('ColorMode', pva.PvInt(0))]
 
         nda['attribute'] = attrs
@@ -146,6 +187,55 @@ class AdSimServer(threading.Thread):
         # self.frame_map[frame_id] = nda
         return nda
 
+    def generate_frame(self, frame_id):
+        if self.peak_generator is None:
+            return np.random.randint(0, 256, size=(self.nx, self.ny), dtype=np.int16)
+        frame, truth = self.peak_generator.generate(frame_id)
+        # kept only to be written out, the server may run indefinitely
+        if self.truth_file is not None:
+            self.truths.append(truth)
+        return frame
+
+    def write_truth(self):
+        if self.truth_file is None or not self.truths:
+            return
+        with h5py.File(self.truth_file, 'w') as h5fd:
+            write_truth(h5fd, concat_truth(self.truths))
+        print('Ground truth for %d frames written to %s' % (len(self.truths), self.truth_file))
+
+    def open_frame_source(self):
+        if self.input_file is not None:
+            if self.input_file.endswith('.npy'):
+                return RawFrameSource(self.input_file)
+            return H5FrameSource(self.input_file, preload=False)
+        if self.in_directory is not None:
+            return ImageDirFrameSource(self.in_directory)
+        return None
+
+    def build_frame_cache(self):
+        source = self.open_frame_source()
+        n_frames = self.nf if source is None else min(self.nf, source.nFrames)
+        t0 = time.time()
+        for i in range(n_frames):
+            if source is None:
+                frame = self.generate_frame(i)
+            else:
+                frame = np.asarray(source.getFrame(i))
+            self.cols, self.rows = frame.shape
+            self.pva_type_key = self.PVA_TYPE_KEY_MAP.get(frame.dtype)
+            if self.pva_type_key is None:
+                print('Unsupported frame data type %s, frame %d skipped' % (frame.dtype, i))
+                continue
+            nda = self.frame_producer(frame, i)
+            self.frame_cache.append(nda)
+            self.frame_cache_nbytes.append((nda['compressedSize'], nda['uncompressedSize']))
+        if source is not None:
+            source.close()
+        print('Cached %d frames in %.3f seconds' % (len(self.frame_cache), time.time() - t0))
+        if self.codec and self.frame_cache:
+            compressed, uncompressed = np.sum(self.frame_cache_nbytes, axis=0)
+            print('Codec %s compression ratio: %.2f' % (self.codec, uncompressed/compressed))
+
     def prepare_frame(self):
         # Get cached frame
         # cached_frame_id = self.current_frame_id % self.n_input_frames
@@ -158,7 +248,7 @@ class AdSimServer(threading.Thread):
             self.get_files()
         try:
             if self.random_frames:
-                frame = np.random.randint(0, 256, size=(self.nx, self.ny), dtype=np.int16)
+                frame = self.generate_frame(self.current_frame_id + 1)
             else:
                 file = self.files.get()
                 frame = fabio.open(file).data
@@ -196,6 +286,8 @@ class AdSimServer(threading.Thread):
             self.server.update(self.channel_name, frame)
             self.last_published_time = time.time()
             self.n_published_frames += 1
+            self.n_published_bytes += frame['compressedSize']
+            self.n_uncompressed_bytes += frame['uncompressedSize']
 
             runtime = 0
             if self.n_published_frames > 1:
@@ -220,28 +312,84 @@ class AdSimServer(threading.Thread):
                     threading.Timer(delay, self.frame_publisher).start()
                     return
 
+    def cached_frame_publisher(self):
+        time.sleep(self.start_delay)
+        self.pacer.start()
+        n_cached = len(self.frame_cache)
+        while not self.is_done:
+            self.pacer.wait()
+            cached_frame_id = self.current_frame_id % n_cached
+            frame = self.frame_cache[cached_frame_id]
+            self.current_frame_id += 1
+            frame['uniqueId'] = self.current_frame_id
+            ts = self.get_timestamp()
+            frame['timeStamp'] = ts
+            frame['dataTimeStamp'] = ts
+            self.server.update(self.channel_name, frame)
+            self.last_published_time = time.time()
+            self.pacer.record(self.last_published_time)
+            self.n_published_frames += 1
+            compressed, uncompressed = self.frame_cache_nbytes[cached_frame_id]
+            self.n_published_bytes += compressed
+            self.n_uncompressed_bytes += uncompressed
+            if self.n_published_frames == 1:
+                self.start_time = self.last_published_time
+
+            if self.report_frequency > 0 and (self.n_published_frames % self.report_frequency) == 0:
+                stats = self.pacer.getStats()
+                print("Published frame id %6d @ %.3f (frame rate: %.4f fps, jitter: %.1f us, lateness: %.1f us mean, %.1f us max)" % \
+                      (self.current_frame_id, self.last_published_time, stats['frameRate'], 1e6*stats['intervalJitter'], \
+                       1e6*stats['meanLateness'], 1e6*stats['maxLateness']))
+
+            if self.last_published_time - self.start_time > self.runtime:
+                print("Server will exit after reaching runtime of %s seconds" % (self.runtime))
+                return
+
     def start(self):
         # threading.Thread(target=self.frame_producer, daemon=True).start()
         self.server.start()
-        threading.Timer(self.start_delay, self.frame_publisher).start()
+        if self.cache:
+            if len(self.frame_cache) == 0:
+                print('No frames cached')
+                return
+            threading.Thread(target=self.cached_frame_publisher, daemon=True).start()
+        else:
+            threading.Timer(self.start_delay, self.frame_publisher).start()
 
     def stop(self):
         self.is_done = True
         self.server.stop()
+        self.write_truth()
         runtime = self.last_published_time - self.start_time
-        delta_t = runtime/(self.n_published_frames - 1)
-        frame_rate = 1.0/delta_t
+        frame_rate = 0
+        if self.n_published_frames > 1 and runtime > 0:
+            frame_rate = (self.n_published_frames - 1)/runtime
         print('\nServer runtime: %.4f seconds' % (runtime))
         print('Published frames: %6d @ %.4f fps' % (self.n_published_frames, frame_rate))
+        if runtime > 0 and self.n_published_bytes > 0:
+            print('Published data: %.3f MB/s (%.3f MB/s uncompressed, codec: %s)' % \
+                  (self.n_published_bytes/runtime/1e6, self.n_uncompressed_bytes/runtime/1e6, self.codec or 'none'))
+        if self.cache:
+            stats = self.pacer.getStats()
+            print('Publish interval jitter: %.1f us, lateness: %.1f us mean, %.1f us p99, %.1f us max' % \
+                  (1e6*stats['intervalJitter'], 1e6*stats['meanLateness'], 1e6*stats['p99Lateness'], 1e6*stats['maxLateness']))
 
 def main():
     parser = argparse.ArgumentParser(description='PvaPy Area Detector Simulator')
     parser.add_argument('--input-directory', '-id', type=str, dest='input_directory', default=None, help='Directory containing input files to be streamed; if input directory or input file are not provided, random images will be generated')
+    parser.add_argument('--input-file', '-if', type=str, dest='input_file', default=None, help='HDF5 file with a frames dataset, or .npy file (memory-mapped), to be streamed; only used with --cache')
     # parser.add_argument('--input-file', '-if', type=str, dest='input_file', default=None, help='Input file to be streamed; if input directory or input file are not provided, random images will be generated')
     parser.add_argument('--frame-rate', '-fps', type=float, dest='frame_rate', default=20, help='Frames per second (default: 20 fps)')
     parser.add_argument('--n-x-pixels', '-nx', type=int, dest='n_x_pixels', default=256, help='Number of pixels in x dimension (default: 256 pixels; does not apply if input_file file is given)')
     parser.add_argument('--n-y-pixels', '-ny', type=int, dest='n_y_pixels', default=256, help='Number of pixels in x dimension (default: 256 pixels; does not apply if hdf5 file is given)')
     parser.add_argument('--n-frames', '-nf', type=int, dest='n_frames', default=1000, help='Number of different frames to generate and cache; those images will be published over and over again as long as the server is running')
+    parser.add_argument('--cache', '-c', action='store_true', dest='cache', default=False, help='Decode the first n-frames frames (or n-frames random frames) once, build their NtNdArrays up-front and publish them in a loop from a single pacing thread')
+    parser.add_argument('--burst-size', '-bs', type=int, dest='burst_size', default=0, help='Publish frames in bursts of this many frames at the frame rate, separated by the burst pause; 0 for a steady stream (default: 0; only used with --cache)')
+    parser.add_argument('--burst-pause', '-bp', type=float, dest='burst_pause', default=0.0, help='Pause between bursts in seconds (default: 0; only used with --cache)')
+    parser.add_argument('--spin-time', '-st', type=float, dest='spin_time', default=0.002, help='Busy-wait for this many seconds before each publish instead of sleeping, for precise pacing (default: 0.002; only used with --cache)')
+    parser.add_argument('--peak-density', '-pd', type=float, dest='peak_density', default=0, help='Generate synthetic Bragg peak frames with this many peaks per megapixel instead of random images (default: 0, random images)')
+    parser.add_argument('--truth-file', '-tf', type=str, dest='truth_file', default=None, help='HDF5 file to save the ground truth of generated peak frames to when the server stops')
+    parser.add_argument('--codec', '-co', type=str, dest='codec', default='', choices=['', 'blosc', 'lz4', 'bslz4'], help='Publish frames compressed with this codec (default: uncompressed); with --cache every frame is compressed once up-front')
     parser.add_argument('--runtime', '-rt', type=float, dest='runtime', default=300, help='Server runtime in seconds (default: 300 seconds)')
     parser.add_argument('--channel-name', '-cn', type=str, dest='channel_name', default='simulation:pva:test', help='Server PVA channel name (default: simulation:pva:test)')
     parser.add_argument('--start-delay', '-sd', type=float, dest='start_delay',  default=3.0, help='Server start delay in seconds (default: 3 seconds)')
@@ -254,7 +402,9 @@ def main():
         exit(1)
 
     # server = AdSimServer(input_directory=args.input_directory, input_file=args.input_file, frame_rate=args.frame_rate, nf=args.n_frames, nx=args.n_x_pixels, ny=args.n_y_pixels, runtime=args.runtime, channel_name=args.channel_name, start_delay=args.start_delay, report_frequency=args.report_frequency)
-    server = AdSimServer(input_directory=args.input_directory, frame_rate=args.frame_rate, nf=args.n_frames, nx=args.n_x_pixels, ny=args.n_y_pixels, runtime=args.runtime, channel_name=args.channel_name, start_delay=args.start_delay, report_frequency=args.report_frequency)
+    server = AdSimServer(input_directory=args.input_directory, frame_rate=args.frame_rate, nf=args.n_frames, nx=args.n_x_pixels, ny=args.n_y_pixels, runtime=args.runtime, channel_name=args.channel_name, start_delay=args.start_delay, report_frequency=args.report_frequency, \
+                         cache=args.cache, input_file=args.input_file, burst_size=args.burst_size, burst_pause=args.burst_pause, spin_time=args.spin_time, \
+                         peak_density=args.peak_density, truth_file=args.truth_file, codec=args.codec)
 
     server.start()
     try:
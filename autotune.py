@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+'''
+Batch size and inference thread autotuner.
+
+The configured inference engine is benchmarked on representative patches for
+every candidate batch size and thread count; the setting with the highest
+throughput whose p90 batch latency meets the latency target is chosen (the
+lowest latency one if none does). Results are cached in a json file keyed by
+host, engine, patch size and model (name and content hash), so tuning runs
+once per node and model; it is repeated when the latency target changes.
+
+infer:
+  autotune:
+    latency_target: 0.05          # seconds per batch (p90)
+    mbsz: [32, 64, 128, 256, 512, 1024]
+    threads: [1, 2, 4, 8]         # torch intra-op threads; ignored by other engines
+    n_patches: 4096               # patches per setting
+    patches_h5: null              # peaks file with a 'patches' dataset; synthetic if null
+    cache_file: ~/.edgeBragg-autotune.json
+    retune: false                 # ignore the cached result
+
+With autotune configured, BraggNNInferImageProcessor and reprocessScan.py
+apply the tuned 'mbsz' and 'threads' at startup (tuning first if there is no
+cached result). Run as a script to tune ahead of time, e.g.
+    python autotune.py -cfg config/sim.sf.yaml
+'''
+
+import argparse, copy, hashlib, json, logging, os, socket, sys, time
+import numpy as np
+import h5py
+import yaml
+
+from braggNNInferEngine import create_infer_engine, get_engine_name
+
+DEFAULT_CACHE_FILE = '~/.edgeBragg-autotune.json'
+DEFAULT_MBSZ = [32, 64, 128, 256, 512, 1024]
+DEFAULT_THREADS = [1, 2, 4, 8]
+WARMUP_BATCHES = 2
+
+def get_autotune_params(params):
+    autotuneParams = params['infer'].get('autotune') or {}
+    return autotuneParams if isinstance(autotuneParams, dict) else {}
+
+def tuning_key(params):
+    model_fname = params['model'].get('model_fname') or ''
+    digest = ''
+    if model_fname and os.path.isfile(model_fname):
+        with open(model_fname, 'rb') as fp:
+            digest = hashlib.sha1(fp.read()).hexdigest()[:12]
+    return f"{socket.gethostname()}/{get_engine_name(params)}/psz={params['model']['psz']}/{os.path.basename(model_fname)}:{digest}"
+
+def load_cache(cacheFile):
+    cacheFile = os.path.expanduser(cacheFile)
+    if not os.path.exists(cacheFile):
+        return {}
+    with open(cacheFile, 'r') as fp:
+        return json.load(fp)
+
+def save_cache(cacheFile, cache):
+    cacheFile = os.path.expanduser(cacheFile)
+    tmpFile = f'{cacheFile}.tmp'
+    with open(tmpFile, 'w') as fp:
+        json.dump(cache, fp, indent=2)
+    os.replace(tmpFile, cacheFile)
+
+def representative_patches(params, nPatches, patchesH5=None, seed=0):
+    psz = params['model']['psz']
+    if patchesH5:
+        with h5py.File(patchesH5, 'r') as h5fd:
+            patches = h5fd['patches'][:nPatches]
+    else:
+        from frameSource import SyntheticFrameSource
+        from braggNNFrameProcessor import BraggNNFrameProcessor
+        minIntensity = 100
+        source = SyntheticFrameSource(nFrames=1, nx=2048, ny=2048, nPeaks=max(nPatches, 1), peakSigma=1.2, fwhmSpread=2.0, \
+                                      etaRange=(0.0, 0.5), intensitySpread=5.0, background=minIntensity/10, seed=seed)
+        processor = BraggNNFrameProcessor(psz=psz, mbsz=1, offset_recover=0, min_intensity=0, max_radius=None, \
+                                          min_peak_sz=1, dark_h5=None, patch_q=None, write_q=None)
+        patches = processor._framePeakPatchesSparse(frame=source.getFrame(0), psz=psz, angle=0, min_intensity=minIntensity)[0]
+    patches = np.array(patches, dtype=np.float32).reshape((-1, 1, psz, psz))
+    if len(patches) == 0:
+        raise Exception('No representative patches for autotuning')
+    # cycle through the available patches if there are fewer than requested
+    return patches[np.arange(nPatches) % len(patches)]
+
+def measure(engine, patches, mbsz):
+    if len(patches) < mbsz:
+        patches = patches[np.arange(mbsz) % len(patches)]
+    nBatches = len(patches) // mbsz
+    latencies = []
+    for i in range(nBatches + WARMUP_BATCHES):
+        batch = patches[(i % nBatches)*mbsz:][:mbsz]
+        t0 = time.perf_counter()
+        engine.process(batch)
+        if i >= WARMUP_BATCHES:
+            latencies.append(time.perf_counter() - t0)
+    latencies = np.array(latencies)
+    return {
+        'latency' : float(np.percentile(latencies, 90)),
+        'meanLatency' : float(latencies.mean()),
+        'throughput' : mbsz*len(latencies)/latencies.sum()
+    }
+
+def tune(params, patches=None):
+    autotuneParams = get_autotune_params(params)
+    latencyTarget = autotuneParams.get('latency_target', 0.05)
+    mbszList = autotuneParams.get('mbsz', DEFAULT_MBSZ)
+    threadsList = autotuneParams.get('threads', DEFAULT_THREADS) if get_engine_name(params) == 'torch' else [None]
+    if patches is None:
+        patches = representative_patches(params, autotuneParams.get('n_patches', 4096), autotuneParams.get('patches_h5'))
+
+    results = []
+    for threads in threadsList:
+        for mbsz in mbszList:
+            tuneParams = copy.deepcopy(params)
+            tuneParams['infer']['mbsz'] = mbsz
+            tuneParams['infer']['threads'] = threads
+            engine = create_infer_engine(tuneParams)
+            if engine is None:
+                raise Exception('No inference engine configured, nothing to tune')
+            try:
+                result = measure(engine, patches, mbsz)
+            finally:
+                engine.stop()
+            result.update({'mbsz' : mbsz, 'threads' : threads})
+            results.append(result)
+            logging.info(f"autotune mbsz={mbsz} threads={threads}: {result['throughput']:.0f} patches/s, p90 latency {1000*result['latency']:.2f} ms")
+
+    feasible = [r for r in results if r['latency'] <= latencyTarget]
+    if feasible:
+        best = max(feasible, key=lambda r: r['throughput'])
+    else:
+        best = min(results, key=lambda r: r['latency'])
+        logging.warning(f'autotune: no setting meets the latency target of {1000*latencyTarget:.1f} ms')
+    return {
+        'mbsz' : best['mbsz'],
+        'threads' : best['threads'],
+        'throughput' : best['throughput'],
+        'latency' : best['latency'],
+        'latencyTarget' : latencyTarget,
+        'metTarget' : bool(feasible),
+        'timestamp' : time.time(),
+        'results' : results
+    }
+
+# cached tuning for this host and model, tuning first if there is none
+def get_tuning(params, retune=False):
+    autotuneParams = get_autotune_params(params)
+    cacheFile = autotuneParams.get('cache_file', DEFAULT_CACHE_FILE)
+    key = tuning_key(params)
+    cache = load_cache(cacheFile)
+    tuning = cache.get(key)
+    retune = retune or autotuneParams.get('retune', False)
+    if tuning and not retune and tuning['latencyTarget'] == autotuneParams.get('latency_target', 0.05):
+        logging.info(f"autotune: using cached mbsz={tuning['mbsz']} threads={tuning['threads']} for {key}")
+        return tuning
+    logging.info(f'autotune: tuning {key}')
+    tuning = tune(params)
+    cache = load_cache(cacheFile)
+    cache[key] = tuning
+    save_cache(cacheFile, cache)
+    return tuning
+
+def apply_tuning(params, retune=False):
+    tuning = get_tuning(params, retune)
+    params['infer']['mbsz'] = tuning['mbsz']
+    params['infer']['threads'] = tuning['threads']
+    return tuning
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='tune inference batch size and threads for this host and model')
+    parser.add_argument('-cfg',       type=str, required=True, help='yaml config file')
+    parser.add_argument('-latency_target', type=float, default=None, help='p90 batch latency target in seconds (overrides the config)')
+    parser.add_argument('-patches_h5', type=str, default=None, help='peaks h5 file with representative patches (overrides the config)')
+    parser.add_argument('-force',     action='store_true', help='tune even if a cached result exists')
+    parser.add_argument('-o',         type=str, default=None, help='write the tuning result to this json file as well')
+
+    args, unparsed = parser.parse_known_args()
+    if len(unparsed) > 0:
+        print('Unrecognized argument(s): \n%s \nProgram exiting ... ... ' % '\n'.join(unparsed))
+        exit(0)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s', stream=sys.stderr)
+    params = yaml.load(open(args.cfg, 'r'), Loader=yaml.CLoader)
+    autotuneParams = dict(get_autotune_params(params))
+    if args.latency_target is not None:
+        autotuneParams['latency_target'] = args.latency_target
+    if args.patches_h5:
+        autotuneParams['patches_h5'] = args.patches_h5
+    params['infer']['autotune'] = autotuneParams
+
+    tuning = get_tuning(params, retune=args.force)
+    if args.o:
+        with open(args.o, 'w') as fp:
+            json.dump(tuning, fp, indent=2)
+    json.dump({k : v for k, v in tuning.items() if k != 'results'}, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+'''
+Compares the dense frame archive (BraggNNHdfWriter, as used for frame2file)
+with the sparse CSR archive (BraggNNSparseHdfWriter) on the same frames:
+file size, write time and throughput, and the time to extract the pixels above
+min_intensity. The sparse archive is read back with SparseH5FrameSource and
+checked against the thresholded frames. Results are reported as json.
+'''
+
+import argparse, json, os, sys, tempfile, time
+import numpy as np
+
+from benchUtil import run_info
+from braggNNHdfWriter import BraggNNHdfWriter, BraggNNSparseHdfWriter
+from frameSource import H5FrameSource, SyntheticFrameSource, SparseH5FrameSource
+
+def write_archive(writer, objects):
+    t0 = time.time()
+    for obj in objects:
+        writer.process(obj)
+    writer.stop()
+    return time.time() - t0
+
+def sparsify(frames, min_intensity):
+    objects = []
+    t0 = time.time()
+    for i, frame in enumerate(frames):
+        idx = np.flatnonzero(frame.reshape(-1) > min_intensity)
+        objects.append({'frame_id' : np.array([i]), 'shape' : frame.shape, 'indices' : idx, 'values' : frame.reshape(-1)[idx]})
+    return objects, time.time() - t0
+
+def verify(fileName, frames, min_intensity, nCheck):
+    source = SparseH5FrameSource(fileName)
+    try:
+        for i in np.linspace(0, len(frames) - 1, min(nCheck, len(frames))).astype(int):
+            expected = np.where(frames[i] > min_intensity, frames[i], 0)
+            if not np.array_equal(source.getFrame(i), expected):
+                return False
+        return True
+    finally:
+        source.close()
+
+def run(args):
+    if args.ifn:
+        source = H5FrameSource(args.ifn, dataset=args.dataset)
+    else:
+        source = SyntheticFrameSource(nFrames=max(1, args.n_frames), nx=args.nx, ny=args.ny, dtype=args.dtype, nPeaks=args.n_peaks, seed=args.seed)
+    nFrames = min(args.n_frames, source.nFrames) if args.n_frames > 0 else source.nFrames
+    frames = [np.asarray(source.getFrame(i)) for i in range(nFrames)]
+    rawBytes = sum(frame.nbytes for frame in frames)
+    sparseObjects, sparsifyTime = sparsify(frames, args.min_intensity)
+    nPixels = sum(len(obj['indices']) for obj in sparseObjects)
+
+    results = {}
+    for name, compression in (('dense', True), ('denseUncompressed', False), ('sparse', True), ('sparseUncompressed', False)):
+        fileName = os.path.join(args.output_dir, f'frames-{name}.h5')
+        if name.startswith('dense'):
+            writer = BraggNNHdfWriter('frame', fileName=fileName, compression=compression)
+            objects = [{'angle' : np.array([i])[None], 'frame' : frame[None]} for i, frame in enumerate(frames)]
+        else:
+            writer = BraggNNSparseHdfWriter('frame', fileName=fileName, compression=compression)
+            objects = sparseObjects
+        writeTime = write_archive(writer, objects)
+        fileSize = os.path.getsize(fileName)
+        results[name] = {
+            'fileSize' : fileSize,
+            'bytesPerFrame' : fileSize/nFrames,
+            'writeTime' : writeTime,
+            'frameRate' : nFrames/writeTime if writeTime > 0 else 0.0,
+            'throughput' : rawBytes/writeTime/1e6 if writeTime > 0 else 0.0
+        }
+        if name.startswith('sparse'):
+            results[name]['verified'] = verify(fileName, frames, args.min_intensity, args.n_check)
+        if not args.keep:
+            os.remove(fileName)
+        print(f"{name}: {fileSize/1e6:.2f} MB, {results[name]['frameRate']:.1f} frames/s", file=sys.stderr)
+
+    for name in ('dense', 'sparse'):
+        dense = results['dense']
+        results[name]['sizeRatio'] = dense['fileSize']/results[name]['fileSize']
+        results[name]['speedup'] = dense['writeTime']/results[name]['writeTime'] if results[name]['writeTime'] > 0 else 0.0
+
+    output = run_info('frameArchive', args.label)
+    output.update({
+        'source' : source.describe(),
+        'nFrames' : nFrames,
+        'rawBytes' : rawBytes,
+        'minIntensity' : args.min_intensity,
+        'occupancy' : nPixels/(nFrames*frames[0].size) if nFrames > 0 else 0.0,
+        'sparsifyTime' : sparsifyTime/nFrames if nFrames > 0 else 0.0,
+        'archives' : results
+    })
+    source.close()
+    return output
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='size and write throughput of the sparse frame archive vs the dense one')
+    parser.add_argument('-ifn',       type=str, default=None, help='h5 file with frames; synthetic frames are generated if not given')
+    parser.add_argument('-dataset',   type=str, default='frames', help='name of the frames dataset in the h5 file')
+    parser.add_argument('-nx',        type=int, default=2048, help='synthetic frame width')
+    parser.add_argument('-ny',        type=int, default=2048, help='synthetic frame height')
+    parser.add_argument('-dtype',     type=str, default='uint16', help='synthetic frame data type')
+    parser.add_argument('-n_peaks',   type=int, default=200, help='number of peaks per synthetic frame')
+    parser.add_argument('-seed',      type=int, default=0, help='random seed for synthetic frames')
+    parser.add_argument('-n_frames',  type=int, default=32, help='number of frames to archive, 0 for all frames in the file')
+    parser.add_argument('-min_intensity', type=float, default=100, help='pixels above this are kept in the sparse archive')
+    parser.add_argument('-n_check',   type=int, default=4, help='number of frames read back and compared')
+    parser.add_argument('-output_dir',type=str, default=None, help='directory for the archives (temporary by default)')
+    parser.add_argument('-keep',      action='store_true', help='keep the archive files')
+    parser.add_argument('-label',     type=str, default=None, help='free-form label stored with the results')
+    parser.add_argument('-o',         type=str, default=None, help='write json results to this file instead of stdout')
+
+    args, unparsed = parser.parse_known_args()
+    if len(unparsed) > 0:
+        print('Unrecognized argument(s): \n%s \nProgram exiting ... ... ' % '\n'.join(unparsed))
+        exit(0)
+
+    if args.output_dir is None:
+        args.output_dir = tempfile.mkdtemp(prefix='edgeBragg-archive-')
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    result = run(args)
+    if args.o:
+        with open(args.o, 'w') as fp:
+            json.dump(result, fp, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+'''
+Compares peak localization engines on the same patch set: the classical
+localizers of BraggNNClassicInfer (centroid, gaussian, pvoigt) and, when a
+model is given, BraggNN (torch/tensorrt). Patches are cropped from synthetic
+frames by the frame processor, so every engine is scored against the known
+peak positions (recall, mean/rms/p90 error in pixels). Throughput is reported
+as peaks/s of wall time and peaks/s per core (peaks over process CPU time), so
+that multi-threaded engines are not favoured. With -reference, the distance of
+each engine's locations to the reference engine's is reported too, e.g. to
+sanity check BraggNN against a fit. Results are reported as json.
+'''
+
+import argparse, json, sys, time
+import numpy as np
+
+from benchUtil import run_info
+from benchPeakFinding import get_peak_finder
+from braggNNInferEngine import create_infer_engine
+from frameSource import SyntheticFrameSource
+from syntheticPeaks import match_peaks
+
+def make_patches(args):
+    source = SyntheticFrameSource(nFrames=args.n_frames, nx=args.nx, ny=args.ny, dtype=args.dtype, nPeaks=args.n_peaks, \
+                                  peakSigma=args.peak_sigma, peakIntensity=args.peak_intensity, background=args.min_intensity/10, \
+                                  fwhmSpread=args.fwhm_spread, etaRange=tuple(args.eta), intensitySpread=args.intensity_spread, seed=args.seed)
+    finder = get_peak_finder(args.impl, args.psz)
+    patches, ori = [], []
+    for i in range(args.n_frames):
+        p, o = finder(frame=source.getFrame(i), psz=args.psz, angle=i, min_intensity=args.min_intensity, max_r=None, min_sz=1)[:2]
+        patches.extend(p)
+        ori.extend(o)
+    patches = np.array(patches, dtype=np.float32).reshape((-1, 1, args.psz, args.psz))
+    ori = np.array(ori, dtype=np.float64).reshape((-1, 3))
+    return patches, ori, source.getTruth(range(args.n_frames)), source.describe()
+
+def run_engine(engine, patches, mbsz, repeat):
+    engine.process(patches[:mbsz])
+    wallTimes, cpuTimes = [], []
+    for r in range(repeat):
+        preds = []
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        for b in range(0, len(patches), mbsz):
+            preds.append(engine.process(patches[b:b+mbsz]))
+        wallTimes.append(time.perf_counter() - wall0)
+        cpuTimes.append(time.process_time() - cpu0)
+    return np.concatenate(preds), float(np.median(wallTimes)), float(np.median(cpuTimes))
+
+def run(args):
+    patches, ori, truth, sourceInfo = make_patches(args)
+    nPatches = len(patches)
+    if nPatches == 0:
+        raise Exception('No peaks found in the synthetic frames, check -min_intensity')
+    print(f'{nPatches} patches from {args.n_frames} frames', file=sys.stderr)
+
+    engines = list(args.engines)
+    if args.model:
+        engines += [e for e in args.model_engines if e not in engines]
+    locations = {}
+    results = {}
+    for name in engines:
+        params = {
+            'infer' : {'engine' : name, 'mbsz' : args.mbsz, 'fit_iterations' : args.fit_iterations},
+            'model' : {'psz' : args.psz, 'model_fname' : args.model}
+        }
+        try:
+            engine = create_infer_engine(params)
+        except Exception as ex:
+            results[name] = {'skipped' : str(ex)}
+            print(f'{name}: skipped, {ex}', file=sys.stderr)
+            continue
+        pred, wallTime, cpuTime = run_engine(engine, patches, args.mbsz, args.repeat)
+        engine.stop()
+        rows = ori[:, 1] + pred[:, 0]*args.psz
+        cols = ori[:, 2] + pred[:, 1]*args.psz
+        locations[name] = (rows, cols)
+        accuracy = match_peaks(truth, ori[:, 0], rows, cols, maxDistance=args.match_distance)
+        results[name] = {
+            'time' : wallTime,
+            'cpuTime' : cpuTime,
+            'peaksPerSecond' : nPatches/wallTime if wallTime > 0 else 0.0,
+            'peaksPerCoreSecond' : nPatches/cpuTime if cpuTime > 0 else 0.0,
+            'usPerPeak' : 1e6*wallTime/nPatches if nPatches > 0 else None
+        }
+        results[name].update(accuracy)
+        print(f"{name}: {results[name]['peaksPerSecond']:.0f} peaks/s, {results[name]['peaksPerCoreSecond']:.0f} peaks/s/core, " \
+              f"recall {accuracy['recall']:.3f}, error {accuracy['meanError']:.3f} px", file=sys.stderr)
+
+    if args.reference in locations:
+        refRows, refCols = locations[args.reference]
+        for name, (rows, cols) in locations.items():
+            d = np.hypot(rows - refRows, cols - refCols)
+            results[name]['referenceMeanDistance'] = float(d.mean()) if len(d) > 0 else None
+            results[name]['referenceP90Distance'] = float(np.percentile(d, 90)) if len(d) > 0 else None
+
+    output = run_info('localization', args.label)
+    output.update({
+        'source' : sourceInfo,
+        'nPatches' : nPatches,
+        'psz' : args.psz,
+        'mbsz' : args.mbsz,
+        'reference' : args.reference,
+        'engines' : results
+    })
+    return output
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='throughput and accuracy of the peak localization engines on the same patches')
+    parser.add_argument('-engines',   type=str, nargs='+', default=['centroid', 'gaussian', 'pvoigt'], help='engines to compare')
+    parser.add_argument('-model',     type=str, default=None, help='BraggNN model; adds the -model_engines to the comparison')
+    parser.add_argument('-model_engines', type=str, nargs='+', default=['torch'], help='engines run with -model')
+    parser.add_argument('-reference', type=str, default=None, help='engine the others are compared against, e.g. torch')
+    parser.add_argument('-fit_iterations', type=int, default=10, help='Levenberg-Marquardt iterations of the fitting engines')
+    parser.add_argument('-psz',       type=int, default=15, help='patch size')
+    parser.add_argument('-mbsz',      type=int, default=512, help='batch size')
+    parser.add_argument('-impl',      type=str, default='sparse', choices=['processor', 'sparse', 'function'], help='peak finder used to crop the patches')
+    parser.add_argument('-nx',        type=int, default=1024, help='synthetic frame width')
+    parser.add_argument('-ny',        type=int, default=1024, help='synthetic frame height')
+    parser.add_argument('-dtype',     type=str, default='uint16', help='synthetic frame data type')
+    parser.add_argument('-n_frames',  type=int, default=8, help='number of synthetic frames')
+    parser.add_argument('-n_peaks',   type=int, default=500, help='number of peaks per frame')
+    parser.add_argument('-peak_sigma', type=float, default=1.2, help='gaussian sigma of the narrowest peaks')
+    parser.add_argument('-fwhm_spread', type=float, default=2.0, help='range of peak FWHM above the narrowest')
+    parser.add_argument('-eta',       type=float, nargs=2, default=[0.0, 0.5], help='range of the pseudo-Voigt mixing factor')
+    parser.add_argument('-peak_intensity', type=float, default=1000, help='lowest peak amplitude')
+    parser.add_argument('-intensity_spread', type=float, default=5.0, help='ratio of highest to lowest peak amplitude')
+    parser.add_argument('-min_intensity', type=float, default=100, help='threshold used for peak finding')
+    parser.add_argument('-match_distance', type=float, default=2.0, help='max distance in pixels for a found peak to match a generated one')
+    parser.add_argument('-repeat',    type=int, default=3, help='timed repetitions per engine')
+    parser.add_argument('-seed',      type=int, default=0, help='random seed for synthetic frames')
+    parser.add_argument('-label',     type=str, default=None, help='free-form label stored with the results')
+    parser.add_argument('-o',         type=str, default=None, help='write json results to this file instead of stdout')
+
+    args, unparsed = parser.parse_known_args()
+    if len(unparsed) > 0:
+        print('Unrecognized argument(s): \n%s \nProgram exiting ... ... ' % '\n'.join(unparsed))
+        exit(0)
+
+    result = run(args)
+    if args.o:
+        with open(args.o, 'w') as fp:
+            json.dump(result, fp, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+'''
+Microbenchmarks for the frame processing hot path: connected-component peak
+cropping (BraggNNFrameProcessor._framePeakPatchesCv2 / _framePeakPatchesSparse /
+frame_peak_patches_cv2),
+CodecAD.decompress and dark subtraction.
+
+The frames are synthetic with known peak positions, so the peaks suite also
+reports recall and the localization error of the patch centroids next to the
+peak rate, as peak density scales.
+
+Results (ns/pixel and us/peak) are written as json; when a baseline json is
+given, the run fails (exit code 1) if any case is slower than the baseline by
+more than the threshold percentage.
+'''
+
+import argparse, itertools, json, sys, time
+import numpy as np
+
+from benchUtil import run_info
+from codecAD import CodecAD
+from codecEncoder import CodecEncoder
+from frameSource import SyntheticFrameSource
+from syntheticPeaks import match_peaks
+
+PEAK_AMPLITUDE = 1000
+
+def time_call(func, repeat):
+    func()
+    elapsed = []
+    for i in range(repeat):
+        tick = time.perf_counter()
+        func()
+        elapsed.append(time.perf_counter() - tick)
+    return float(np.median(elapsed)), float(np.min(elapsed))
+
+def make_frame(size, density, psz, peak_frac, dtype, min_intensity, seed):
+    # sigma chosen so that the above-threshold footprint is about peak_frac*psz wide
+    width = max(1.0, peak_frac*psz)
+    sigma = max(0.3, (width - 1)/2) / np.sqrt(2*np.log(PEAK_AMPLITUDE/min_intensity))
+    nPeaks = int(density*size*size/1e6)
+    source = SyntheticFrameSource(nFrames=1, nx=size, ny=size, dtype=dtype, nPeaks=nPeaks, peakSigma=sigma, \
+                                  peakIntensity=PEAK_AMPLITUDE, background=min_intensity/10, seed=seed)
+    return source.getFrame(0), source.getTruth([0])
+
+# intensity weighted centroid of each patch, in frame coordinates
+def patch_centroids(patches, peak_ori):
+    if len(patches) == 0:
+        return np.zeros(0), np.zeros(0)
+    ori = np.array(peak_ori, dtype=np.float64)
+    rows, cols = np.zeros(len(ori)), np.zeros(len(ori))
+    # routed patch sizes are handled one size at a time
+    sizes = np.array([np.shape(patch)[-1] for patch in patches])
+    for psz in np.unique(sizes):
+        idx = np.flatnonzero(sizes == psz)
+        block = np.array([patches[i] for i in idx], dtype=np.float64)
+        grid = np.arange(psz)
+        total = block.sum(axis=(1, 2))
+        total[total == 0] = 1
+        rows[idx] = ori[idx, 1] + (block.sum(axis=2)*grid).sum(axis=1)/total
+        cols[idx] = ori[idx, 2] + (block.sum(axis=1)*grid).sum(axis=1)/total
+    return rows, cols
+
+# with psz_routes (processor implementations only), each peak is cropped at the
+# smallest of these patch sizes that fits it, psz being the largest
+def get_peak_finder(impl, psz, psz_routes=None):
+    if impl == 'function':
+        from frameProcess import frame_peak_patches_cv2
+        return frame_peak_patches_cv2
+    from braggNNFrameProcessor import BraggNNFrameProcessor
+    processor = BraggNNFrameProcessor(psz=psz, mbsz=1, offset_recover=0, min_intensity=0, max_radius=None, \
+                                      min_peak_sz=1, dark_h5=None, patch_q=None, write_q=None, psz_routes=psz_routes)
+    if impl == 'sparse':
+        return processor._framePeakPatchesSparse
+    return processor._framePeakPatchesCv2
+
+def bench_peaks(args):
+    results = []
+    for size, density, psz, peak_frac, dtype in itertools.product(args.sizes, args.densities, args.psz, args.peak_fracs, args.dtypes):
+        frame, truth = make_frame(size, density, psz, peak_frac, dtype, args.min_intensity, args.seed)
+        routes = sorted(set(r for r in args.psz_routes if r < psz) | {psz}) if args.psz_routes else None
+        finder = get_peak_finder(args.impl, psz, routes)
+        patches, peak_ori = finder(frame=frame, psz=psz, angle=0, min_intensity=args.min_intensity, max_r=None, min_sz=1)[:2]
+        rows, cols = patch_centroids(patches, peak_ori)
+        accuracy = match_peaks(truth, np.zeros(len(rows)), rows, cols, maxDistance=args.match_distance)
+        t, tmin = time_call(lambda: finder(frame=frame, psz=psz, angle=0, min_intensity=args.min_intensity, max_r=None, min_sz=1), args.repeat)
+        nFound = len(patches)
+        results.append({
+            'case' : f'peaks/{args.impl}/size={size}/density={density}/psz={psz}/peak={peak_frac}/dtype={dtype}' + \
+                     (f'/routes={"-".join(map(str, routes))}' if routes else ''),
+            'time' : t,
+            'minTime' : tmin,
+            'nsPerPixel' : 1e9*t/frame.size,
+            'usPerPeak' : 1e6*t/nFound if nFound > 0 else None,
+            'peaksPerSecond' : nFound/t if t > 0 else 0.0,
+            'nPeaksGenerated' : len(truth['row']),
+            'nPeaksFound' : nFound,
+            'nPatchPixels' : int(sum(np.asarray(patch).size for patch in patches)),
+            'recall' : accuracy['recall'],
+            'precision' : accuracy['precision'],
+            'meanError' : accuracy['meanError'],
+            'rmsError' : accuracy['rmsError']
+        })
+        log(results[-1])
+    return results
+
+def bench_decompress(args):
+    results = []
+    encoder = CodecEncoder()
+    codecAD = CodecAD()
+    for size, dtype, codecName in itertools.product(args.sizes, args.dtypes, args.codecs):
+        case = f'decompress/size={size}/dtype={dtype}/codec={codecName}'
+        frame, truth = make_frame(size, args.densities[0], args.psz[0], 0.5, dtype, args.min_intensity, args.seed)
+        try:
+            payload = encoder.compress(frame, codecName)
+            codec = encoder.getCodec(frame, codecName)
+            codecAD.decompress(payload, codec, payload.nbytes, frame.nbytes)
+        except Exception as ex:
+            results.append({'case' : case, 'skipped' : str(ex)})
+            log(results[-1])
+            continue
+        t, tmin = time_call(lambda: codecAD.decompress(payload, codec, payload.nbytes, frame.nbytes), args.repeat)
+        results.append({
+            'case' : case,
+            'time' : t,
+            'minTime' : tmin,
+            'nsPerPixel' : 1e9*t/frame.size,
+            'compressRatio' : frame.nbytes/payload.nbytes
+        })
+        log(results[-1])
+    return results
+
+def bench_dark(args):
+    results = []
+    rng = np.random.default_rng(args.seed)
+    for size, dtype in itertools.product(args.sizes, args.dtypes):
+        frame, truth = make_frame(size, args.densities[0], args.psz[0], 0.5, dtype, args.min_intensity, args.seed)
+        # same dark representation as BraggNNFrameProcessor: mean over dark frames
+        dark_fr = rng.poisson(args.min_intensity/10, size=(4, size, size)).mean(axis=0)
+        t, tmin = time_call(lambda: frame - dark_fr, args.repeat)
+        results.append({
+            'case' : f'dark/size={size}/dtype={dtype}',
+            'time' : t,
+            'minTime' : tmin,
+            'nsPerPixel' : 1e9*t/frame.size
+        })
+        log(results[-1])
+    return results
+
+def find_regressions(results, baseline, threshold):
+    baseResults = {r['case'] : r for r in baseline['results'] if 'nsPerPixel' in r}
+    regressions = []
+    for r in results:
+        base = baseResults.get(r['case'])
+        if base is None or 'nsPerPixel' not in r:
+            continue
+        change = 100*(r['nsPerPixel']/base['nsPerPixel'] - 1)
+        if change > threshold:
+            regressions.append({'case' : r['case'], 'nsPerPixel' : r['nsPerPixel'], \
+                                'baselineNsPerPixel' : base['nsPerPixel'], 'change' : change})
+    return regressions
+
+def log(result):
+    if 'skipped' in result:
+        print(f"{result['case']}: skipped, {result['skipped']}", file=sys.stderr)
+    else:
+        perPeak = f", {result['usPerPeak']:.2f} us/peak" if result.get('usPerPeak') else ''
+        if result.get('meanError') is not None:
+            perPeak += f", recall {result['recall']:.3f}, error {result['meanError']:.3f} px"
+        print(f"{result['case']}: {result['nsPerPixel']:.3f} ns/pixel{perPeak}", file=sys.stderr)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='microbenchmarks for peak finding, decompression and dark subtraction')
+    parser.add_argument('-suites',     type=str, nargs='+', default=['peaks', 'decompress', 'dark'], help='benchmark suites to run')
+    parser.add_argument('-sizes',      type=int, nargs='+', default=[512, 1024, 2048, 4096], help='frame sizes (square frames)')
+    parser.add_argument('-densities',  type=float, nargs='+', default=[100, 1000, 5000], help='peaks per megapixel')
+    parser.add_argument('-psz',        type=int, nargs='+', default=[11, 13, 15], help='patch sizes')
+    parser.add_argument('-peak_fracs', type=float, nargs='+', default=[0.3, 0.6, 0.9], help='peak footprint relative to patch size')
+    parser.add_argument('-dtypes',     type=str, nargs='+', default=['uint16', 'int32', 'float32'], help='frame data types')
+    parser.add_argument('-codecs',     type=str, nargs='+', default=list(CodecEncoder.SUPPORTED_CODECS), help='codecs to decompress')
+    parser.add_argument('-impl',       type=str, default='processor', choices=['processor', 'sparse', 'function'], \
+                        help='peak finder: BraggNNFrameProcessor._framePeakPatchesCv2, BraggNNFrameProcessor._framePeakPatchesSparse or frameProcess.frame_peak_patches_cv2')
+    parser.add_argument('-psz_routes', type=int, nargs='*', default=None, help='smaller patch sizes to route peaks to (e.g. 11 13), processor implementations only')
+    parser.add_argument('-min_intensity', type=float, default=100, help='threshold used for peak finding')
+    parser.add_argument('-match_distance', type=float, default=2.0, help='max distance in pixels for a found peak to match a generated one')
+    parser.add_argument('-repeat',     type=int, default=5, help='timed repetitions per case')
+    parser.add_argument('-seed',       type=int, default=0, help='random seed for synthetic frames')
+    parser.add_argument('-baseline',   type=str, default=None, help='baseline json to compare against')
+    parser.add_argument('-threshold',  type=float, default=10.0, help='allowed slowdown in percent before a case counts as regressed')
+    parser.add_argument('-label',      type=str, default=None, help='free-form label stored with the results')
+    parser.add_argument('-o',          type=str, default=None, help='write json results to this file instead of stdout')
+
+    args, unparsed = parser.parse_known_args()
+    if len(unparsed) > 0:
+        print('Unrecognized argument(s): \n%s \nProgram exiting ... ... ' % '\n'.join(unparsed))
+        exit(0)
+
+    suites = {'peaks' : bench_peaks, 'decompress' : bench_decompress, 'dark' : bench_dark}
+    results = []
+    for suite in args.suites:
+        results.extend(suites[suite](args))
+
+    output = run_info('peakFinding', args.label)
+    output['args'] = vars(args)
+    output['results'] = results
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as fp:
+            regressions = find_regressions(results, json.load(fp), args.threshold)
+        output['regressions'] = regressions
+
+    if args.o:
+        with open(args.o, 'w') as fp:
+            json.dump(output, fp, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+    for r in regressions:
+        print(f"REGRESSION {r['case']}: {r['nsPerPixel']:.3f} ns/pixel vs {r['baselineNsPerPixel']:.3f} baseline (+{r['change']:.1f}%)", file=sys.stderr)
+    if regressions:
+        exit(1)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+'''
+Offline replay benchmark for BraggNNInferImageProcessor.
+
+Frames from an HDF5 'frames' dataset (the format used by tools/daq-simu-pva.py)
+or from a synthetic generator are fed into process() at a target (or unbounded)
+rate; the real frame processors, batching, inference and writers run as they
+would under pvapy-hpc-consumer, with the pvAccess server replaced by a local
+stand-in. Per-stage and end-to-end throughput/latency are reported as JSON.
+When the source has ground truth (synthetic frames, or h5 files written by
+syntheticPeaks.py) and the inference stage produces peak locations, the
+localization error is reported as well.
+'''
+
+import argparse, json, os, sys, tempfile, threading, time
+import numpy as np
+import yaml
+
+from braggNNInferImageProcessor import BraggNNInferImageProcessor
+from benchUtil import run_info, latency_summary
+from frameSource import H5FrameSource, SyntheticFrameSource
+from pvaStandIn import StandInNtNdArray, StandInPvaServer
+from syntheticPeaks import match_peaks
+
+class BenchImageProcessor(BraggNNInferImageProcessor):
+
+    def __init__(self, configDict={}):
+        BraggNNInferImageProcessor.__init__(self, configDict)
+        self.outputTimes = {}
+        self.peakLocations = []
+        self.outputLock = threading.Lock()
+
+    # record when the last output for a frame has been published, and where
+    # its peaks were localized
+    def _pvaPublishPeaks(self, ddict):
+        BraggNNInferImageProcessor._pvaPublishPeaks(self, ddict)
+        with self.outputLock:
+            self.outputTimes[ddict['uniqueId']] = time.time()
+            if 'ploc' in ddict:
+                self.peakLocations.append((ddict['uniqueId'], ddict['ploc']))
+
+    def getOutputTimes(self):
+        with self.outputLock:
+            return dict(self.outputTimes)
+
+    # (frame ids, rows, cols) of all localized peaks
+    def getPeakLocations(self):
+        with self.outputLock:
+            if not self.peakLocations:
+                return None
+            frames = np.concatenate([np.full(len(ploc), uid) for uid, ploc in self.peakLocations])
+            ploc = np.concatenate([ploc for uid, ploc in self.peakLocations])
+        return frames, ploc[:, 1] + ploc[:, 3], ploc[:, 2] + ploc[:, 4]
+
+def apply_overrides(params, overrides):
+    for item in overrides:
+        key, value = item.split('=', 1)
+        d = params
+        keys = key.split('.')
+        for k in keys[:-1]:
+            d = d.setdefault(k, {})
+        d[keys[-1]] = yaml.safe_load(value)
+
+def prepare_config(args):
+    params = yaml.load(open(args.cfg, 'r'), Loader=yaml.CLoader)
+    output = params.setdefault('output', {})
+    for key in ('frame2file', 'peaks2file'):
+        fname = output.get(key)
+        if args.no_writers or not fname:
+            output[key] = None
+        else:
+            output[key] = os.path.join(args.output_dir, os.path.basename(fname))
+    if args.no_writers:
+        output['port4zmq'] = None
+    apply_overrides(params, args.set)
+    cfg = os.path.join(args.output_dir, 'bench-config.yaml')
+    with open(cfg, 'w') as fp:
+        yaml.safe_dump(params, fp)
+    return cfg, params
+
+def stage_summary(stats):
+    def mean_of(suffix):
+        values = [v for k, v in stats.items() if k.startswith('frameProcessor') and k.endswith(f'_{suffix}') and v > 0]
+        return float(np.mean(values)) if values else 0.0
+
+    def rate(t):
+        return 1.0/t if t > 0 else 0.0
+
+    stages = {
+        'frameProcessing' : {'time' : stats['frameProcessingTime'], 'rate' : stats['frameProcessingRate']},
+        'decode' : {'time' : mean_of('decodeTime'), 'rate' : rate(mean_of('decodeTime'))},
+        'peakFinding' : {'time' : mean_of('peakTime'), 'rate' : rate(mean_of('peakTime'))},
+        'publish' : {'time' : stats['publishTime'], 'rate' : stats['publishRate']},
+    }
+    if 'inferTime' in stats:
+        stages['infer'] = {'time' : stats['inferTime'], 'rate' : stats['inferRate']}
+    for writer, timeKey in (('frameHdfWriter', 'writeTime'), ('peakHdfWriter', 'writeTime'), ('peakZmqWriter', 'publishTime')):
+        if f'{writer}_{timeKey}' in stats:
+            t = stats[f'{writer}_{timeKey}']
+            stages[writer] = {'time' : t, 'rate' : rate(t)}
+    return stages
+
+def run(args):
+    if args.ifn:
+        source = H5FrameSource(args.ifn, dataset=args.dataset, preload=not args.no_preload)
+    else:
+        source = SyntheticFrameSource(nFrames=args.n_distinct, nx=args.nx, ny=args.ny, dtype=args.dtype, \
+                                      nPeaks=args.n_peaks, peakSigma=args.peak_sigma, peakIntensity=args.peak_intensity, \
+                                      etaRange=(0.0, args.eta), seed=args.seed)
+    nFrames = args.n_frames if args.n_frames > 0 else source.nFrames
+    cfg, params = prepare_config(args)
+
+    processor = BenchImageProcessor({'configFile' : cfg})
+    processor.processorId = 1
+    processor.outputChannel = 'bench:output'
+    processor.pvaServer = StandInPvaServer()
+    processor.start()
+    time.sleep(args.start_delay)
+
+    submitTimes = {}
+    submitTimeSum = 0.0
+    delta_t = 1.0/args.rate if args.rate > 0 else 0
+    t0 = time.time()
+    for i in range(nFrames):
+        if delta_t > 0:
+            delay = t0 + i*delta_t - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        frameId = i + 1
+        pvObject = StandInNtNdArray(frameId, source.getFrame(i))
+        tick = time.time()
+        submitTimes[frameId] = tick
+        processor.process(pvObject)
+        submitTimeSum += time.time() - tick
+    submitEnd = time.time()
+
+    deadline = submitEnd + args.drain_timeout
+    while time.time() < deadline:
+        if len(processor.getOutputTimes()) >= nFrames:
+            break
+        time.sleep(0.05)
+    outputTimes = processor.getOutputTimes()
+    stats = processor.stop()
+
+    accuracy = None
+    truth = source.getTruth(range(nFrames))
+    peakLocations = processor.getPeakLocations()
+    if truth is not None and peakLocations is not None:
+        frames, rows, cols = peakLocations
+        # frame ids are submitted as source index + 1
+        accuracy = match_peaks(truth, frames - 1, rows, cols, maxDistance=args.match_distance)
+    source.close()
+
+    latencies = [outputTimes[fid] - submitTimes[fid] for fid in outputTimes if fid in submitTimes]
+    nCompleted = len(latencies)
+    elapsed = (max(outputTimes.values()) - t0) if nCompleted > 0 else time.time() - t0
+    result = run_info('pipeline', args.label)
+    result.update({
+        'config' : params,
+        'source' : source.describe(),
+        'targetRate' : args.rate,
+        'nFramesSubmitted' : nFrames,
+        'nFramesCompleted' : nCompleted,
+        'elapsed' : elapsed,
+        'submit' : {
+            'rate' : nFrames/(submitEnd - t0) if submitEnd > t0 else 0.0,
+            'time' : submitTimeSum/nFrames if nFrames > 0 else 0.0
+        },
+        'endToEnd' : {
+            'throughput' : nCompleted/elapsed if elapsed > 0 else 0.0,
+            'latency' : latency_summary(latencies)
+        },
+        'stages' : stage_summary(stats),
+        'accuracy' : accuracy,
+        'stats' : stats
+    })
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='offline replay benchmark of the edgeBragg processing pipeline')
+    parser.add_argument('-cfg',       type=str, required=True, help='yaml config file')
+    parser.add_argument('-ifn',       type=str, default=None, help='h5 file with frames to replay; synthetic frames are generated if not given')
+    parser.add_argument('-dataset',   type=str, default='frames', help='name of the frames dataset in the h5 file')
+    parser.add_argument('-no_preload',action='store_true', help='read frames from the h5 file while replaying instead of loading them first')
+    parser.add_argument('-nx',        type=int, default=2048, help='synthetic frame width')
+    parser.add_argument('-ny',        type=int, default=2048, help='synthetic frame height')
+    parser.add_argument('-dtype',     type=str, default='uint16', help='synthetic frame data type')
+    parser.add_argument('-n_peaks',   type=int, default=200, help='number of peaks per synthetic frame')
+    parser.add_argument('-peak_sigma',type=float, default=1.5, help='gaussian sigma of synthetic peaks')
+    parser.add_argument('-peak_intensity', type=float, default=1000, help='amplitude of synthetic peaks')
+    parser.add_argument('-eta',       type=float, default=0.0, help='synthetic peaks are pseudo-Voigt with a Lorentzian fraction up to eta')
+    parser.add_argument('-match_distance', type=float, default=2.0, help='max distance in pixels for a localized peak to match a true one')
+    parser.add_argument('-n_distinct',type=int, default=16, help='number of distinct synthetic frames to cycle through')
+    parser.add_argument('-seed',      type=int, default=0, help='random seed for synthetic frames')
+    parser.add_argument('-n_frames',  type=int, default=0, help='number of frames to submit, 0 for one pass over the source')
+    parser.add_argument('-rate',      type=float, default=0, help='target submit rate in frames per second, 0 for unbounded')
+    parser.add_argument('-start_delay', type=float, default=2.0, help='seconds to wait for workers to start before submitting')
+    parser.add_argument('-drain_timeout', type=float, default=60.0, help='seconds to wait for outstanding frames after the last submit')
+    parser.add_argument('-output_dir',type=str, default=None, help='directory for writer outputs and the effective config (temporary by default)')
+    parser.add_argument('-no_writers',action='store_true', help='disable hdf and zmq writers')
+    parser.add_argument('-set',       type=str, action='append', default=[], help='config override as dotted.key=value, may be repeated')
+    parser.add_argument('-label',     type=str, default=None, help='free-form label stored with the results')
+    parser.add_argument('-o',         type=str, default=None, help='write json results to this file instead of stdout')
+
+    args, unparsed = parser.parse_known_args()
+    if len(unparsed) > 0:
+        print('Unrecognized argument(s): \n%s \nProgram exiting ... ... ' % '\n'.join(unparsed))
+        exit(0)
+
+    if args.output_dir is None:
+        args.output_dir = tempfile.mkdtemp(prefix='edgeBragg-bench-')
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    result = run(args)
+    if args.o:
+        with open(args.o, 'w') as fp:
+            json.dump(result, fp, indent=2, default=str)
+    else:
+        json.dump(result, sys.stdout, indent=2, default=str)
+        print()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+'''
+End-to-end check and benchmark of remote inference (remoteInfer.py) on one
+host: a RemoteInferServer runs in this process and several producer processes
+ship patch batches to it, as frame processing nodes would. Every producer
+checks that each batch comes back exactly once, tagged with its frame id, and
+that the returned locations match those of the same engine run locally.
+With -publish, the server publishes the localized batches instead, and this
+process subscribes to them and checks the frame ids per producer.
+Throughput, round trip times and credit waits are reported as json.
+'''
+
+import argparse, json, multiprocessing as mp, sys, threading, time
+import numpy as np
+import zmq
+
+from autotune import representative_patches
+from benchUtil import run_info
+from braggNNInferEngine import create_infer_engine
+from remoteInfer import RemoteInferClient, RemoteInferServer
+
+def get_params(args):
+    return {
+        'infer' : {'engine' : args.engine, 'mbsz' : args.mbsz},
+        'model' : {'psz' : args.psz, 'model_fname' : args.model}
+    }
+
+def producer(i, args, address, result_q):
+    params = get_params(args)
+    patches = representative_patches(params, args.n_patches, seed=args.seed + i).astype(args.dtype)
+    rng = np.random.default_rng(args.seed + i)
+    # the angle column holds the patch index, so that returned batches can be told apart
+    ori = np.stack([np.arange(len(patches)), rng.integers(0, 2048, len(patches)), rng.integers(0, 2048, len(patches))], axis=1).astype(np.float32)
+    engine = None if args.publish else create_infer_engine(params)
+    client = RemoteInferClient(address, credits=args.credits, timeout=args.timeout, name=f'producer{i}')
+
+    nBatchesPerFrame = max(1, args.patches_per_frame // args.mbsz)
+    sent, results = {}, []
+    nPatchesSent = 0
+    t0 = time.perf_counter()
+    for b in range(args.n_batches):
+        start = (b*args.mbsz) % len(patches)
+        in_mb, ori_mb = patches[start:start + args.mbsz], ori[start:start + args.mbsz]
+        frameId = i*args.n_batches + b // nBatchesPerFrame
+        lastBatch = b % nBatchesPerFrame == nBatchesPerFrame - 1 or b == args.n_batches - 1
+        sent[(frameId, start)] = sent.get((frameId, start), 0) + 1
+        nPatchesSent += len(in_mb)
+        results += client.submit(in_mb, ori_mb, frameId, lastBatch)
+    results += client.flush()
+    elapsed = time.perf_counter() - t0
+
+    nLocalized, maxDifference = 0, 0.0
+    returned = {}
+    for in_mb, ori_mb, frameId, lastBatch, pred, forwarded in results:
+        key = (frameId, int(ori_mb[0, 0]))
+        returned[key] = returned.get(key, 0) + 1
+        if pred is not None:
+            nLocalized += 1
+            maxDifference = max(maxDifference, float(np.abs(pred - engine.process(in_mb)).max()))
+    stats = client.getStats()
+    client.close()
+    result_q.put({
+        'producer' : i,
+        'nBatchesSent' : args.n_batches,
+        'nPatchesSent' : nPatchesSent,
+        'nBatchesReturned' : len(results),
+        'nBatchesLocalized' : nLocalized,
+        'nBatchesForwarded' : sum(1 for r in results if r[5]),
+        'batchesMatch' : returned == sent,
+        'maxDifference' : maxDifference,
+        'time' : elapsed,
+        'patchesPerSecond' : nPatchesSent/elapsed,
+        'clientStats' : stats
+    })
+
+def subscriber(port, nExpected, received, isDone):
+    context = zmq.Context()
+    sub = context.socket(zmq.SUB)
+    sub.setsockopt(zmq.SUBSCRIBE, b'')
+    sub.connect(f'tcp://localhost:{port}')
+    while not isDone.is_set() and sum(len(v) for v in received.values()) < nExpected:
+        if sub.poll(100):
+            ddict = sub.recv_pyobj()
+            received.setdefault(ddict['producer'], []).append(ddict['uniqueId'])
+    sub.close()
+    context.term()
+
+def run(args):
+    address = f'tcp://127.0.0.1:{args.port}'
+    server = RemoteInferServer(get_params(args), f'tcp://*:{args.port}', credits=args.credits, \
+                               publishPort=args.port + 1 if args.publish else None)
+    serverThread = threading.Thread(target=server.run, daemon=True)
+    serverThread.start()
+
+    received, subDone = {}, threading.Event()
+    subThread = None
+    if args.publish:
+        subThread = threading.Thread(target=subscriber, args=(args.port + 1, args.n_producers*args.n_batches, received, subDone), daemon=True)
+        subThread.start()
+        # slow joiner: give the subscription time to reach the publisher
+        time.sleep(0.5)
+
+    result_q = mp.Queue()
+    t0 = time.perf_counter()
+    procs = [mp.Process(target=producer, args=(i, args, address, result_q)) for i in range(args.n_producers)]
+    for p in procs:
+        p.start()
+    producers = sorted([result_q.get() for p in procs], key=lambda r: r['producer'])
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - t0
+    if subThread:
+        subThread.join(timeout=args.timeout)
+        subDone.set()
+    server.stop()
+    serverThread.join()
+    server.close()
+
+    nPatches = sum(r['nPatchesSent'] for r in producers)
+    output = run_info('remoteInfer', args.label)
+    output.update({
+        'engine' : args.engine,
+        'nProducers' : args.n_producers,
+        'mbsz' : args.mbsz,
+        'psz' : args.psz,
+        'dtype' : args.dtype,
+        'credits' : args.credits,
+        'publish' : args.publish,
+        'time' : elapsed,
+        'patchesPerSecond' : nPatches/elapsed,
+        'server' : server.getStats(),
+        'producers' : producers,
+        'ok' : all(r['batchesMatch'] for r in producers) and \
+               (all(r['nBatchesForwarded'] == r['nBatchesSent'] for r in producers) if args.publish else \
+                all(r['nBatchesLocalized'] == r['nBatchesSent'] and r['maxDifference'] < 1e-5 for r in producers))
+    })
+    if args.publish:
+        output['nBatchesPublished'] = {name : len(ids) for name, ids in received.items()}
+        output['ok'] = output['ok'] and all(len(received.get(f'producer{i}', [])) == args.n_batches for i in range(args.n_producers))
+    return output
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='end-to-end check and benchmark of remote inference with several local producers')
+    parser.add_argument('-engine',    type=str, default='centroid', help='inference engine of the server')
+    parser.add_argument('-model',     type=str, default=None, help='BraggNN model, for the torch/tensorrt engines')
+    parser.add_argument('-n_producers', type=int, default=4, help='number of producer processes')
+    parser.add_argument('-n_batches', type=int, default=200, help='batches per producer')
+    parser.add_argument('-patches_per_frame', type=int, default=256, help='patches per frame id')
+    parser.add_argument('-n_patches', type=int, default=4096, help='distinct patches per producer')
+    parser.add_argument('-mbsz',      type=int, default=64, help='batch size')
+    parser.add_argument('-psz',       type=int, default=15, help='patch size')
+    parser.add_argument('-dtype',     type=str, default='uint16', help='patch data type on the wire')
+    parser.add_argument('-credits',   type=int, default=4, help='batches in flight per producer')
+    parser.add_argument('-timeout',   type=float, default=10, help='client timeout in seconds')
+    parser.add_argument('-publish',   action='store_true', help='server publishes results (on port + 1) instead of returning them')
+    parser.add_argument('-port',      type=int, default=5560, help='server port')
+    parser.add_argument('-seed',      type=int, default=0, help='random seed for synthetic patches')
+    parser.add_argument('-label',     type=str, default=None, help='free-form label stored with the results')
+    parser.add_argument('-o',         type=str, default=None, help='write json results to this file instead of stdout')
+
+    args, unparsed = parser.parse_known_args()
+    if len(unparsed) > 0:
+        print('Unrecognized argument(s): \n%s \nProgram exiting ... ... ' % '\n'.join(unparsed))
+        exit(0)
+
+    result = run(args)
+    if args.o:
+        with open(args.o, 'w') as fp:
+            json.dump(result, fp, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    exit(0 if result['ok'] else 1)
@@ -0,0 +1,35 @@
+'''
+Helpers shared by the benchmark scripts.
+'''
+
+import os, socket, subprocess, time
+import numpy as np
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), \
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def run_info(benchmark, label=None):
+    return {
+        'benchmark' : benchmark,
+        'label' : label,
+        'commit' : get_commit(),
+        'host' : socket.gethostname(),
+        'timestamp' : time.time()
+    }
+
+# summary of a list of durations in seconds, reported in ms
+def latency_summary(latencies):
+    if len(latencies) == 0:
+        return {}
+    lat = 1000*np.array(latencies)
+    return {
+        'mean' : float(lat.mean()),
+        'p50' : float(np.percentile(lat, 50)),
+        'p90' : float(np.percentile(lat, 90)),
+        'p99' : float(np.percentile(lat, 99)),
+        'max' : float(lat.max())
+    }
@@ -0,0 +1,131 @@
+import numpy as np
+from pvapy.utility.loggingManager import LoggingManager
+
+class BraggNNClassicInfer:
+    '''
+    Non-NN peak localization with the interface of BraggNNTorchInfer:
+    process(in_mb) takes a (N, 1, psz, psz) batch of patches and returns (N, 2)
+    (row, col) peak locations relative to the patch size.
+
+    Methods:
+      centroid - intensity weighted centroid
+      gaussian - least squares fit of A*exp(-dr^2/2sr^2 - dc^2/2sc^2)
+      pvoigt   - least squares fit of A*(eta*L + (1-eta)*G), Lorentzian L and
+                 Gaussian G of the same FWHM
+
+    Fits run Levenberg-Marquardt on the whole batch at once (a PxP system per
+    patch solved with one batched np.linalg.solve per iteration), starting from
+    the centroid and second moments. Only the non-zero pixels of a patch are
+    fitted, since the frame processor zeroes everything below min_intensity
+    and outside the peak's component. Patches whose fit does not converge to
+    a finite location inside the patch fall back to the centroid.
+    '''
+
+    METHODS = ('centroid', 'gaussian', 'pvoigt')
+    FWHM_SIGMA = 2*np.sqrt(2*np.log(2))
+
+    def __init__(self, method='pvoigt', nIter=10):
+        self.logger = LoggingManager.getLogger(self.__class__.__name__)
+        if method not in self.METHODS:
+            raise Exception(f'Unknown localization method: {method}')
+        self.method = method
+        self.nIter = nIter
+        self.psz = None
+        self.nFitFailures = 0
+        self.logger.debug(f'Classic inference engine initialization completed, method is {method}')
+
+    def _setGrid(self, psz):
+        if psz != self.psz:
+            self.psz = psz
+            self.r = np.repeat(np.arange(psz, dtype=np.float64), psz)
+            self.c = np.tile(np.arange(psz, dtype=np.float64), psz)
+
+    def _moments(self, y):
+        total = y.sum(axis=1)
+        total[total == 0] = 1
+        rows = (y*self.r).sum(axis=1)/total
+        cols = (y*self.c).sum(axis=1)/total
+        sr = np.sqrt((y*(self.r - rows[:, None])**2).sum(axis=1)/total)
+        sc = np.sqrt((y*(self.c - cols[:, None])**2).sum(axis=1)/total)
+        return rows, cols, np.maximum(sr, 0.5), np.maximum(sc, 0.5)
+
+    # model values (N, M) and jacobian (N, P, M) for parameters p (N, P)
+    def _gaussian(self, p):
+        A, r0, c0, sr, sc = p.T[:, :, None]
+        dr = self.r - r0
+        dc = self.c - c0
+        g = np.exp(-0.5*((dr/sr)**2 + (dc/sc)**2))
+        f = A*g
+        return f, np.stack([g, f*dr/sr**2, f*dc/sc**2, f*dr**2/sr**3, f*dc**2/sc**3], axis=1)
+
+    def _pvoigt(self, p):
+        A, r0, c0, fw, eta = p.T[:, :, None]
+        dr = self.r - r0
+        dc = self.c - c0
+        x = 4*(dr**2 + dc**2)/fw**2
+        G = np.exp(-np.log(2)*x)
+        L = 1/(1 + x)
+        profile = eta*L + (1 - eta)*G
+        f = A*profile
+        # derivative of the profile with respect to x
+        dpdx = -(eta*L**2 + (1 - eta)*np.log(2)*G)
+        return f, np.stack([profile, A*dpdx*(-8*dr/fw**2), A*dpdx*(-8*dc/fw**2), A*dpdx*(-2*x/fw), A*(L - G)], axis=1)
+
+    def _fit(self, model, p, lower, upper, y, w):
+        n, nParams = p.shape
+        eye = np.eye(nParams)
+        lam = np.full(n, 1e-2)
+        f, J = model(p)
+        cost = (w*(y - f)**2).sum(axis=1)
+        for i in range(self.nIter):
+            Jw = J*w[:, None, :]
+            H = Jw @ J.transpose(0, 2, 1)
+            g = (Jw @ (y - f)[:, :, None])[:, :, 0]
+            damping = lam[:, None]*(np.diagonal(H, axis1=1, axis2=2) + 1e-9)
+            step = np.linalg.solve(H + damping[:, :, None]*eye, g[:, :, None])[:, :, 0]
+            pNew = np.clip(p + step, lower, upper)
+            fNew, JNew = model(pNew)
+            costNew = (w*(y - fNew)**2).sum(axis=1)
+            better = costNew < cost
+            p[better] = pNew[better]
+            f[better] = fNew[better]
+            J[better] = JNew[better]
+            cost[better] = costNew[better]
+            lam = np.where(better, lam*0.3, lam*10)
+        return p
+
+    def process(self, in_mb):
+        n = in_mb.shape[0]
+        psz = in_mb.shape[-1]
+        if n == 0:
+            return np.zeros((0, 2), dtype=np.float32)
+        self._setGrid(psz)
+        y = in_mb.reshape((n, psz*psz)).astype(np.float64)
+        rows, cols, sr, sc = self._moments(y)
+        if self.method == 'centroid':
+            return (np.stack([rows, cols], axis=1)/psz).astype(np.float32)
+
+        w = (y > 0).astype(np.float64)
+        amplitude = y.max(axis=1)
+        inf = np.full(n, np.inf)
+        edge = np.full(n, -0.5)
+        if self.method == 'gaussian':
+            p = np.stack([amplitude, rows, cols, sr, sc], axis=1)
+            lower = np.stack([np.zeros(n), edge, edge, np.full(n, 0.3), np.full(n, 0.3)], axis=1)
+            upper = np.stack([inf, edge + psz, edge + psz, np.full(n, psz), np.full(n, psz)], axis=1)
+            p = self._fit(self._gaussian, p, lower, upper, y, w)
+        else:
+            fwhm = self.FWHM_SIGMA*np.sqrt(sr*sc)
+            p = np.stack([amplitude, rows, cols, fwhm, np.full(n, 0.5)], axis=1)
+            lower = np.stack([np.zeros(n), edge, edge, np.full(n, 0.5), np.zeros(n)], axis=1)
+            upper = np.stack([inf, edge + psz, edge + psz, np.full(n, 2*psz), np.ones(n)], axis=1)
+            p = self._fit(self._pvoigt, p, lower, upper, y, w)
+
+        failed = ~np.isfinite(p[:, 1:3]).all(axis=1)
+        self.nFitFailures += int(failed.sum())
+        loc = np.where(failed[:, None], np.stack([rows, cols], axis=1), p[:, 1:3])
+        return (loc/psz).astype(np.float32)
+
+    def stop(self):
+        if self.nFitFailures > 0:
+            self.logger.debug(f'{self.nFitFailures} patches fell back to the centroid')
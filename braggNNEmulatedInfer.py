@@ -0,0 +1,75 @@
+import threading
+import time
+import numpy as np
+from pvapy.utility.loggingManager import LoggingManager
+
+class BraggNNEmulatedInfer:
+    '''
+    Stand-in for an accelerator with the interface of BraggNNTorchInfer:
+    process(in_mb) takes a (N, 1, psz, psz) batch of patches and returns (N, 2)
+    (row, col) peak locations relative to the patch size, after the time the
+    emulated accelerator would take, so that scheduling, batching and
+    backpressure can be tested on machines without a GPU.
+
+    A batch takes batchLatency + N*patchLatency seconds, plus normally
+    distributed jitter (standard deviation in seconds, from a seeded generator).
+    With fixedBatch (the TensorRT engine pads partial batches), N is at least
+    mbsz. At most concurrency batches are in flight at once across all
+    emulated engines of a process, as on one device; the wait does not hold
+    the GIL. Locations are the intensity weighted centroids of the patches
+    (the patch center for empty patches), so results are deterministic.
+    '''
+
+    # one slot semaphore per concurrency limit, shared by the engines of a process
+    SLOTS = {}
+    SLOTS_LOCK = threading.Lock()
+
+    def __init__(self, batchLatency=0.001, patchLatency=0.0, jitter=0.0, concurrency=1, mbsz=None, fixedBatch=False, seed=0):
+        self.logger = LoggingManager.getLogger(self.__class__.__name__)
+        self.batchLatency = batchLatency
+        self.patchLatency = patchLatency
+        self.jitter = jitter
+        self.mbsz = mbsz
+        self.fixedBatch = fixedBatch
+        self.rng = np.random.default_rng(seed)
+        with self.SLOTS_LOCK:
+            if concurrency not in self.SLOTS:
+                self.SLOTS[concurrency] = threading.BoundedSemaphore(concurrency)
+            self.slots = self.SLOTS[concurrency]
+        self.logger.debug(f'Emulated inference engine initialization completed: {1000*batchLatency:.3f} ms per batch, '
+                          f'{1e6*patchLatency:.3f} us per patch, jitter {1000*jitter:.3f} ms, concurrency {concurrency}')
+
+    def _latency(self, n):
+        if self.fixedBatch and self.mbsz:
+            n = max(n, self.mbsz)
+        latency = self.batchLatency + n*self.patchLatency
+        if self.jitter > 0:
+            latency += self.rng.normal(0, self.jitter)
+        return max(latency, 0.0)
+
+    def _centroids(self, in_mb):
+        n, psz = in_mb.shape[0], in_mb.shape[-1]
+        y = in_mb.reshape((n, psz, psz)).astype(np.float32)
+        total = y.sum(axis=(1, 2))
+        grid = np.arange(psz, dtype=np.float32)
+        rows = (y.sum(axis=2)*grid).sum(axis=1)
+        cols = (y.sum(axis=1)*grid).sum(axis=1)
+        center = (psz - 1)/2
+        empty = total == 0
+        total[empty] = 1
+        rows = np.where(empty, center, rows/total)
+        cols = np.where(empty, center, cols/total)
+        return np.stack([rows, cols], axis=1)/psz
+
+    def process(self, in_mb):
+        latency = self._latency(in_mb.shape[0])
+        with self.slots:
+            t0 = time.perf_counter()
+            pred = self._centroids(in_mb)
+            remaining = latency - (time.perf_counter() - t0)
+            if remaining > 0:
+                time.sleep(remaining)
+        return pred
+
+    def stop(self):
+        pass
@@ -4,33 +4,92 @@ import cv2
 import time
 import h5py
 from codecAD import CodecAD
+from memoryAccounting import process_memory
+from workerProfiler import WorkerProfiler
 from pvapy.hpc.userMpDataProcessor import UserMpDataProcessor
 
 class BraggNNFrameProcessor(UserMpDataProcessor):
 
-    def __init__(self, psz, mbsz, offset_recover, min_intensity, max_radius, min_peak_sz, dark_h5, patch_q, write_q):
+    # parameters that can be updated at runtime through configure()
+    CONFIG_KEYS = ('min_intensity', 'min_peak_sz', 'max_radius', 'mbsz', 'offset_recover', 'sparse')
+
+    # frame parameters that can be set per detector (detectors argument)
+    DETECTOR_KEYS = ('psz', 'dark_h5', 'mask_h5', 'dtype')
+
+    # dark frames and masks by file, loaded once by the parent process and
+    # inherited by the frame processor processes forked from it
+    FILE_CACHE = {}
+
+    # neighbours that follow a pixel in raster order (row, col offsets);
+    # 8-connectivity, as cv2.connectedComponentsWithStats uses by default
+    SPARSE_NEIGHBOURS = ((0, 1), (1, -1), (1, 0), (1, 1))
+
+    # with write_sparse, frames are backed up as the pixels above min_intensity
+    # (for BraggNNSparseHdfWriter) instead of dense frames
+    # placement (workerPlacement.WorkerPlacement) pins the processor process and caps its thread pools;
+    # with psz_routes (sorted patch sizes, the largest being psz), each peak is
+    # cropped at the smallest patch size that fits it and batches have one patch size;
+    # mask_h5 holds a 'mask' dataset, nonzero pixels are ignored; frames are converted to dtype if given;
+    # with detectors (dicts of DETECTOR_KEYS overrides), frames are tagged with their detector index
+    # and frame id, and batches carry the sequence id (braggNNReorderBuffer.SequenceIds) of the frame
+    def __init__(self, psz, mbsz, offset_recover, min_intensity, max_radius, min_peak_sz, dark_h5, patch_q, write_q, sparse=False, write_sparse=False, \
+                 placement=None, psz_routes=None, mask_h5=None, dtype=None, detectors=None):
         UserMpDataProcessor.__init__(self)
-        self.psz = psz
         self.mbsz = mbsz
         self.offset_recover = offset_recover
         self.min_intensity = min_intensity
         self.max_radius = max_radius
         self.min_peak_sz = min_peak_sz
         self.dark_h5 = dark_h5
-        self.dark_fr = self._getDarkFrame(self.dark_h5)
+        defaults = {'psz' : psz, 'psz_routes' : psz_routes, 'dark_h5' : dark_h5, 'mask_h5' : mask_h5, 'dtype' : dtype}
+        self.detectors = [self._getDetector(dict(defaults, **(d or {}))) for d in (detectors or [{}])]
+        self.tagDetectors = detectors is not None
+        self._selectDetector(0)
+        self.sparse = sparse
+        self.write_sparse = write_sparse
+        self.sparseThresholds = {}
         self.patch_q = patch_q
         self.write_q = write_q
         self.codecAD = CodecAD()
-        self.patch_list = []
-        self.patch_ori_list = []
+        self.placement = placement
+        self.profiler = WorkerProfiler(self.__class__.__name__)
         self.resetStats()
 
+    # frame parameters of a detector; dark frames and masks are loaded once
+    def _getDetector(self, params):
+        psz = params['psz']
+        routes = sorted(p for p in (params['psz_routes'] or []) if p <= psz)
+        return {
+            'psz' : psz,
+            'psz_routes' : routes if len(routes) > 1 else None,
+            'dark_fr' : self._getDarkFrame(params['dark_h5']),
+            'mask' : self._getMask(params['mask_h5']),
+            'dtype' : np.dtype(params['dtype']) if params['dtype'] else None
+        }
+
+    def _selectDetector(self, detector):
+        self.detector = detector
+        for key, value in self.detectors[detector].items():
+            setattr(self, key, value)
+
+    def _getMask(self, mask_h5):
+        if mask_h5 is None:
+            return None
+        key = ('mask', mask_h5)
+        if key not in self.FILE_CACHE:
+            with h5py.File(mask_h5, 'r') as fp:
+                self.FILE_CACHE[key] = fp['mask'][:] != 0
+        return self.FILE_CACHE[key]
+
     def _getDarkFrame(self, dark_h5):
         dark_fr = None
         if dark_h5 is not None:
-            with h5py.File(dark_h5, 'r') as fp:
-                dark_fr = fp['frames'][:]
-            dark_fr = dark_fr[:].mean(axis=0)
+            key = ('dark', dark_h5)
+            if key not in self.FILE_CACHE:
+                with h5py.File(dark_h5, 'r') as fp:
+                    self.FILE_CACHE[key] = fp['frames'][:].mean(axis=0)
+                self.logger.debug(f'Loaded dark frame from {dark_h5}')
+            dark_fr = self.FILE_CACHE[key]
         else:
             self.logger.debug('No dark h5 file supplied')
         return dark_fr
@@ -52,7 +111,9 @@ class BraggNNFrameProcessor(UserMpDataProcessor):
                 continue
             
             # ignore component that is bigger than patch size
-            if stats[comp, cv2.CC_STAT_WIDTH] > psz or stats[comp, cv2.CC_STAT_HEIGHT] > psz:
+            ch, cw = stats[comp, cv2.CC_STAT_HEIGHT], stats[comp, cv2.CC_STAT_WIDTH]
+            cpsz = int(self._routePatchSize(ch, cw, psz)) if self.psz_routes else (psz if ch <= psz and cw <= psz else 0)
+            if cpsz == 0:
                 big_peaks += 1
                 continue
         
@@ -73,12 +134,12 @@ class BraggNNFrameProcessor(UserMpDataProcessor):
             _mask  = cc_labels[row_s:row_e, col_s:col_e] == comp
             _patch = _patch * _mask
 
-            if _patch.size != psz * psz:
+            if _patch.size != cpsz * cpsz:
                 h, w = _patch.shape
-                _lp = (psz - w) // 2
-                _rp = (psz - w) - _lp
-                _tp = (psz - h) // 2
-                _bp = (psz - h) - _tp
+                _lp = (cpsz - w) // 2
+                _rp = (cpsz - w) - _lp
+                _tp = (cpsz - h) // 2
+                _bp = (cpsz - h) - _tp
                 _patch = np.pad(_patch, ((_tp, _bp), (_lp, _rp)), mode='constant', constant_values=0)
             else:
                 _tp, _lp = 0, 0
@@ -93,64 +154,232 @@ class BraggNNFrameProcessor(UserMpDataProcessor):
 
         return patches, peak_ori, big_peaks
 
+    # patch size for components of height h and width w (scalars or arrays):
+    # the smallest routed patch size that fits, psz without routing; 0 if none fits
+    def _routePatchSize(self, h, w, psz):
+        if not self.psz_routes:
+            return np.where((h <= psz) & (w <= psz), psz, 0)
+        routes = np.array(self.psz_routes)
+        k = np.searchsorted(routes, np.maximum(h, w))
+        return np.where(k < len(routes), routes[np.minimum(k, len(routes) - 1)], 0)
+
+
+    # dark + min_intensity per pixel, computed once per min_intensity; lowered
+    # slightly so that no pixel the dense path keeps is lost to rounding
+    def _getSparseThreshold(self, min_intensity):
+        key = (self.detector, min_intensity)
+        if key not in self.sparseThresholds:
+            if len(self.sparseThresholds) >= len(self.detectors):
+                self.sparseThresholds = {}
+            threshold = self.dark_fr.reshape(-1) + min_intensity
+            self.sparseThresholds[key] = threshold - 1e-6*(np.abs(threshold) + 1)
+        return self.sparseThresholds[key]
+
+    def _sparseBrightPixels(self, frame, min_intensity):
+        """
+        above-threshold pixels of a raw (not dark subtracted) frame, in one pass
+        with dark subtraction and offset recovery folded into the threshold;
+        masked pixels are left out.
+
+        Returns
+        -------
+            idx    : flat indices of the pixels, in raster order
+            values : pixel values after dark subtraction / offset recovery
+        """
+        idx, values = self._thresholdPixels(frame, min_intensity)
+        if self.mask is not None:
+            keep = ~self.mask.reshape(-1)[idx]
+            return idx[keep], values[keep]
+        return idx, values
+
+    def _thresholdPixels(self, frame, min_intensity):
+        flat = frame.reshape(-1)
+        if self.dark_fr is not None:
+            idx = np.flatnonzero(flat > self._getSparseThreshold(min_intensity))
+            values = flat[idx] - self.dark_fr.reshape(-1)[idx]
+            keep = values > min_intensity
+            return idx[keep], values[keep]
+        if self.offset_recover != 0 and min_intensity >= 0:
+            # offset is only added to positive pixels
+            idx = np.flatnonzero(flat > max(0, min_intensity - self.offset_recover))
+            values = flat[idx]
+            values += self.offset_recover
+            return idx, values
+        if self.offset_recover != 0:
+            flat = flat.copy()
+            flat[flat > 0] += self.offset_recover
+        idx = np.flatnonzero(flat > min_intensity)
+        return idx, flat[idx]
+
+    # component label of every pixel: the position (in idx) of the first
+    # pixel of its component in raster order
+    def _sparseLabels(self, idx, width):
+        n = len(idx)
+        cols = idx % width
+        src, dst = [], []
+        for dr, dc in self.SPARSE_NEIGHBOURS:
+            target = idx + dr*width + dc
+            pos = np.minimum(np.searchsorted(idx, target), n - 1)
+            found = (idx[pos] == target) & (cols + dc >= 0) & (cols + dc < width)
+            src.append(np.flatnonzero(found))
+            dst.append(pos[found])
+        src = np.concatenate(src)
+        dst = np.concatenate(dst)
+        labels = np.arange(n)
+        while len(src) > 0:
+            low = np.minimum(labels[src], labels[dst])
+            np.minimum.at(labels, src, low)
+            np.minimum.at(labels, dst, low)
+            labels = labels[labels]
+            if np.array_equal(labels[src], labels[dst]):
+                break
+        return labels
+
+    # same patches (and order) as _framePeakPatchesCv2 on the dark subtracted /
+    # offset recovered frame, but the work scales with the number of pixels
+    # above min_intensity instead of the frame size
+    def _framePeakPatchesSparse(self, frame, psz, angle, min_intensity=0, max_r=None, min_sz=1):
+        idx, values = self._sparseBrightPixels(frame, min_intensity)
+        return self._sparsePeakPatches(idx, values, frame.shape, psz, angle, max_r, min_sz)
+
+    def _sparsePeakPatches(self, idx, values, shape, psz, angle, max_r=None, min_sz=1):
+        fh, fw = shape
+        if len(idx) == 0:
+            return np.zeros((0, psz, psz), dtype=values.dtype), np.zeros((0, 3)), 0
+
+        roots, comp = np.unique(self._sparseLabels(idx, fw), return_inverse=True)
+        comp = comp.reshape(-1)
+        nComps = len(roots)
+        rows, cols = np.divmod(idx, fw)
+        area = np.bincount(comp, minlength=nComps)
+        row_s = np.full(nComps, fh)
+        col_s = np.full(nComps, fw)
+        row_e = np.zeros(nComps, dtype=rows.dtype)
+        col_e = np.zeros(nComps, dtype=cols.dtype)
+        np.minimum.at(row_s, comp, rows)
+        np.minimum.at(col_s, comp, cols)
+        np.maximum.at(row_e, comp, rows + 1)
+        np.maximum.at(col_e, comp, cols + 1)
+        h = row_e - row_s
+        w = col_e - col_s
+
+        small = (w < min_sz) | (h < min_sz)
+        cpsz = self._routePatchSize(h, w, psz)
+        big = ~small & (cpsz == 0)
+        keep = ~small & ~big
+        if max_r is not None:
+            c = np.bincount(comp, weights=cols, minlength=nComps)/area
+            r = np.bincount(comp, weights=rows, minlength=nComps)/area
+            keep &= ~(max_r**2 < ((c - fw/2)**2 + (r - fh/2)**2))
+
+        # patches that are not fully covered by the component have zeros
+        vmin = np.full(nComps, values.max(), dtype=values.dtype)
+        vmax = np.full(nComps, values.min(), dtype=values.dtype)
+        np.minimum.at(vmin, comp, values)
+        np.maximum.at(vmax, comp, values)
+        zero = np.zeros(1, dtype=values.dtype)[0]
+        partial = area < cpsz*cpsz
+        pmin = np.where(partial, np.minimum(vmin, zero), vmin)
+        pmax = np.where(partial, np.maximum(vmax, zero), vmax)
+        keep &= pmin != pmax
+
+        pr_o = row_s - (cpsz - h)//2
+        pc_o = col_s - (cpsz - w)//2
+        kept = np.flatnonzero(keep)
+        if not self.psz_routes:
+            patches = self._fillPatches(kept, psz, comp, rows, cols, values, pr_o, pc_o)
+        else:
+            # one block of patches per patch size, in increasing size
+            patches, blocks = [], []
+            for p in np.unique(cpsz[kept]):
+                block = kept[cpsz[kept] == p]
+                patches.extend(self._fillPatches(block, p, comp, rows, cols, values, pr_o, pc_o))
+                blocks.append(block)
+            kept = np.concatenate(blocks) if blocks else kept
+        peak_ori = np.stack([np.full(len(kept), angle), pr_o[kept], pc_o[kept]], axis=1)
+        return patches, peak_ori, int(big.sum())
+
+    def _fillPatches(self, kept, psz, comp, rows, cols, values, pr_o, pc_o):
+        patchId = np.full(len(pr_o), -1)
+        patchId[kept] = np.arange(len(kept))
+        sel = patchId[comp] >= 0
+        pc = comp[sel]
+        patches = np.zeros((len(kept), psz, psz), dtype=values.dtype)
+        patches[patchId[pc], rows[sel] - pr_o[pc], cols[sel] - pc_o[pc]] = values[sel]
+        return patches
+
+    # dark is not removed, thus remove here
+    # min_intensity will deal with negative pixels
+    def _correctFrame(self, frame):
+        if self.dark_fr is not None:
+            frame = frame - self.dark_fr
+
+        # dark was removed on EPICS server
+        elif self.offset_recover != 0:
+            frame[frame > 0] += self.offset_recover
 
-    def _processFrame(self, frm_id, data_codec, compressed, uncompressed, codec, rows, cols):
+        # masked pixels are zeroed
+        if self.mask is not None:
+            frame = np.where(self.mask, 0, frame)
+        return frame
+
+    def _processFrame(self, frm_id, data_codec, compressed, uncompressed, codec, rows, cols, detector=0, frameId=None):
         startTick = time.time()
         self.logger.debug(f'Processing frame {frm_id}, codec: {codec}')
+        if detector != self.detector:
+            self._selectDetector(detector)
+        # peak origins and frame backups carry the frame id, batches the sequence id
+        if frameId is None:
+            frameId = frm_id
         if not codec['name']:
             data = data_codec 
         else:
             self.codecAD.decompress(data_codec, codec, compressed, uncompressed)
             data = self.codecAD.getData()
-            decTime = startTick - time.time()
+            decTime = time.time() - startTick
             self.decodeTimeSum += decTime
             self.logger.debug(f'frame {frm_id} has been decoded in {1000*decTime:.3f} ms using {codec["name"]}, compress ratio is {self.codecAD.getCompressRatio():.1f}')
 
         frame = data.reshape((rows, cols))
+        if self.dtype is not None:
+            frame = frame.astype(self.dtype, copy=False)
 
-        # dark is not removed, thus remove here
-        # min_intensity will deal with negative pixels
-        if self.dark_fr is not None:
-            frame = frame - self.dark_fr
-
-        # dark was removed on EPICS server
-        elif self.offset_recover != 0:
-            frame[frame > 0] += self.offset_recover
-
-        tick = time.time()
-        patches, patch_ori, big_peaks = self._framePeakPatchesCv2(frame=frame, angle=frm_id, psz=self.psz, min_intensity=self.min_intensity, max_r=self.max_radius, min_sz=self.min_peak_sz)
+        if self.sparse:
+            # thresholding, dark subtraction and offset recovery in one pass
+            tick = time.time()
+            idx, values = self._sparseBrightPixels(frame, self.min_intensity)
+            patches, patch_ori, big_peaks = self._sparsePeakPatches(idx, values, frame.shape, psz=self.psz, angle=frameId, max_r=self.max_radius, min_sz=self.min_peak_sz)
+        else:
+            frame = self._correctFrame(frame)
+            tick = time.time()
+            patches, patch_ori, big_peaks = self._framePeakPatchesCv2(frame=frame, angle=frameId, psz=self.psz, min_intensity=self.min_intensity, max_r=self.max_radius, min_sz=self.min_peak_sz)
         self.nPatchesGenerated += len(patches)
                                                                
         mbsz = self.mbsz
-        # print("length of self.patchlist: " +str(len(self.patch_list)))
-        # patch_list = self.patch_list
-        # patch_ori_list = self.patch_ori_list
-        patch_list = []
-        patch_ori_list = []
-        patch_list.extend(self.patch_list)
-        patch_ori_list.extend(self.patch_ori_list)
+        psz = self.psz
         patch_q = self.patch_q
         write_q = self.write_q
 
-        patch_list.extend(patches)
-        patch_ori_list.extend(patch_ori)
-
-        self.logger.debug(f'Patch list size is {len(patch_list)}, mbsz is {mbsz}')
-        # while len(patch_list) >= mbsz:
-        batch_task = (
-                np.array(patches)[:,np.newaxis],
-                np.array(patch_ori[:mbsz]).astype(np.float32),
-                frm_id
-        )
-
-
-
-        patch_q.put(batch_task)
-        patch_list = patch_list[mbsz:]
-        patch_ori_list = patch_ori_list[mbsz:]
-
-        self.patch_list = patch_list
-        self.patch_ori_list = patch_ori_list
+        # patches of a frame go out in batches of at most mbsz patches of one
+        # size, the last one is flagged; a frame without patches still sends
+        # an (empty) last batch
+        segments = [(psz, 0, len(patches))]
+        if self.psz_routes and len(patches) > 0:
+            order = sorted(range(len(patches)), key=lambda k: patches[k].shape[-1])
+            patches = [patches[k] for k in order]
+            patch_ori = [patch_ori[k] for k in order]
+            sizes = [patch.shape[-1] for patch in patches]
+            segments = [(size, sizes.index(size), len(sizes) - sizes[::-1].index(size)) for size in sorted(set(sizes))]
+        batches = [(size, b, min(b + mbsz, stop)) for size, start, stop in segments for b in range(start, stop, mbsz)] or [(psz, 0, 0)]
+        self.logger.debug(f'{len(patches)} patches in {len(batches)} batches, mbsz is {mbsz}')
+        for i, (size, b0, b1) in enumerate(batches):
+            batch_task = (
+                    np.array(patches[b0:b1]).reshape((-1, 1, size, size)),
+                    np.array(patch_ori[b0:b1], dtype=np.float32).reshape((-1, 3)),
+                    frm_id,
+                    i == len(batches)-1
+            )
+            patch_q.put(batch_task)
 
         peakTime = time.time() - tick
         self.peakTimeSum += peakTime
@@ -158,14 +387,51 @@ class BraggNNFrameProcessor(UserMpDataProcessor):
 
         # back-up raw frames when required
         if write_q is not None:
-            write_q.put({'angle':np.array([frm_id])[None], 'frame':frame[None]})
+            if self.write_sparse:
+                if not self.sparse:
+                    idx = np.flatnonzero(frame.reshape(-1) > self.min_intensity)
+                    values = frame.reshape(-1)[idx]
+                write_q.put({'frame_id':np.array([frameId]), 'shape':(rows, cols), 'indices':idx, 'values':values})
+            else:
+                if self.sparse:
+                    frame = self._correctFrame(frame)
+                wdict = {'angle':np.array([frameId])[None], 'frame':frame[None]}
+                if self.tagDetectors:
+                    wdict['detector'] = np.array([detector], dtype=np.int16)
+                write_q.put(wdict)
         processTime = time.time() - startTick
         self.processTimeSum += processTime
         self.nFramesProcessed += 1
 
+    @classmethod
+    def parseConfigValue(cls, key, value):
+        if key == 'max_radius':
+            if value is None or str(value).lower() in ('', 'none', 'null'):
+                return None
+            return float(value)
+        if key == 'min_intensity':
+            return float(value)
+        if key == 'sparse':
+            return str(value).lower() in ('1', 'true', 'yes', 'on')
+        return int(value)
+
+    def configure(self, configDict):
+        self.profiler.configure(configDict)
+        for key in self.CONFIG_KEYS:
+            if key in configDict:
+                value = self.parseConfigValue(key, configDict[key])
+                self.logger.debug(f'Updating {key}: {getattr(self, key)} => {value}')
+                setattr(self, key, value)
+
     def process(self, mpqObject):
-        frm_id, data_codec, compressed, uncompressed, codec, rows, cols = mpqObject
-        self._processFrame(frm_id, data_codec, compressed, uncompressed, codec, rows, cols)
+        if self.placement:
+            self.placement.apply()
+        self.profiler.onProcess()
+        # frames of several detectors carry the detector index
+        self._processFrame(*mpqObject)
+
+    def stop(self):
+        self.profiler.stop()
 
     def getStats(self):
         processTime = 0.0
@@ -182,6 +448,7 @@ class BraggNNFrameProcessor(UserMpDataProcessor):
             'decodeTime' : decodeTime,  
             'peakTime' : peakTime
         }
+        statsDict.update(process_memory())
         return statsDict
 
     def resetStats(self):
@@ -1,28 +1,53 @@
-import time
+import os, time
 import numpy as np
 import h5py
 from pvapy.hpc.userMpDataProcessor import UserMpDataProcessor
+from memoryAccounting import process_memory
+from workerProfiler import WorkerProfiler
+
+# file of one consumer with sharded output (output.shard), e.g. peaks.h5 =>
+# peaks.shard3.h5; stitchShards.py presents the shards as one file
+def shard_file_name(fileName, shardId):
+    root, ext = os.path.splitext(fileName)
+    return f'{root}.shard{shardId}{ext}'
 
 class BraggNNHdfWriter(UserMpDataProcessor):
 
-    def __init__(self, writerId, fileName, compression):
+    # fileMode 'a' appends to datasets already in the file
+    def __init__(self, writerId, fileName, compression, fileMode='w', placement=None):
         UserMpDataProcessor.__init__(self)
         self.writerId = writerId
         self.fileName = fileName
         self.compression = compression
+        self.fileMode = fileMode
+        self.placement = placement
         self.logger.debug(f'Using file {fileName} for writer {writerId}, compression is {compression}')
         self.h5fd = None
+        self.profiler = WorkerProfiler(self.__class__.__name__)
 
         self.resetStats()
 
+    def configure(self, configDict):
+        self.profiler.configure(configDict)
+
+    def stop(self):
+        self.profiler.stop()
+        if self.h5fd is not None:
+            self.h5fd.close()
+            self.h5fd = None
+
     def process(self, mpqObject):
+        if self.placement:
+            self.placement.apply()
+        self.profiler.onProcess()
         t0 = time.time()
         ddict = mpqObject
         if self.h5fd is None:
-            self.h5fd = h5py.File(self.fileName, 'w')
-            for key, data in ddict.items():
-                if type(data) != np.ndarray:
-                    continue
+            self.h5fd = h5py.File(self.fileName, self.fileMode)
+        for key, data in ddict.items():
+            if type(data) != np.ndarray:
+                continue
+            if key not in self.h5fd:
                 dshape = list(data.shape)
                 dshape[0] = None
                 if self.compression:
@@ -30,10 +55,7 @@ class BraggNNHdfWriter(UserMpDataProcessor):
                 else:
                     self.h5fd.create_dataset(key, data=data, chunks=True, maxshape=dshape)
                 self.logger.debug(f'Created dataset {key} with {data.shape} samples')
-        else:
-            for key, data in ddict.items():
-                if type(data) != np.ndarray:
-                    continue
+            else:
                 self.h5fd[key].resize((self.h5fd[key].shape[0] + data.shape[0]), axis=0)
                 self.h5fd[key][-data.shape[0]:] = data
                 self.logger.debug(f'Added {data.shape} samples to key {key}')
@@ -51,9 +73,72 @@ class BraggNNHdfWriter(UserMpDataProcessor):
             'nObjectsWritten' : self.nWritten,
             'writeTime' : writeTime
         }
+        statsDict.update(process_memory())
         return statsDict
 
     def resetStats(self):
         self.nWritten = 0
         self.writeTimeSum = 0.0
 
+class BraggNNSparseHdfWriter(BraggNNHdfWriter):
+    '''
+    Archives frames as their above-threshold pixels, CSR style: frame i has
+    flat pixel indices indices[indptr[i]:indptr[i+1]] and the corresponding
+    values, frame_ids[i] is its uniqueId; the frame shape is stored as a file
+    attribute. Expects {'frame_id', 'shape', 'indices', 'values'} objects, as
+    BraggNNFrameProcessor sends them with write_sparse. Read the archive back
+    with frameSource.SparseH5FrameSource.
+    '''
+
+    INDEX_DTYPE = np.uint32
+
+    def _createDataset(self, key, dtype):
+        kwargs = {'compression' : 'gzip'} if self.compression else {}
+        self.h5fd.create_dataset(key, shape=(0,), dtype=dtype, chunks=True, maxshape=(None,), **kwargs)
+
+    def _append(self, key, data):
+        dset = self.h5fd[key]
+        n = dset.shape[0]
+        dset.resize((n + data.shape[0],))
+        dset[n:] = data
+
+    def _openFile(self, ddict):
+        self.h5fd = h5py.File(self.fileName, self.fileMode)
+        if 'indptr' not in self.h5fd:
+            self.h5fd.attrs['format'] = 'csr'
+            self.h5fd.attrs['shape'] = ddict['shape']
+            self._createDataset('frame_ids', np.int64)
+            self._createDataset('indptr', np.int64)
+            self._createDataset('indices', self.INDEX_DTYPE)
+            self._createDataset('values', ddict['values'].dtype)
+            self._append('indptr', np.zeros(1, dtype=np.int64))
+        self.nnz = int(self.h5fd['indptr'][-1])
+
+    def process(self, mpqObject):
+        if self.placement:
+            self.placement.apply()
+        self.profiler.onProcess()
+        t0 = time.time()
+        ddict = mpqObject
+        if self.h5fd is None:
+            self._openFile(ddict)
+        self.nnz += len(ddict['indices'])
+        self._append('frame_ids', np.asarray(ddict['frame_id'], dtype=np.int64).reshape(-1))
+        self._append('indptr', np.array([self.nnz], dtype=np.int64))
+        self._append('indices', np.asarray(ddict['indices'], dtype=self.INDEX_DTYPE))
+        self._append('values', np.asarray(ddict['values']))
+        self.h5fd.flush()
+        writeTime = time.time() - t0
+        self.writeTimeSum += writeTime
+        self.nPixelsWritten += len(ddict['indices'])
+        self.logger.debug(f'{len(ddict["indices"])} pixels of frame {ddict["frame_id"]} written to {self.fileName} in {writeTime:.4f} seconds')
+        self.nWritten += 1
+
+    def getStats(self):
+        statsDict = BraggNNHdfWriter.getStats(self)
+        statsDict['nPixelsWritten'] = self.nPixelsWritten
+        return statsDict
+
+    def resetStats(self):
+        BraggNNHdfWriter.resetStats(self)
+        self.nPixelsWritten = 0
@@ -0,0 +1,117 @@
+'''
+Creates the inference engine selected in the yaml config. Engines share the
+interface of BraggNNTorchInfer: process(in_mb) takes a (N, 1, psz, psz) batch
+and returns (N, 2) peak locations relative to the patch size, stop() releases it.
+
+infer:
+  engine: torch | tensorrt | centroid | gaussian | pvoigt | emulated | none  # defaults to tensorrt/torch following 'tensorrt'
+  fit_iterations: 10  # Levenberg-Marquardt iterations of the gaussian/pvoigt engines
+  threads: null       # torch intra-op threads (see autotune.py); torch default if null
+  warmup: True        # localize a zero batch once engines are created, so that the first frame does not pay for lazy initialization
+
+centroid, gaussian and pvoigt are the classical (non-NN) localizers of
+BraggNNClassicInfer; they need neither a GPU nor a model file.
+
+emulated (BraggNNEmulatedInfer) stands in for an accelerator, for load tests
+of the pipeline on machines without one; it takes the configured time per
+batch and returns patch centroids:
+
+infer:
+  engine: emulated
+  emulated:
+    batch_latency: 0.002  # seconds per batch
+    patch_latency: 2e-5   # seconds per patch
+    jitter: 0.0002        # standard deviation of the latency, seconds
+    concurrency: 1        # batches in flight at once per process
+    fixed_batch: False    # partial batches take as long as full ones (TensorRT)
+    seed: 0
+
+Models for several patch sizes can be loaded at once; the frame processor then
+crops each peak at the smallest patch size that fits it, and each batch is
+localized by the engine of its patch size:
+
+model:
+  psz: 15                              # largest patch size
+  model_fname: "models/feb402psz15.pth"
+  routes:
+    - {psz: 11, model_fname: "models/feb402psz11.pth"}
+    - {psz: 13, model_fname: "models/feb402psz13.pth"}
+'''
+
+import numpy as np
+
+# patch size => model file, sorted by patch size
+def get_model_routes(params):
+    routes = {params['model']['psz'] : params['model']['model_fname']}
+    for route in params['model'].get('routes') or []:
+        routes[route['psz']] = route['model_fname']
+    return dict(sorted(routes.items()))
+
+def get_engine_name(params):
+    engine = params['infer'].get('engine')
+    if engine is None:
+        engine = 'tensorrt' if params['infer'].get('tensorrt') else 'torch'
+    return engine
+
+def create_infer_engine(params, mbsz=None, psz=None, model_fname=None):
+    mbsz = mbsz or params['infer']['mbsz']
+    psz = psz or params['model']['psz']
+    model_fname = model_fname or params['model']['model_fname']
+    engine = get_engine_name(params)
+    if engine == 'tensorrt':
+        from trtUtil import scriptpth2onnx
+        from braggNNTrtInfer import BraggNNTrtInfer
+        onnx_mdl = scriptpth2onnx(pth=model_fname, mbsz=mbsz, psz=psz)
+        return BraggNNTrtInfer(onnx_mdl)
+    elif engine == 'torch':
+        from braggNNTorchInfer import BraggNNTorchInfer
+        if params['infer'].get('threads'):
+            import torch
+            torch.set_num_threads(params['infer']['threads'])
+        return BraggNNTorchInfer(script_pth=model_fname)
+    elif engine in ('centroid', 'gaussian', 'pvoigt'):
+        from braggNNClassicInfer import BraggNNClassicInfer
+        return BraggNNClassicInfer(method=engine, nIter=params['infer'].get('fit_iterations', 10))
+    elif engine == 'emulated':
+        from braggNNEmulatedInfer import BraggNNEmulatedInfer
+        emulated = params['infer'].get('emulated') or {}
+        return BraggNNEmulatedInfer(batchLatency=float(emulated.get('batch_latency', 0.001)),
+                                    patchLatency=float(emulated.get('patch_latency', 0.0)),
+                                    jitter=float(emulated.get('jitter', 0.0)),
+                                    concurrency=emulated.get('concurrency', 1),
+                                    mbsz=mbsz,
+                                    fixedBatch=emulated.get('fixed_batch', False),
+                                    seed=emulated.get('seed', 0))
+    elif engine == 'none':
+        return None
+    raise Exception(f'Unknown inference engine: {engine}')
+
+# one engine per routed patch size (None values with engine 'none')
+def create_infer_engines(params):
+    engines = {psz : create_infer_engine(params, psz=psz, model_fname=model_fname) for psz, model_fname in get_model_routes(params).items()}
+    if params['infer'].get('warmup', True):
+        for psz, engine in engines.items():
+            if engine is not None:
+                engine.process(np.zeros((params['infer']['mbsz'], 1, psz, psz), dtype=np.float32))
+    return engines
+
+# localizes a batch with the engine of its patch size (see peak_batch)
+def localize_batch(engines, in_mb, ori_mb, outPsz):
+    engine = engines.get(in_mb.shape[-1])
+    pred = engine.process(in_mb) if engine is not None else None
+    return peak_batch(in_mb, ori_mb, pred, outPsz)
+
+# peak output ddict of a batch with predicted locations pred (None if not
+# localized); patches smaller than outPsz are zero padded at the bottom/right
+# (so that their origins stay valid), so that batches of all patch sizes can
+# go to the same outputs, and the patch size of every peak is recorded
+def peak_batch(in_mb, ori_mb, pred, outPsz):
+    psz = in_mb.shape[-1]
+    ddict = {}
+    if pred is not None:
+        ddict['ploc'] = np.concatenate([ori_mb, pred*psz], axis=1)
+    if psz < outPsz:
+        in_mb = np.pad(in_mb, ((0, 0), (0, 0), (0, outPsz - psz), (0, outPsz - psz)))
+    ddict['patches'] = in_mb
+    ddict['psz'] = np.full(in_mb.shape[0], psz, dtype=np.int16)
+    return ddict
@@ -1,131 +1,472 @@
 import os
 import numpy as np
-import multiprocessing as mp
 import threading
 import queue
 import time
 import yaml
+import zmq
 import pvapy as pva
 from pvapy.hpc.adImageProcessor import AdImageProcessor
-from pvapy.hpc.userMpWorkerController import UserMpWorkerController 
 from braggNNFrameProcessor import BraggNNFrameProcessor
-from braggNNHdfWriter import BraggNNHdfWriter
+from codecAD import CodecAD
+from braggNNHdfWriter import BraggNNHdfWriter, BraggNNSparseHdfWriter, shard_file_name
+from braggNNInferEngine import create_infer_engines, get_model_routes, localize_batch, peak_batch
+from braggNNPeakGrouper import BraggNNPeakGrouper
+from braggNNReorderBuffer import BraggNNReorderBuffer, SequenceIds
+from braggNNSummary import BraggNNSummaryAggregator
 from braggNNZmqWriter import BraggNNZmqWriter
+from memoryAccounting import TrackedQueue, QUEUE_STATS_FIELDS, physical_memory, process_memory
+from remoteInfer import RemoteInferClient
+from streamRecorder import StreamRecorder
+from workerController import WorkerController
+from workerPlacement import PlacementPolicy
+from workerProfiler import WorkerProfiler
 
 class BraggNNInferImageProcessor(AdImageProcessor):
 
     Q_WAIT_TIME = 1
+    REMOTE_POLL_TIME = 0.01
+    LIVE_POLL_TIME = 0.005
+
+    LIVE_LANE = 'live'
+    BACKLOG_LANE = 'backlog'
+    OUTPUTS = ('hdf', 'zmq', 'pva')
+
+    SUMMARY_PVA_TYPE = {
+        'summaryId' : pva.UINT,
+        'windowStart' : pva.DOUBLE,
+        'windowEnd' : pva.DOUBLE,
+        'nFrames' : pva.UINT,
+        'nPeaks' : pva.UINT,
+        'frameIds' : [pva.LONG],
+        'frameCounts' : [pva.UINT],
+        'histogramEdges' : [pva.FLOAT],
+        'histogram' : [pva.UINT],
+        'densityRows' : pva.UINT,
+        'densityCols' : pva.UINT,
+        'density' : [pva.UINT],
+        'topPeaks' : [pva.FLOAT]
+    }
+    REORDER_WAIT_TIME = 0.05
+    ENGINES_READY_POLL_TIME = 1.0
 
     FRAME_PROCESSOR_WORKER_ID = 'frameProcessor'
+    LIVE_FRAME_PROCESSOR_WORKER_ID = 'liveFrameProcessor'
     FRAME_HDF_WRITER_WORKER_ID = 'frameHdfWriter'
     PEAK_HDF_WRITER_WORKER_ID = 'peakHdfWriter'
     PEAK_ZMQ_WRITER_WORKER_ID = 'peakZmqWriter'
+    INFER_WORKER_ID = 'infer'
 
     def __init__(self, configDict={}):
         AdImageProcessor.__init__(self, configDict)
+        # Startup metrics are measured from process launch
+        self.launchTime = self._getLaunchTime()
+        self.enginesReadyTime = None
+        self.enginesReady = threading.Event()
+        self.firstFrameTime = None
+        self.firstPeakTime = None
         self.configFile = configDict.get('configFile')
         if not self.configFile:
             raise Exception('No configuration file provided')
         self.params = yaml.load(open(self.configFile, 'r'), Loader=yaml.CLoader)
 
-        self.frame_proc_q = mp.Queue(maxsize=-1)
+        # Optional two-lane scheduling: a live lane always processes the newest
+        # frame, for visualization and steering, while the backlog lane drains
+        # all frames in order, for archiving; the backlog may be limited
+        self.laneParams = self.params.get('lanes') or {}
+        liveParams = self.laneParams.get('live') or {}
+        backlogParams = self.laneParams.get('backlog') or {}
+
+        # Queues count the items and bytes they hold (memoryAccounting.py)
+        self.frame_proc_q = TrackedQueue(maxsize=backlogParams.get('max_frames') or -1, name='frameQueue')
         self.frame_hdf_q = None
-        self.patch_q = mp.Queue(maxsize=-1)
+        self.patch_q = TrackedQueue(maxsize=-1, name='patchQueue')
         self.peak_hdf_q = None
         self.peak_zmq_q = None
         self.peak_pva_q = None
 
         params = self.params
+        # Memory warning thresholds; warn_rss <= 1 is a fraction of physical memory
+        memoryParams = params.get('memory') or {}
+        self.warnRss = memoryParams.get('warn_rss')
+        if self.warnRss is not None and self.warnRss <= 1:
+            self.warnRss *= physical_memory()
+        self.warnQueueBytes = memoryParams.get('warn_queue_bytes')
+        self.memoryWarnings = set()
+
+        # Batch size and inference threads tuned for this host and model
+        if params['infer'].get('autotune'):
+            from autotune import apply_tuning
+            tuning = apply_tuning(params)
+            self.logger.debug(f"Using tuned mbsz={tuning['mbsz']}, threads={tuning['threads']}")
+        # Cpu placement and thread caps per worker role
+        self.placementPolicy = PlacementPolicy(params.get('placement'))
         self.nFrameProcessors = params['frame']['nproc']
+        self.minFrameProcessors = params['frame'].get('nproc_min', self.nFrameProcessors)
+        self.maxFrameProcessors = max(params['frame'].get('nproc_max', self.nFrameProcessors), self.nFrameProcessors)
+        # Stats are declared per processor slot, so the pool can never grow beyond this
+        self.nFrameProcessorSlots = self.maxFrameProcessors
+        self.autoscaleParams = params['frame'].get('autoscale') or {}
         self.nGpu = params['infer'].get('n_gpu', 2)
         self.logger.debug(f'Number of available GPUs: {self.nGpu}')
+        # Optional remote inference; patch batches are shipped to a RemoteInferServer
+        self.remoteInferParams = params['infer'].get('remote') or {}
+        self.remoteInferClient = None
+
+        # Optional recording of the incoming stream, as received (see streamReplayer.py)
+        self.streamRecorder = None
+        if params['frame'].get('record'):
+            self.streamRecorder = StreamRecorder(params['frame']['record'], maxQueued=params['frame'].get('record_queue', 1000))
 
         #if n_set_frames reached (and isn't 0), publish zeroed out patch!
-        self.n_set_frames = params['frame']['frames_per_dataset']
+        self.n_set_frames = params['frame'].get('frames_per_dataset', 0)
         self.frame_counter = 0
         self.first_dataset = True
 
+        # With several consumers, each one can write its own shard of the
+        # output files (output.shard), named by processor id
+        self.frameFileName = params['output']['frame2file']
+        self.peakFileName = params['output']['peaks2file']
+        if params['output'].get('shard', False):
+            shardId = configDict.get('processorId', 1)
+            self.frameFileName = self.frameFileName and shard_file_name(self.frameFileName, shardId)
+            self.peakFileName = self.peakFileName and shard_file_name(self.peakFileName, shardId)
+
         # Create frame writer; receives data from frame processor
+        # (frame2file_format 'sparse' archives only the pixels above min_intensity)
         self.frameHdfController = None
-        if params['output']['frame2file']:
-            self.frame_hdf_q = mp.Queue(maxsize=-1)
-            self.frameHdfWriter = BraggNNHdfWriter('frame', fileName=params['output']['frame2file'], compression=True)
-            self.frameHdfController = UserMpWorkerController(self.FRAME_HDF_WRITER_WORKER_ID, self.frameHdfWriter, self.frame_hdf_q)
+        self.writeSparseFrames = params['output'].get('frame2file_format', 'dense') == 'sparse'
+        if self.frameFileName:
+            self.frame_hdf_q = TrackedQueue(maxsize=-1, name='frameHdfQueue')
+            if self.writeSparseFrames:
+                self.frameHdfWriter = BraggNNSparseHdfWriter('frame', fileName=self.frameFileName, compression=True, \
+                                                             placement=self.placementPolicy.getPlacement('writer', 0))
+            else:
+                self.frameHdfWriter = BraggNNHdfWriter('frame', fileName=self.frameFileName, compression=True, \
+                                                       placement=self.placementPolicy.getPlacement('writer', 0))
+            self.frameHdfController = WorkerController(self.FRAME_HDF_WRITER_WORKER_ID, self.frameHdfWriter, self.frame_hdf_q)
+
+        # Frame processors are created here, with dark frames and masks loaded
+        # once (BraggNNFrameProcessor.FILE_CACHE) and codec libraries preloaded;
+        # start() forks the worker processes once the inference engines are
+        # loaded, so that they begin warm
+        self.logger.debug(f'Preloaded codec libraries: {CodecAD().preload()}')
 
         # Create frame processors; they send data to frame writer 
+        # Arguments that can be updated at runtime are kept in frameProcessorArgs,
+        # so that processors added later use the current values
+        # With models for several patch sizes, peaks are cropped at the smallest
+        # patch size that fits them and localized by the model of that size
+        self.modelRoutes = get_model_routes(params)
+        self.outputPsz = max(self.modelRoutes)
+        self.frameProcessorArgs = {
+            'psz' : self.outputPsz,
+            'psz_routes' : list(self.modelRoutes) if len(self.modelRoutes) > 1 else None,
+            'mbsz' : params['infer']['mbsz'],
+            'offset_recover' : params['frame']['offset_recover'],
+            'min_intensity' : params['frame']['min_intensity'],
+            'max_radius' : params['frame']['max_radius'],
+            'min_peak_sz' : params['frame']['min_peak_sz'],
+            'dark_h5' : params['frame']['dark_h5'],
+            'sparse' : params['frame'].get('sparse', False),
+            'write_sparse' : self.writeSparseFrames,
+            'mask_h5' : params['frame'].get('mask_h5'),
+            'dtype' : params['frame'].get('dtype')
+        }
+        # Optional multi-detector ingestion: several detectors (or panels) share
+        # the frame processors, batches and inference engines, with their own
+        # input channel and frame parameters. Frames travel as sequence ids
+        # (SequenceIds), frame index*nDetectors + detector, so that the frame ids
+        # of different detectors do not collide; peaks are tagged with their detector.
+        # Each detector counts its frames from its own first_id (reorder.first_id
+        # unless the detector sets one)
+        self.detectors = [dict(dp, name=dp.get('name', f'detector{i+1}')) for i, dp in enumerate(params.get('detectors') or [])]
+        self.nDetectors = max(len(self.detectors), 1)
+        reorderParams = params['output'].get('reorder') or {}
+        firstIds = [dp.get('first_id', reorderParams.get('first_id')) for dp in self.detectors] or [reorderParams.get('first_id')]
+        self.sequenceIds = SequenceIds(self.nDetectors, idStep=reorderParams.get('id_step', 1), firstId=firstIds)
+        self.detectorChannels = []
+        self.nDetectorFrames = [0]*self.nDetectors
+        inputDetectors = [i for i, dp in enumerate(self.detectors) if not dp.get('channel')]
+        if len(inputDetectors) > 1:
+            raise Exception(f'Only one detector can use the input channel, detectors {[self.detectors[i]["name"] for i in inputDetectors]} have no channel')
+        # frames on the input channel are ignored if every detector has its own channel
+        self.inputDetector = inputDetectors[0] if inputDetectors else (None if self.detectors else 0)
+        for dp in self.detectors:
+            if dp.get('psz', self.outputPsz) not in self.modelRoutes:
+                raise Exception(f'Detector {dp["name"]} patch size {dp["psz"]} has no model, patch sizes are {list(self.modelRoutes)}')
+        if self.nDetectors > 1 and self.frameFileName and self.writeSparseFrames:
+            raise Exception('Sparse frame archives hold frames of one detector, use frame2file_format dense with several detectors')
+        if self.detectors:
+            self.frameProcessorArgs['detectors'] = [{key : dp[key] for key in BraggNNFrameProcessor.DETECTOR_KEYS if key in dp} for dp in self.detectors]
+            self.logger.debug(f'Detectors: {[dp["name"] for dp in self.detectors]}')
+        # The live lane has its own frame processor, queues and batch size; when
+        # the live processor falls behind, the oldest waiting frames are skipped
+        self.live_frame_q = None
+        self.live_patch_q = None
+        self.liveFrameProcController = None
+        self.backlogOutputs = set(self.OUTPUTS)
+        self.frameArrivalTimes = {}
+        self.laneLock = threading.Lock()
+        if self.laneParams:
+            if self.remoteInferParams:
+                raise Exception('Live and backlog lanes require local inference, infer.remote cannot be used with lanes')
+            self.liveOutputs = set(liveParams.get('outputs', ['zmq', 'pva']))
+            self.backlogOutputs = set(backlogParams.get('outputs', ['hdf']))
+            self.live_frame_q = TrackedQueue(maxsize=liveParams.get('max_frames', 1), name='liveFrameQueue')
+            self.live_patch_q = TrackedQueue(maxsize=liveParams.get('max_batches') or -1, name='livePatchQueue')
+            liveArgs = dict(self.frameProcessorArgs)
+            liveArgs['mbsz'] = min(liveParams.get('mbsz', liveArgs['mbsz']), liveArgs['mbsz'])
+            liveArgs['write_sparse'] = False
+            liveFrameProcessor = BraggNNFrameProcessor(patch_q=self.live_patch_q, write_q=None, \
+                                                       placement=self.placementPolicy.getPlacement('frame_processor', self.maxFrameProcessors), **liveArgs)
+            self.liveFrameProcController = WorkerController(self.LIVE_FRAME_PROCESSOR_WORKER_ID, liveFrameProcessor, self.live_frame_q)
+            self.logger.debug(f"Live lane batch size {liveArgs['mbsz']}, outputs {sorted(self.liveOutputs)}; backlog outputs {sorted(self.backlogOutputs)}")
+
+        self.controllerLock = threading.RLock()
         self.frameProcControllerMap = {}
         for i in range(0,self.nFrameProcessors):
-            workerId = f'{self.FRAME_PROCESSOR_WORKER_ID}.{i+1}'
-            frameProcessor = BraggNNFrameProcessor(
-                psz=params['model']['psz'],
-                mbsz=params['infer']['mbsz'], 
-                offset_recover=params['frame']['offset_recover'], 
-                min_intensity=params['frame']['min_intensity'],
-                max_radius=params['frame']['max_radius'],
-                min_peak_sz=params['frame']['min_peak_sz'], 
-                dark_h5=params['frame']['dark_h5'], 
-                patch_q=self.patch_q, write_q=self.frame_hdf_q)
-            self.frameProcControllerMap[i] = UserMpWorkerController(workerId, frameProcessor, self.frame_proc_q)
+            self.frameProcControllerMap[i] = self._createFrameProcessorController(i)
+        self.retiredFrameProcStats = {'nFramesProcessed' : 0, 'nPatchesGenerated' : 0, 'processTimeSum' : 0.0}
+        self.frameProcUtilization = 0.0
+        self.scalingThread = None
 
         # Create peak hdf writer; receives data from this processor
         self.peakHdfController = None
-        if params['output']['peaks2file']:
-            self.peak_hdf_q = mp.Queue(maxsize=-1)
-            self.peakHdfWriter = BraggNNHdfWriter('peak', fileName=params['output']['peaks2file'], compression=False)
-            self.peakHdfController = UserMpWorkerController(self.PEAK_HDF_WRITER_WORKER_ID, self.peakHdfWriter, self.peak_hdf_q)
+        if self.peakFileName:
+            self.peak_hdf_q = TrackedQueue(maxsize=-1, name='peakHdfQueue')
+            self.peakHdfWriter = BraggNNHdfWriter('peak', fileName=self.peakFileName, compression=False, \
+                                                  placement=self.placementPolicy.getPlacement('writer', 1))
+            self.peakHdfController = WorkerController(self.PEAK_HDF_WRITER_WORKER_ID, self.peakHdfWriter, self.peak_hdf_q)
 
         # Create peak zmq writer; receives data from this processor
         self.peakZmqController = None
         if params['output']['port4zmq']:
-            self.peak_zmq_q = mp.Queue(maxsize=-1)
-            self.peakZmqWriter = BraggNNZmqWriter(port=params['output']['port4zmq'])
-            self.peakZmqController = UserMpWorkerController(self.PEAK_ZMQ_WRITER_WORKER_ID, self.peakZmqWriter, self.peak_zmq_q)
+            self.peak_zmq_q = TrackedQueue(maxsize=-1, name='peakZmqQueue')
+            self.peakZmqWriter = BraggNNZmqWriter(port=params['output']['port4zmq'], placement=self.placementPolicy.getPlacement('writer', 2))
+            self.peakZmqController = WorkerController(self.PEAK_ZMQ_WRITER_WORKER_ID, self.peakZmqWriter, self.peak_zmq_q)
+
+        # Optional reorder stage; peak batches are released to the outputs in uniqueId order
+        # (peak grouping needs it, and enables it with default settings)
+        self.reorderBuffer = None
+        self.reorderThread = None
+        groupParams = params['output'].get('group') or {}
+        if reorderParams or groupParams:
+            if self.detectors:
+                # sequence ids have no gaps; they start at 0 when every first_id is known
+                self.reorderBuffer = BraggNNReorderBuffer(
+                    maxHoldTime=reorderParams.get('max_hold_time', 1.0),
+                    idStep=1,
+                    firstId=0 if None not in firstIds else None,
+                    idKey='sequenceId')
+            else:
+                self.reorderBuffer = BraggNNReorderBuffer(
+                    maxHoldTime=reorderParams.get('max_hold_time', 1.0),
+                    idStep=reorderParams.get('id_step', 1),
+                    firstId=reorderParams.get('first_id'))
+
+        # Optional grouping of peaks in consecutive frames into 3D peaks; closed
+        # groups are sent to the outputs as {'groups' : array of GROUP_FIELDS rows}.
+        # Peaks are grouped per detector, and groups get a detector column
+        self.peakGroupers = []
+        self.groupPatches = True
+        self.groupChannel = None
+        self.groupFields = BraggNNPeakGrouper.GROUP_FIELDS + (('detector',) if self.detectors else ())
+        if groupParams:
+            self.peakGroupers = [BraggNNPeakGrouper(
+                maxDistance=groupParams.get('max_distance', 2.0),
+                maxGap=groupParams.get('max_gap', 0),
+                idStep=reorderParams.get('id_step', 1)) for i in range(self.nDetectors)]
+            self.groupPatches = groupParams.get('patches', True)
+            self.groupChannel = groupParams.get('channel')
+
+        # Optional summary stream for visualization clients: fixed size summaries
+        # of the peaks of each time window, on their own zmq port and pva channel;
+        # with lanes, summaries follow the live lane
+        self.summaryAggregator = None
+        self.summaryThread = None
+        self.summaryParams = params['output'].get('summary') or {}
+        self.summaryChannel = self.summaryParams.get('channel')
+        if self.summaryParams:
+            self.summaryAggregator = BraggNNSummaryAggregator(
+                maxFrames=self.summaryParams.get('max_frames', 256),
+                nBins=self.summaryParams.get('histogram_bins', 32),
+                maxIntensity=float(self.summaryParams.get('max_intensity', 1e6)),
+                densityShape=self.summaryParams.get('density_shape', (64, 64)),
+                topK=self.summaryParams.get('top_k', 16),
+                detectorShape=self.summaryParams.get('detector_shape'))
 
         # Stats
+        self._resetLaneStats()
+        self.nSummariesPublished = 0
+        self.summaryPublishTimeSum = 0
         self.nPatchBatchesProcessed = 0
+        self.nPatchesInferred = 0
         self.nPatchesPublished = 0
         self.inferTimeSum = 0
         self.publishTimeSum = 0
+        self.nGroupsPublished = 0
+
+        # Profiler for the inference thread; workers have their own. Commands
+        # received before the thread starts are applied once it runs
+        self.inferProfiler = WorkerProfiler(self.INFER_WORKER_ID)
+        self.inferThread = None
+        self.pendingInferProfilerConfig = None
+
+        if self.placementPolicy.params:
+            nWriters = len([c for c in (self.frameHdfController, self.peakHdfController, self.peakZmqController) if c])
+            placement = self.placementPolicy.describe({'frame_processor' : self.maxFrameProcessors, 'writer' : nWriters})
+            self.logger.info(f'Worker placement: {placement}')
+            for role, rd in placement.items():
+                if rd.get('threadsPerCpu', 0) > 1:
+                    self.logger.warning(f'{role} placement is oversubscribed: {rd["threadsPerCpu"]:.1f} threads per cpu')
 
         self.isDone = False
 
+    def _createFrameProcessorController(self, i):
+        workerId = f'{self.FRAME_PROCESSOR_WORKER_ID}.{i+1}'
+        frameProcessor = BraggNNFrameProcessor(patch_q=self.patch_q, write_q=self.frame_hdf_q, \
+                                               placement=self.placementPolicy.getPlacement('frame_processor', i), **self.frameProcessorArgs)
+        return WorkerController(workerId, frameProcessor, self.frame_proc_q)
+
+    def _addFrameProcessor(self):
+        with self.controllerLock:
+            if len(self.frameProcControllerMap) >= self.maxFrameProcessors:
+                return False
+            i = min(set(range(self.nFrameProcessorSlots)) - set(self.frameProcControllerMap))
+            controller = self._createFrameProcessorController(i)
+            self.logger.debug(f'Starting frame processor {i+1}')
+            controller.start()
+            self.frameProcControllerMap[i] = controller
+            self.nFrameProcessors = len(self.frameProcControllerMap)
+        return True
+
+    # A retired processor finishes the frame it is working on and takes no
+    # more (WorkerController.retire); frames still in the queue are picked up
+    # by the remaining processors
+    def _retireFrameProcessor(self):
+        with self.controllerLock:
+            if len(self.frameProcControllerMap) <= max(self.minFrameProcessors, 1):
+                return False
+            i = max(self.frameProcControllerMap)
+            controller = self.frameProcControllerMap.pop(i)
+            self.nFrameProcessors = len(self.frameProcControllerMap)
+            cKey = f'{self.FRAME_PROCESSOR_WORKER_ID}{i+1}'
+            self.logger.debug(f'Retiring frame processor {i+1}')
+            sd = controller.retire(statsKeyPrefix=f'{cKey}_') or {}
+            nfp = sd.get(f'{cKey}_nFramesProcessed', 0)
+            self.retiredFrameProcStats['nFramesProcessed'] += nfp
+            self.retiredFrameProcStats['nPatchesGenerated'] += sd.get(f'{cKey}_nPatchesGenerated', 0)
+            self.retiredFrameProcStats['processTimeSum'] += nfp*sd.get(f'{cKey}_processTime', 0)
+        return True
+
+    def _setFrameProcessorCount(self, n):
+        n = min(max(n, self.minFrameProcessors, 1), self.maxFrameProcessors)
+        while len(self.frameProcControllerMap) < n and self._addFrameProcessor():
+            pass
+        while len(self.frameProcControllerMap) > n and self._retireFrameProcessor():
+            pass
+
+    # Frame processor pool scaling: scale up when frames are queueing and the
+    # processors are busy, scale down when the queue is empty and processors are
+    # mostly idle; a decision requires 'hysteresis' consecutive periods
+    def _scalingWorker(self):
+        self.logger.debug('Starting scaling worker')
+        period = self.autoscaleParams.get('period', 2.0)
+        upQueue = self.autoscaleParams.get('up_queue', 10)
+        downQueue = self.autoscaleParams.get('down_queue', 0)
+        upUtil = self.autoscaleParams.get('up_util', 0.8)
+        downUtil = self.autoscaleParams.get('down_util', 0.3)
+        hysteresis = self.autoscaleParams.get('hysteresis', 3)
+        busyTimeMap = {}
+        lastTime = time.time()
+        nUp = 0
+        nDown = 0
+        while not self.isDone:
+            time.sleep(period)
+            if self.isDone:
+                break
+            try:
+                now = time.time()
+                utilization = []
+                with self.controllerLock:
+                    for i, controller in list(self.frameProcControllerMap.items()):
+                        sd = controller.getStats()
+                        busyTime = sd.get('nFramesProcessed', 0)*sd.get('processTime', 0)
+                        if i in busyTimeMap:
+                            utilization.append(max(0, busyTime - busyTimeMap[i])/(now - lastTime))
+                        busyTimeMap[i] = busyTime
+                lastTime = now
+                if not utilization:
+                    continue
+                self.frameProcUtilization = sum(utilization)/len(utilization)
+                nFramesQueued = self.frame_proc_q.qsize()
+                nUp = nUp + 1 if nFramesQueued > upQueue and self.frameProcUtilization > upUtil else 0
+                nDown = nDown + 1 if nFramesQueued <= downQueue and self.frameProcUtilization < downUtil else 0
+                if nUp >= hysteresis:
+                    nUp = 0
+                    if self._addFrameProcessor():
+                        self.logger.debug(f'Scaled up to {self.nFrameProcessors} frame processors, {nFramesQueued} frames queued, utilization {self.frameProcUtilization:.2f}')
+                elif nDown >= hysteresis:
+                    nDown = 0
+                    if self._retireFrameProcessor():
+                        self.logger.debug(f'Scaled down to {self.nFrameProcessors} frame processors, {nFramesQueued} frames queued, utilization {self.frameProcUtilization:.2f}')
+                busyTimeMap = {i : t for i, t in busyTimeMap.items() if i in self.frameProcControllerMap}
+            except Exception as ex:
+                self.logger.error(f'Unexpected error caught: {ex} {type(ex)}')
+        self.logger.debug('Scaling worker is done')
+
     def _inferWorker(self):
         self.logger.debug('Starting infer worker')
         self.gpu = (self.processorId - 1) % self.nGpu
         self.logger.debug(f'Using gpu: {self.gpu}')
         os.environ['CUDA_VISIBLE_DEVICES'] = str(self.gpu)
+        placement = self.placementPolicy.getPlacement('infer')
+        if placement:
+            # infer.threads (e.g. from the autotuner) takes precedence for torch
+            placement.applyToThread(torchThreads=not self.params['infer'].get('threads'))
+            self.logger.debug(f'Infer thread runs on cpus {placement.describe()["cpus"]}, threads: {placement.threads}')
 
-        # Inference engine
-        # params = self.params
-        # if params['infer']['tensorrt']:
-        #     from trtUtil import scriptpth2onnx
-        #     from braggNNTrtInfer import BraggNNTrtInfer
-        #     onnx_mdl = scriptpth2onnx(pth=params['model']['model_fname'], mbsz=params['infer']['mbsz'], psz=params['model']['psz'])
-        #     inferEngine = BraggNNTrtInfer(onnx_mdl)
-        # else:
-        #     from braggNNTorchInfer import BraggNNTorchInfer
-        #     inferEngine = BraggNNTorchInfer(script_pth=params['model']['model_fname'])
+        # Inference engines, one per patch size; they are created in this thread,
+        # as the TensorRT context must be used from the thread that created it.
+        # Without engines, patches are passed on without locations.
+        inferEngines = {}
+        remoteClient = None
+        if self.remoteInferParams:
+            remoteClient = RemoteInferClient(self.remoteInferParams['address'], credits=self.remoteInferParams.get('credits', 4), \
+                                             timeout=self.remoteInferParams.get('timeout', 10.0), name=f'{os.uname().nodename}:{self.processorId}')
+            self.remoteInferClient = remoteClient
+            self.logger.debug(f'Shipping patch batches to remote inference server {remoteClient.address}')
+        else:
+            try:
+                inferEngines = create_infer_engines(self.params)
+                self.logger.debug(f'Inference engines for patch sizes {list(inferEngines)}')
+            except Exception as ex:
+                self.logger.error(f'Cannot create inference engines, peaks will not be localized: {ex}')
+        self.enginesReadyTime = time.time()
+        self.enginesReady.set()
+        self.logger.info(f'Inference ready {self.enginesReadyTime - self.launchTime:.3f} seconds after launch')
 
         while True:
             if self.isDone:
                 break
+            self.inferProfiler.onProcess()
             try:
-                in_mb, ori_mb, frm_id = self.patch_q.get(block=True, timeout=self.Q_WAIT_TIME)
-                # t0 = time.time()
-                # pred = inferEngine.process(in_mb)
-                # inferTime = time.time() - t0
-                # self.inferTimeSum += inferTime
-                ddict = {  # 'ploc' : np.concatenate([ori_mb, in_mb.shape[-1]], axis=1),
-                    'patches' : in_mb,
-                    'uniqueId' : frm_id
-                }
-                if self.peak_hdf_q:
-                    self.peak_hdf_q.put(ddict)
-                if self.peak_zmq_q:
-                    self.peak_zmq_q.put(ddict)
-                self.peak_pva_q.put(ddict)
-                self.nPatchBatchesProcessed += 1
-                self.logger.debug(f'Batch of {in_mb.shape[0]} patches from frame {frm_id}; {self.patch_q.qsize()} batches pending.')
+                if remoteClient:
+                    self._releaseRemoteBatches(remoteClient.poll())
+                    # results of batches in flight are polled for while waiting for more
+                    waitTime = self.REMOTE_POLL_TIME if remoteClient.getNumPending() else self.Q_WAIT_TIME
+                    in_mb, ori_mb, frm_id, lastBatch = self.patch_q.get(block=True, timeout=waitTime)
+                    self._releaseRemoteBatches(remoteClient.submit(in_mb, ori_mb, frm_id, lastBatch))
+                    continue
+                lane, (in_mb, ori_mb, frm_id, lastBatch) = self._getPatchBatch()
+                t0 = time.time()
+                ddict = localize_batch(inferEngines, in_mb, ori_mb, self.outputPsz)
+                self.inferTimeSum += time.time() - t0
+                if lane == self.LIVE_LANE:
+                    self._releaseLiveBatch(ddict, ori_mb, frm_id, lastBatch)
+                else:
+                    self._releaseInferredBatch(ddict, ori_mb, frm_id, lastBatch)
             except queue.Empty:
                 continue
             except KeyboardInterrupt:
@@ -138,15 +479,169 @@ class BraggNNInferImageProcessor(AdImageProcessor):
                 self.logger.error(f'Unexpected error caught: {ex} {type(ex)}')
                 break
 
-        try:
-            self.logger.debug(f'Emptying patch queue, current size is {self.patch_q.qsize()}')
-            while not self.patch_q.empty():
-                self.patch_q.get(block=True, timeout=self.Q_WAIT_TIME)
-            self.patch_q.close()
-        except Exception as ex:
-            self.logger.warn(f'Error emptying patch queue: {ex}')
+        for q in (self.patch_q, self.live_patch_q):
+            if q is None:
+                continue
+            try:
+                self.logger.debug(f'Emptying {q.name}, current size is {q.qsize()}')
+                while not q.empty():
+                    q.get(block=True, timeout=self.Q_WAIT_TIME)
+                q.close()
+            except Exception as ex:
+                self.logger.warning(f'Error emptying {q.name}: {ex}')
+        for engine in inferEngines.values():
+            if engine is not None:
+                engine.stop()
+        if remoteClient:
+            self._releaseRemoteBatches(remoteClient.flush())
+            remoteClient.close()
+        self.inferProfiler.stop()
         self.logger.debug('Infer worker is done')
 
+    # Live batches go first; while the backlog is empty, live batches are
+    # polled for at short intervals
+    def _getPatchBatch(self):
+        if self.live_patch_q is None:
+            return self.BACKLOG_LANE, self.patch_q.get(block=True, timeout=self.Q_WAIT_TIME)
+        try:
+            return self.LIVE_LANE, self.live_patch_q.get_nowait()
+        except queue.Empty:
+            return self.BACKLOG_LANE, self.patch_q.get(block=True, timeout=self.LIVE_POLL_TIME)
+
+    # Seconds since the frame arrived; the frame is forgotten once its backlog
+    # lane processing is done
+    def _frameLag(self, frm_id, done):
+        with self.laneLock:
+            arrivalTime = self.frameArrivalTimes.pop(frm_id, None) if done else self.frameArrivalTimes.get(frm_id)
+        return time.time() - arrivalTime if arrivalTime is not None else None
+
+    # Live batches skip the reorder buffer and grouper, and go to the live outputs only
+    def _releaseLiveBatch(self, ddict, ori_mb, frm_id, lastBatch):
+        self._checkFirstPeak(ori_mb.shape[0])
+        self.nPatchesInferred += ori_mb.shape[0]
+        ddict['ori'] = ori_mb
+        self._setFrameId(ddict, frm_id)
+        ddict['lastBatch'] = lastBatch
+        ddict['live'] = True
+        if self.summaryAggregator:
+            self.summaryAggregator.add(ddict)
+        self._dispatchPeaks(ddict, self.liveOutputs)
+        self.nPatchBatchesProcessed += 1
+        if lastBatch:
+            lag = self._frameLag(frm_id, done=False)
+            if lag is not None:
+                self.nLiveFrames += 1
+                self.liveLagSum += lag
+                self.maxLiveLag = max(self.maxLiveLag, lag)
+
+    def _releaseInferredBatch(self, ddict, ori_mb, frm_id, lastBatch):
+        if lastBatch and self.laneParams:
+            lag = self._frameLag(frm_id, done=True)
+            if lag is not None:
+                self.nBacklogFrames += 1
+                self.backlogLagSum += lag
+                self.maxBacklogLag = max(self.maxBacklogLag, lag)
+        self._checkFirstPeak(ori_mb.shape[0])
+        self.nPatchesInferred += ori_mb.shape[0]
+        ddict['ori'] = ori_mb
+        self._setFrameId(ddict, frm_id)
+        ddict['lastBatch'] = lastBatch
+        if self.summaryAggregator and not self.laneParams:
+            self.summaryAggregator.add(ddict)
+        if self.reorderBuffer:
+            self.reorderBuffer.put(ddict)
+        else:
+            self._dispatchPeaks(ddict)
+        self.nPatchBatchesProcessed += 1
+        self.logger.debug(f'Batch of {ori_mb.shape[0]} patches from frame {frm_id}; {self.patch_q.qsize()} batches pending.')
+
+    def _checkFirstPeak(self, nPeaks):
+        if self.firstPeakTime is None and nPeaks > 0:
+            self.firstPeakTime = time.time()
+            self.logger.info(f'First peak localized {self.firstPeakTime - self.launchTime:.3f} seconds after launch')
+
+    # Wall clock time at which this process was launched, from /proc; falls
+    # back to now
+    @staticmethod
+    def _getLaunchTime():
+        try:
+            with open('/proc/self/stat', 'r') as fp:
+                startTicks = int(fp.read().rsplit(')', 1)[1].split()[19])
+            with open('/proc/uptime', 'r') as fp:
+                uptime = float(fp.read().split()[0])
+            return time.time() - (uptime - startTicks/os.sysconf('SC_CLK_TCK'))
+        except (OSError, ValueError, IndexError):
+            return time.time()
+
+    # Seconds from launch to each startup milestone; 0 until it is reached
+    def _getStartupStats(self):
+        return {
+            f'timeTo{name}' : t - self.launchTime if t is not None else 0.0
+            for name, t in (('EnginesReady', self.enginesReadyTime), ('FirstFrame', self.firstFrameTime), ('FirstPeak', self.firstPeakTime))
+        }
+
+    # Batches carry sequence ids; peaks get the frame id and, with detectors,
+    # the detector index of every peak and the detector name
+    def _setFrameId(self, ddict, frm_id):
+        if not self.detectors:
+            ddict['uniqueId'] = frm_id
+            return
+        frameId, detector = self.sequenceIds.decode(frm_id)
+        ddict['uniqueId'] = frameId
+        ddict['sequenceId'] = frm_id
+        ddict['detector'] = np.full(ddict['patches'].shape[0], detector, dtype=np.int16)
+        ddict['detectorName'] = self.detectors[detector]['name']
+
+    def _tagGroups(self, groups, detector):
+        if not self.detectors:
+            return groups
+        return np.concatenate([groups, np.full((groups.shape[0], 1), detector)], axis=1)
+
+    # Batches returned by the remote inference server; batches the server
+    # published to the writers itself are not sent to the local outputs
+    def _releaseRemoteBatches(self, results):
+        for in_mb, ori_mb, frm_id, lastBatch, pred, forwarded in results:
+            if forwarded:
+                self._checkFirstPeak(ori_mb.shape[0])
+                self.nPatchesInferred += ori_mb.shape[0]
+                self.nPatchBatchesProcessed += 1
+                continue
+            self._releaseInferredBatch(peak_batch(in_mb, ori_mb, pred, self.outputPsz), ori_mb, frm_id, lastBatch)
+
+    # outputs is a subset of OUTPUTS; the backlog lane outputs (all outputs
+    # without lanes) by default
+    def _dispatchPeaks(self, ddict, outputs=None):
+        if outputs is None:
+            outputs = self.backlogOutputs
+        if self.peak_hdf_q and 'hdf' in outputs:
+            self.peak_hdf_q.put(ddict)
+        if self.peak_zmq_q and 'zmq' in outputs:
+            self.peak_zmq_q.put(ddict)
+        if self.peak_pva_q and 'pva' in outputs:
+            self.peak_pva_q.put(ddict)
+
+    # Peak batches released in uniqueId order go through the grouper, if any
+    def _releasePeaks(self, ddict):
+        if self.peakGroupers:
+            detector = ddict.get('sequenceId', 0) % self.nDetectors
+            groups = self.peakGroupers[detector].put(ddict)
+            if groups is not None:
+                self._dispatchPeaks({'groups' : self._tagGroups(groups, detector)})
+            if not self.groupPatches:
+                return
+        self._dispatchPeaks(ddict)
+
+    def _reorderWorker(self):
+        self.logger.debug('Starting reorder worker')
+        while not self.isDone:
+            try:
+                for ddict in self.reorderBuffer.get(timeout=self.REORDER_WAIT_TIME):
+                    self._releasePeaks(ddict)
+            except Exception as ex:
+                self.logger.error(f'Unexpected error caught: {ex} {type(ex)}')
+                break
+        self.logger.debug('Reorder worker is done')
+
     def _pvaPublishPeaks(self, ddict):
         seqId = 0
         frameId = ddict['uniqueId']
@@ -158,6 +653,8 @@ class BraggNNInferImageProcessor(AdImageProcessor):
             pdict['image'] = ddict['patches'][i]
             pdict['uniqueId'] = ddict['uniqueId']
             pdict['patchId'] = seqId # seqID
+            if self.detectors:
+                pdict['detector'] = ddict['detector'][i]
 
             seqId += 1
 
@@ -176,12 +673,80 @@ class BraggNNInferImageProcessor(AdImageProcessor):
             publishTime = time.time()-t0
             self.publishTimeSum += publishTime
             self.nPatchesPublished += 1
-        self.frame_counter += 1
+        # frames may be split into several batches, count each frame once;
+        # with reordering the last batch of each released frame is marked,
+        # including frames skipped as missing whose batches arrive late
+        if self.reorderBuffer:
+            frameDone = 'frameComplete' in ddict
+        else:
+            frameDone = ddict.get('lastBatch', True)
+        if frameDone:
+            self.frame_counter += 1
         self.logger.debug(self.frame_counter)
         if self.frame_counter >= self.n_set_frames != 0:
             self._publishBreakPatch()
             self.frame_counter = 0
 
+    def _pvaPublishGroups(self, groups):
+        if not self.groupChannel:
+            return
+        t0 = time.time()
+        table = pva.NtTable([pva.DOUBLE]*len(self.groupFields))
+        table.setLabels(list(self.groupFields))
+        for i in range(len(self.groupFields)):
+            table.setColumn(i, groups[:,i].tolist())
+        self.pvaServer.update(self.groupChannel, table)
+        self.logger.debug(f'Published {groups.shape[0]} grouped peaks in {time.time()-t0:.4f} seconds')
+        self.nGroupsPublished += groups.shape[0]
+
+    def _summaryWorker(self):
+        self.logger.debug('Starting summary worker')
+        window = self.summaryParams.get('window', 1.0)
+        publisher = None
+        if self.summaryParams.get('port'):
+            context = zmq.Context()
+            publisher = context.socket(zmq.PUB)
+            publisher.bind(f"tcp://*:{self.summaryParams['port']}")
+        nextTime = time.time() + window
+        while not self.isDone:
+            time.sleep(max(0, min(nextTime - time.time(), self.Q_WAIT_TIME)))
+            if time.time() < nextTime:
+                continue
+            nextTime += window
+            try:
+                t0 = time.time()
+                summary = self.summaryAggregator.getSummary()
+                if publisher:
+                    publisher.send_pyobj(summary)
+                if self.summaryChannel:
+                    self.pvaServer.update(self.summaryChannel, self._makeSummaryPvObject(summary))
+                self.summaryPublishTimeSum += time.time() - t0
+                self.nSummariesPublished += 1
+            except Exception as ex:
+                self.logger.error(f'Unexpected error caught: {ex} {type(ex)}')
+        if publisher:
+            publisher.close()
+            context.term()
+        self.logger.debug('Summary worker is done')
+
+    def _makeSummaryPvObject(self, summary):
+        density = summary['density']
+        return pva.PvObject(self.SUMMARY_PVA_TYPE, {
+            'summaryId' : summary['summaryId'],
+            'windowStart' : summary['windowStart'],
+            'windowEnd' : summary['windowEnd'],
+            'nFrames' : summary['nFrames'],
+            'nPeaks' : summary['nPeaks'],
+            'frameIds' : summary['frameIds'].tolist(),
+            'frameCounts' : summary['frameCounts'].tolist(),
+            'histogramEdges' : summary['histogramEdges'].tolist(),
+            'histogram' : summary['histogram'].tolist(),
+            'densityRows' : density.shape[0],
+            'densityCols' : density.shape[1],
+            'density' : density.flatten().tolist(),
+            'topPeaks' : summary['topPeaks'].flatten().tolist()
+        })
+
     #for when an indication of a break between datasets is required.
     def _publishBreakPatch(self):
         self.logger.debug(f'Publishing 1 zero patch, break between datasets.')
@@ -215,6 +780,9 @@ class BraggNNInferImageProcessor(AdImageProcessor):
                 break
             try:
                 ddict = self.peak_pva_q.get(block=True, timeout=self.Q_WAIT_TIME)
+                if 'groups' in ddict:
+                    self._pvaPublishGroups(ddict['groups'])
+                    continue
                 if self.frame_counter == 0 and self.n_set_frames != 0 and self.first_dataset:
                     self._publishBreakPatch()
                     self.first_dataset = False
@@ -240,11 +808,19 @@ class BraggNNInferImageProcessor(AdImageProcessor):
         self.logger.debug('Pva worker is done')
 
     def _getControllerStats(self):
+        with self.controllerLock:
+            return self._getControllerStatsLocked()
+
+    def _getControllerStatsLocked(self):
         controllerStatsMap = {}
-        for i in range(0,self.nFrameProcessors):
+        for i, controller in self.frameProcControllerMap.items():
             procId = i+1
             cKey = f'{self.FRAME_PROCESSOR_WORKER_ID}{procId}'
-            sd = self.frameProcControllerMap[i].getStats(statsKeyPrefix=f'{cKey}_')
+            sd = controller.getStats(statsKeyPrefix=f'{cKey}_')
+            controllerStatsMap[cKey] = sd
+        if self.liveFrameProcController:
+            cKey = self.LIVE_FRAME_PROCESSOR_WORKER_ID
+            sd = self.liveFrameProcController.getStats(statsKeyPrefix=f'{cKey}_')
             controllerStatsMap[cKey] = sd
         if self.frameHdfController:
             cKey = self.FRAME_HDF_WRITER_WORKER_ID
@@ -261,32 +837,32 @@ class BraggNNInferImageProcessor(AdImageProcessor):
         return controllerStatsMap
 
     def _calculateStats(self, controllerStatsMap):
-        nFramesProcessed = 0
-        nPatchesGenerated = 0
-        frameProcessingTimeSum = 0
+        nFramesProcessed = self.retiredFrameProcStats['nFramesProcessed']
+        nPatchesGenerated = self.retiredFrameProcStats['nPatchesGenerated']
+        frameProcessingTimeSum = self.retiredFrameProcStats['processTimeSum']
         frameProcessingTime = 0
         frameProcessingRate = 0
-        for i in range(0,self.nFrameProcessors):
+        for i in range(0,self.nFrameProcessorSlots):
             procId = i+1
             cKey = f'{self.FRAME_PROCESSOR_WORKER_ID}{procId}'
-            sd = controllerStatsMap[cKey]
+            sd = controllerStatsMap.get(cKey, {})
             nfp = sd.get(f'{cKey}_nFramesProcessed', 0)
             fpt = sd.get(f'{cKey}_processTime', 0)
             nFramesProcessed += nfp
             frameProcessingTimeSum += nfp*fpt
             npg = sd.get(f'{cKey}_nPatchesGenerated', 0)
             nPatchesGenerated += npg
-        if nFramesProcessed > 0:
+        if nFramesProcessed > 0 and frameProcessingTimeSum > 0:
             frameProcessingTime = frameProcessingTimeSum/nFramesProcessed  
             frameProcessingRate = nFramesProcessed/frameProcessingTimeSum
         nFramesQueued = self.frame_proc_q.qsize()
         nPatchBatchesQueued = self.patch_q.qsize()
 
-        # inferRate = 0
-        # inferTime = 0
-        # if self.nPatchBatchesProcessed > 0:
-        #     inferRate = self.nPatchBatchesProcessed/self.inferTimeSum
-        #     inferTime = self.inferTimeSum/self.nPatchBatchesProcessed
+        inferRate = 0
+        inferTime = 0
+        if self.nPatchBatchesProcessed > 0 and self.inferTimeSum > 0:
+            inferRate = self.nPatchesInferred/self.inferTimeSum
+            inferTime = self.inferTimeSum/self.nPatchBatchesProcessed
 
         publishRate = 0
         publishTime = 0
@@ -297,22 +873,124 @@ class BraggNNInferImageProcessor(AdImageProcessor):
         statsDict = {}
         statsDict['nFramesProcessed'] = nFramesProcessed
         statsDict['nFramesQueued'] = nFramesQueued
+        statsDict['nFrameProcessors'] = self.nFrameProcessors
+        statsDict['frameProcessorUtilization'] = self.frameProcUtilization
         statsDict['frameProcessingTime'] = frameProcessingTime
         statsDict['frameProcessingRate'] = frameProcessingRate
         statsDict['nPatchBatchesProcessed'] = self.nPatchBatchesProcessed
         statsDict['nPatchBatchesQueued'] = nPatchBatchesQueued
-        # statsDict['inferTime'] = inferTime
-        # statsDict['inferRate'] = inferRate
+        statsDict['inferTime'] = inferTime
+        statsDict['inferRate'] = inferRate
         statsDict['nPatchesGenerated'] = nPatchesGenerated
         statsDict['nPatchesPublished'] = self.nPatchesPublished
         statsDict['publishTime'] = publishTime
         statsDict['publishRate'] = publishRate
+        statsDict.update(self._getStartupStats())
+
+        if self.reorderBuffer:
+            statsDict.update(self.reorderBuffer.getStats())
+        if self.remoteInferClient:
+            statsDict.update(self.remoteInferClient.getStats())
+        if self.laneParams:
+            statsDict.update(self._getLaneStats())
+        if self.summaryAggregator:
+            statsDict['nSummariesPublished'] = self.nSummariesPublished
+            statsDict['summaryPublishTime'] = self.summaryPublishTimeSum/self.nSummariesPublished if self.nSummariesPublished > 0 else 0.0
+        if self.streamRecorder:
+            statsDict.update(self.streamRecorder.getStats())
+        if self.peakGroupers:
+            statsDict.update(self._getGrouperStats())
+            statsDict['nGroupsPublished'] = self.nGroupsPublished
+        for detector, dp in enumerate(self.detectors):
+            statsDict[f'{dp["name"]}_nFramesReceived'] = self.nDetectorFrames[detector]
 
         for cKey,sd in controllerStatsMap.items():
             statsDict.update(sd)
+
+        # Memory: bytes held per queue, RSS of this process and of the workers
+        for q in self._getTrackedQueues():
+            statsDict.update(q.getStats())
+        memory = process_memory()
+        statsDict.update(memory)
+        statsDict['totalRss'] = memory['rss'] + sum(sd.get(f'{cKey}_rss', 0) for cKey, sd in controllerStatsMap.items())
+        self._checkMemory(statsDict)
+        return statsDict
+
+    # Grouper stats summed over detectors
+    def _getGrouperStats(self):
+        statsDict = {}
+        for grouper in self.peakGroupers:
+            for key, value in grouper.getStats().items():
+                statsDict[key] = statsDict.get(key, 0) + value
+        nGroupsClosed = statsDict['nGroupsClosed']
+        statsDict['peaksPerGroup'] = statsDict['nPeaksGrouped']/nGroupsClosed if nGroupsClosed > 0 else 0.0
         return statsDict
 
+    def _getTrackedQueues(self):
+        return [q for q in (self.frame_proc_q, self.patch_q, self.frame_hdf_q, self.peak_hdf_q, self.peak_zmq_q, self.peak_pva_q, \
+                            self.live_frame_q, self.live_patch_q) if q is not None]
+
+    # Lag: seconds from frame arrival until the last batch of the frame has
+    # been localized; backlogAge is the age of the oldest frame not yet through
+    # the backlog lane
+    def _getLaneStats(self):
+        with self.laneLock:
+            oldestArrivalTime = min(self.frameArrivalTimes.values(), default=None)
+        return {
+            'nLiveFrames' : self.nLiveFrames,
+            'nLiveFramesSkipped' : self.nLiveFramesSkipped,
+            'nLivePatchBatchesQueued' : self.live_patch_q.qsize(),
+            'liveLag' : self.liveLagSum/self.nLiveFrames if self.nLiveFrames > 0 else 0.0,
+            'maxLiveLag' : self.maxLiveLag,
+            'nBacklogFrames' : self.nBacklogFrames,
+            'nBacklogFramesDropped' : self.nBacklogFramesDropped,
+            'backlogLag' : self.backlogLagSum/self.nBacklogFrames if self.nBacklogFrames > 0 else 0.0,
+            'maxBacklogLag' : self.maxBacklogLag,
+            'backlogAge' : time.time() - oldestArrivalTime if oldestArrivalTime is not None else 0.0
+        }
+
+    def _resetLaneStats(self):
+        self.nLiveFrames = 0
+        self.nLiveFramesSkipped = 0
+        self.liveLagSum = 0.0
+        self.maxLiveLag = 0.0
+        self.nBacklogFrames = 0
+        self.nBacklogFramesDropped = 0
+        self.backlogLagSum = 0.0
+        self.maxBacklogLag = 0.0
+
+    # Warns once when a threshold is crossed, and again only after usage has
+    # dropped below it
+    def _checkMemory(self, statsDict):
+        usage = {}
+        if self.warnRss:
+            usage['totalRss'] = (statsDict['totalRss'], self.warnRss)
+        if self.warnQueueBytes:
+            for q in self._getTrackedQueues():
+                usage[q.name] = (statsDict[f'{q.name}_nBytes'], self.warnQueueBytes)
+            if self.reorderBuffer:
+                usage['reorderBuffer'] = (statsDict['nBytesBuffered'], self.warnQueueBytes)
+        for key, (value, threshold) in usage.items():
+            if value > threshold and key not in self.memoryWarnings:
+                self.memoryWarnings.add(key)
+                self.logger.warning(f'Memory use of {key} is {value/1e6:.1f} MB, above the threshold of {threshold/1e6:.1f} MB')
+            elif value <= threshold:
+                self.memoryWarnings.discard(key)
+        statsDict['nMemoryWarnings'] = len(self.memoryWarnings)
+
     def start(self):
+        placement = self.placementPolicy.getPlacement('main')
+        if placement:
+            placement.apply()
+        # the engines are created in the inference thread; worker processes
+        # are forked after they are loaded
+        self.inferThread = threading.Thread(target=self._inferWorker)
+        self.inferThread.start()
+        if self.pendingInferProfilerConfig:
+            self.inferProfiler.configure(self.pendingInferProfilerConfig, threadIds=[self.inferThread.ident])
+            self.pendingInferProfilerConfig = None
+        while not self.enginesReady.wait(self.ENGINES_READY_POLL_TIME) and self.inferThread.is_alive():
+            pass
         if self.frameHdfController:
             self.logger.debug('Starting frame HDF controller')
             self.frameHdfController.start()
@@ -322,26 +1000,86 @@ class BraggNNInferImageProcessor(AdImageProcessor):
         if self.peakZmqController:
             self.logger.debug('Starting peak ZMQ controller')
             self.peakZmqController.start()
-        for i in range(0,self.nFrameProcessors):
+        for i, controller in self.frameProcControllerMap.items():
             self.logger.debug(f'Starting frame processor {i+1}')
-            self.frameProcControllerMap[i].start()
-        self.inferThread = threading.Thread(target=self._inferWorker)
-        self.inferThread.start()
+            controller.start()
+        if self.liveFrameProcController:
+            self.logger.debug('Starting live frame processor')
+            self.liveFrameProcController.start()
+        if self.autoscaleParams and self.autoscaleParams.get('enabled', True) and self.minFrameProcessors < self.maxFrameProcessors:
+            self.scalingThread = threading.Thread(target=self._scalingWorker)
+            self.scalingThread.start()
         if self.outputChannel:
-            self.peak_pva_q = mp.Queue(maxsize=-1)
+            if self.peakGroupers:
+                self.groupChannel = self.groupChannel or f'{self.outputChannel}:groups'
+                self.pvaServer.addRecord(self.groupChannel, pva.NtTable([pva.DOUBLE]*len(self.groupFields)))
+                self.logger.debug(f'Publishing grouped peaks on {self.groupChannel}')
+            else:
+                self.groupChannel = None
+            self.peak_pva_q = TrackedQueue(maxsize=-1, name='peakPvaQueue')
             self.pvaThread = threading.Thread(target=self._pvaWorker)
             self.pvaThread.start()
+        if self.reorderBuffer:
+            self.reorderThread = threading.Thread(target=self._reorderWorker)
+            self.reorderThread.start()
+        if self.summaryAggregator:
+            if self.outputChannel:
+                self.summaryChannel = self.summaryChannel or f'{self.outputChannel}:summary'
+                self.pvaServer.addRecord(self.summaryChannel, pva.PvObject(self.SUMMARY_PVA_TYPE))
+                self.logger.debug(f'Publishing peak summaries on {self.summaryChannel}')
+            else:
+                self.summaryChannel = None
+            self.summaryThread = threading.Thread(target=self._summaryWorker)
+            self.summaryThread.start()
+        # detectors with their own channel are subscribed to once the pipeline is up
+        for detector, dp in enumerate(self.detectors):
+            if not dp.get('channel'):
+                continue
+            channel = pva.Channel(dp['channel'], pva.PVA)
+            channel.subscribe(dp['name'], lambda pvObject, detector=detector: self._ingestFrame(pvObject, detector))
+            channel.startMonitor('')
+            self.detectorChannels.append((channel, dp['name']))
+            self.logger.debug(f'Detector {dp["name"]} subscribed to {dp["channel"]}')
 
     def stop(self):
         self.logger.debug('Signaling worker threads to stop')
         self.isDone = True
+        for channel, name in self.detectorChannels:
+            channel.stopMonitor()
+            channel.unsubscribe(name)
+        if self.streamRecorder:
+            self.streamRecorder.stop()
+        if self.scalingThread:
+            self.scalingThread.join()
+        if self.summaryThread:
+            self.summaryThread.join()
+        if self.reorderThread:
+            self.reorderThread.join()
+            for ddict in self.reorderBuffer.flush():
+                self._releasePeaks(ddict)
+        for detector, grouper in enumerate(self.peakGroupers):
+            # pva worker is done by now, publish the remaining groups directly
+            groups = grouper.flush()
+            if groups is not None:
+                groups = self._tagGroups(groups, detector)
+                if self.peak_hdf_q:
+                    self.peak_hdf_q.put({'groups' : groups})
+                if self.peak_zmq_q:
+                    self.peak_zmq_q.put({'groups' : groups})
+                if self.peak_pva_q:
+                    self._pvaPublishGroups(groups)
         controllerStatsMap = {}
-        for i in range(0,self.nFrameProcessors):
+        for i, controller in self.frameProcControllerMap.items():
             procId = i+1
             cKey = f'{self.FRAME_PROCESSOR_WORKER_ID}{procId}'
             self.logger.debug(f'Stopping frame processor {procId}')
-            controllerStatsMap[cKey] = self.frameProcControllerMap[i].stop(statsKeyPrefix=f'{cKey}_')
+            controllerStatsMap[cKey] = controller.stop(statsKeyPrefix=f'{cKey}_')
         self.frame_proc_q.close()
+        if self.liveFrameProcController:
+            cKey = self.LIVE_FRAME_PROCESSOR_WORKER_ID
+            self.logger.debug('Stopping live frame processor')
+            controllerStatsMap[cKey] = self.liveFrameProcController.stop(statsKeyPrefix=f'{cKey}_')
+            self.live_frame_q.close()
         if self.frameHdfController:
             cKey = self.FRAME_HDF_WRITER_WORKER_ID
             self.logger.debug('Stopping frame HDF controller')
@@ -361,12 +1099,102 @@ class BraggNNInferImageProcessor(AdImageProcessor):
         self.logger.debug('All controllers stopped, exiting')
         return statsDict
 
+    def _getWorkerControllerMap(self):
+        controllerMap = {}
+        for i, controller in self.frameProcControllerMap.items():
+            controllerMap[f'{self.FRAME_PROCESSOR_WORKER_ID}.{i+1}'] = controller
+        if self.liveFrameProcController:
+            controllerMap[self.LIVE_FRAME_PROCESSOR_WORKER_ID] = self.liveFrameProcController
+        if self.frameHdfController:
+            controllerMap[self.FRAME_HDF_WRITER_WORKER_ID] = self.frameHdfController
+        if self.peakHdfController:
+            controllerMap[self.PEAK_HDF_WRITER_WORKER_ID] = self.peakHdfController
+        if self.peakZmqController:
+            controllerMap[self.PEAK_ZMQ_WRITER_WORKER_ID] = self.peakZmqController
+        return controllerMap
+
+    # Profiler commands, e.g. {'profiler' : 'start', 'profilerTarget' : 'frameProcessor.2',
+    # 'profilerMode' : 'sample', 'profilerDuration' : 10}; target is a worker id,
+    # a worker id prefix (e.g. 'frameProcessor'), 'infer' or 'all' (default)
+    def _configureProfiler(self, kwargs):
+        profilerParams = self.params.get('profiler') or {}
+        configDict = dict(kwargs)
+        configDict.setdefault('profilerDir', profilerParams.get('output_dir', '.'))
+        configDict.setdefault('profilerInterval', profilerParams.get('interval', WorkerProfiler.DEFAULT_INTERVAL))
+        target = configDict.get('profilerTarget', 'all')
+
+        def isTarget(workerId):
+            return target == 'all' or workerId == target or workerId.startswith(f'{target}.')
+
+        if isTarget(self.INFER_WORKER_ID):
+            configDict['profilerName'] = f'{self.INFER_WORKER_ID}-{self.processorId}'
+            if self.inferThread is None:
+                self.logger.debug(f'Inference thread not started yet, deferring profiler command {configDict["profiler"]}')
+                self.pendingInferProfilerConfig = dict(configDict)
+            else:
+                self.inferProfiler.configure(dict(configDict), threadIds=[self.inferThread.ident])
+        with self.controllerLock:
+            for workerId, controller in self._getWorkerControllerMap().items():
+                if isTarget(workerId):
+                    self.logger.debug(f'Sending profiler command {configDict["profiler"]} to {workerId}')
+                    configDict['profilerName'] = f'{workerId}-{self.processorId}'
+                    controller.configure(dict(configDict))
+
+    # Frame processor updates, e.g. {'min_intensity' : 120, 'mbsz' : 64}, are
+    # applied to running processors and remembered for processors added later;
+    # 'nproc', 'nproc_min' and 'nproc_max' resize the processor pool
+    # (the pool is resized even if the parameter update fails)
+    def _configureFrameProcessors(self, kwargs):
+        with self.controllerLock:
+            try:
+                self._updateFrameProcessors(kwargs)
+            except Exception as ex:
+                self.logger.error(f'Cannot update frame processors: {ex}')
+            if 'nproc_min' in kwargs:
+                self.minFrameProcessors = int(kwargs['nproc_min'])
+            if 'nproc_max' in kwargs:
+                self.maxFrameProcessors = min(int(kwargs['nproc_max']), self.nFrameProcessorSlots)
+            if 'nproc' in kwargs or 'nproc_min' in kwargs or 'nproc_max' in kwargs:
+                nproc = int(kwargs.get('nproc', self.nFrameProcessors))
+                self._setFrameProcessorCount(nproc)
+
+    def _updateFrameProcessors(self, kwargs):
+        configDict = {}
+        for key in BraggNNFrameProcessor.CONFIG_KEYS:
+            if key in kwargs:
+                configDict[key] = BraggNNFrameProcessor.parseConfigValue(key, kwargs[key])
+        if not configDict:
+            return
+        self.frameProcessorArgs.update(configDict)
+        for i, controller in self.frameProcControllerMap.items():
+            self.logger.debug(f'Updating frame processor {i+1}: {configDict}')
+            controller.configure(configDict)
+        # the live lane keeps its own batch size
+        liveConfigDict = {key : value for key, value in configDict.items() if key != 'mbsz'}
+        if self.liveFrameProcController and liveConfigDict:
+            self.logger.debug(f'Updating live frame processor: {liveConfigDict}')
+            self.liveFrameProcController.configure(liveConfigDict)
+
     def configure(self, kwargs):
         self.logger.debug(f'Configuration update: {kwargs}')
+        if 'profiler' in kwargs:
+            self._configureProfiler(kwargs)
+        self._configureFrameProcessors(kwargs)
 
     def process(self, pvObject):
         if self.isDone:
             return
+        if self.inputDetector is not None:
+            self._ingestFrame(pvObject, self.inputDetector)
+        return pvObject
+
+    # Frames of all detectors; detectors with their own channel call this from
+    # their monitor
+    def _ingestFrame(self, pvObject, detector):
+        if self.isDone:
+            return
+        if self.firstFrameTime is None:
+            self.firstFrameTime = time.time()
         frameId = pvObject['uniqueId']
         dims = pvObject['dimension']
         nx = dims[0]['size']
@@ -376,17 +1204,65 @@ class BraggNNInferImageProcessor(AdImageProcessor):
         uncompressedSize = pvObject['uncompressedSize']
         fieldKey = pvObject.getSelectedUnionFieldName()
         frameData = pvObject['value'][0][fieldKey]
+        if self.streamRecorder and detector == self.inputDetector:
+            self.streamRecorder.record(frameId, frameData, codec, compressedSize, uncompressedSize, (nx, ny), fieldKey)
+        if self.summaryAggregator and self.summaryAggregator.detectorShape is None:
+            self.summaryAggregator.setDetectorShape((ny, nx))
 
-        self.frame_proc_q.put((frameId, frameData, compressedSize, uncompressedSize, codec, ny, nx))
-        return pvObject
+        frame = (frameId, frameData, compressedSize, uncompressedSize, codec, ny, nx)
+        if self.detectors:
+            self.nDetectorFrames[detector] += 1
+            frame = (self.sequenceIds.encode(frameId, detector),) + frame[1:] + (detector, frameId)
+        if not self.laneParams:
+            self.frame_proc_q.put(frame)
+            return
+
+        seqId = frame[0]
+        with self.laneLock:
+            self.frameArrivalTimes[seqId] = time.time()
+        # the live lane only keeps the newest frames
+        while True:
+            try:
+                self.live_frame_q.put_nowait(frame)
+                break
+            except queue.Full:
+                try:
+                    self.live_frame_q.get_nowait()
+                    self.nLiveFramesSkipped += 1
+                except queue.Empty:
+                    pass
+        try:
+            self.frame_proc_q.put_nowait(frame)
+        except queue.Full:
+            self.nBacklogFramesDropped += 1
+            with self.laneLock:
+                self.frameArrivalTimes.pop(seqId, None)
 
     def resetStats(self):
         self.nPatchBatchesProcessed = 0
+        self.nPatchesInferred = 0
         self.nPatchesPublished = 0
         self.inferTimeSum = 0
         self.publishTimeSum = 0
-        for i in range(0,self.nFrameProcessors):
-            self.frameProcControllerMap[i].resetStats()
+        self.nGroupsPublished = 0
+        self._resetLaneStats()
+        self.nSummariesPublished = 0
+        self.summaryPublishTimeSum = 0
+        if self.reorderBuffer:
+            self.reorderBuffer.resetStats()
+        for q in self._getTrackedQueues():
+            q.resetStats()
+        if self.remoteInferClient:
+            self.remoteInferClient.resetStats()
+        for grouper in self.peakGroupers:
+            grouper.resetStats()
+        self.nDetectorFrames = [0]*self.nDetectors
+        with self.controllerLock:
+            for controller in self.frameProcControllerMap.values():
+                controller.resetStats()
+        if self.liveFrameProcController:
+            self.liveFrameProcController.resetStats()
+        self.retiredFrameProcStats = {'nFramesProcessed' : 0, 'nPatchesGenerated' : 0, 'processTimeSum' : 0.0}
         if self.frameHdfController:
             self.frameHdfController.resetStats()
         if self.peakHdfController:
@@ -404,6 +1280,8 @@ class BraggNNInferImageProcessor(AdImageProcessor):
         typeDict = {
             'nFramesProcessed' : pva.UINT,
             'nFramesQueued' : pva.UINT,
+            'nFrameProcessors' : pva.UINT,
+            'frameProcessorUtilization' : pva.DOUBLE,
             'frameProcessingTime' : pva.DOUBLE,
             'frameProcessingRate' : pva.DOUBLE,
             'nPatchBatchesProcessed' : pva.UINT,
@@ -413,24 +1291,105 @@ class BraggNNInferImageProcessor(AdImageProcessor):
             'nPatchesGenerated' : pva.UINT,
             'nPatchesPublished' : pva.UINT,
             'publishTime' : pva.DOUBLE,
-            'publishRate' : pva.DOUBLE
+            'publishRate' : pva.DOUBLE,
+            'timeToEnginesReady' : pva.DOUBLE,
+            'timeToFirstFrame' : pva.DOUBLE,
+            'timeToFirstPeak' : pva.DOUBLE,
+            'rss' : pva.ULONG,
+            'peakRss' : pva.ULONG,
+            'totalRss' : pva.ULONG,
+            'nMemoryWarnings' : pva.UINT
         }
-        for i in range(0,self.nFrameProcessors):
+        queueNames = ['frameQueue', 'patchQueue']
+        queueNames += ['frameHdfQueue'] if self.frame_hdf_q else []
+        queueNames += ['peakHdfQueue'] if self.peak_hdf_q else []
+        queueNames += ['peakZmqQueue'] if self.peak_zmq_q else []
+        queueNames += ['peakPvaQueue'] if self.outputChannel else []
+        queueNames += ['liveFrameQueue', 'livePatchQueue'] if self.laneParams else []
+        for name in queueNames:
+            for field in QUEUE_STATS_FIELDS:
+                typeDict[f'{name}_{field}'] = pva.ULONG
+        for i in range(0,self.nFrameProcessorSlots):
             procId = i+1
             typeDict[f'frameProcessor{procId}_nFramesProcessed'] = pva.UINT
             typeDict[f'frameProcessor{procId}_nPatchesGenerated'] = pva.UINT
             typeDict[f'frameProcessor{procId}_processTime'] = pva.DOUBLE
             typeDict[f'frameProcessor{procId}_decodeTime'] = pva.DOUBLE
             typeDict[f'frameProcessor{procId}_peakTime'] = pva.DOUBLE
+            typeDict[f'frameProcessor{procId}_rss'] = pva.ULONG
+            typeDict[f'frameProcessor{procId}_peakRss'] = pva.ULONG
+        if self.reorderBuffer:
+            typeDict['nFramesReordered'] = pva.UINT
+            typeDict['nFramesBuffered'] = pva.UINT
+            typeDict['maxFramesBuffered'] = pva.UINT
+            typeDict['nBytesBuffered'] = pva.ULONG
+            typeDict['maxBytesBuffered'] = pva.ULONG
+            typeDict['nFramesMissing'] = pva.UINT
+            typeDict['nFramesIncomplete'] = pva.UINT
+            typeDict['nLateBatches'] = pva.UINT
+            typeDict['reorderHoldTime'] = pva.DOUBLE
+        if self.remoteInferParams:
+            typeDict['nRemoteBatchesSent'] = pva.UINT
+            typeDict['nRemoteBatchesReturned'] = pva.UINT
+            typeDict['nRemoteBatchesExpired'] = pva.UINT
+            typeDict['nRemoteBatchesFailed'] = pva.UINT
+            typeDict['nRemoteBatchesNotSent'] = pva.UINT
+            typeDict['nRemoteBytesSent'] = pva.ULONG
+            typeDict['remoteRoundTripTime'] = pva.DOUBLE
+            typeDict['remoteCreditWaitTime'] = pva.DOUBLE
+        if self.summaryAggregator:
+            typeDict['nSummariesPublished'] = pva.UINT
+            typeDict['summaryPublishTime'] = pva.DOUBLE
+        if self.laneParams:
+            typeDict['nLiveFrames'] = pva.UINT
+            typeDict['nLiveFramesSkipped'] = pva.UINT
+            typeDict['nLivePatchBatchesQueued'] = pva.UINT
+            typeDict['liveLag'] = pva.DOUBLE
+            typeDict['maxLiveLag'] = pva.DOUBLE
+            typeDict['nBacklogFrames'] = pva.UINT
+            typeDict['nBacklogFramesDropped'] = pva.UINT
+            typeDict['backlogLag'] = pva.DOUBLE
+            typeDict['maxBacklogLag'] = pva.DOUBLE
+            typeDict['backlogAge'] = pva.DOUBLE
+            typeDict['liveFrameProcessor_nFramesProcessed'] = pva.UINT
+            typeDict['liveFrameProcessor_nPatchesGenerated'] = pva.UINT
+            typeDict['liveFrameProcessor_processTime'] = pva.DOUBLE
+            typeDict['liveFrameProcessor_decodeTime'] = pva.DOUBLE
+            typeDict['liveFrameProcessor_peakTime'] = pva.DOUBLE
+            typeDict['liveFrameProcessor_rss'] = pva.ULONG
+            typeDict['liveFrameProcessor_peakRss'] = pva.ULONG
+        for dp in self.detectors:
+            typeDict[f'{dp["name"]}_nFramesReceived'] = pva.UINT
+        if self.peakGroupers:
+            typeDict['nPeaksGrouped'] = pva.UINT
+            typeDict['nGroupsClosed'] = pva.UINT
+            typeDict['nGroupsOpen'] = pva.UINT
+            typeDict['maxGroupsOpen'] = pva.UINT
+            typeDict['peaksPerGroup'] = pva.DOUBLE
+            typeDict['nGroupsPublished'] = pva.UINT
+        if self.streamRecorder:
+            typeDict['nFramesRecorded'] = pva.UINT
+            typeDict['nFramesNotRecorded'] = pva.UINT
+            typeDict['nBytesRecorded'] = pva.ULONG
+            typeDict['nRecordBytesQueued'] = pva.ULONG
+            typeDict['maxRecordBytesQueued'] = pva.ULONG
         if self.frameHdfController:
             typeDict['frameHdfWriter_nObjectsWritten'] = pva.UINT
             typeDict['frameHdfWriter_writeTime'] = pva.DOUBLE
+            typeDict['frameHdfWriter_rss'] = pva.ULONG
+            typeDict['frameHdfWriter_peakRss'] = pva.ULONG
+            if self.writeSparseFrames:
+                typeDict['frameHdfWriter_nPixelsWritten'] = pva.ULONG
         if self.peakHdfController:
             typeDict['peakHdfWriter_nObjectsWritten'] = pva.UINT
             typeDict['peakHdfWriter_writeTime'] = pva.DOUBLE
+            typeDict['peakHdfWriter_rss'] = pva.ULONG
+            typeDict['peakHdfWriter_peakRss'] = pva.ULONG
         if self.peakZmqController:
             typeDict['peakZmqWriter_nObjectsPublished'] = pva.UINT
             typeDict['peakZmqWriter_nErrors'] = pva.UINT
             typeDict['peakZmqWriter_publishTime'] = pva.DOUBLE
+            typeDict['peakZmqWriter_rss'] = pva.ULONG
+            typeDict['peakZmqWriter_peakRss'] = pva.ULONG
         return typeDict
 
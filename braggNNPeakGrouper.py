@@ -0,0 +1,138 @@
+import numpy as np
+from pvapy.utility.loggingManager import LoggingManager
+
+# rows, cols and summed intensities of the peaks of a batch: locations from
+# 'ploc' when inference produced it, otherwise the intensity weighted centroid
+# of each patch placed at its origin 'ori'
+def peak_locations(ddict):
+    patches = ddict['patches'].reshape((ddict['patches'].shape[0], -1, ddict['patches'].shape[-1])).astype(np.float64)
+    intensity = patches.sum(axis=(1, 2))
+    if 'ploc' in ddict:
+        ploc = ddict['ploc']
+        return ploc[:, 1] + ploc[:, 3], ploc[:, 2] + ploc[:, 4], intensity
+    ori = ddict['ori']
+    grid = np.arange(patches.shape[-1])
+    total = np.where(intensity != 0, intensity, 1)
+    rows = ori[:, 1] + (patches.sum(axis=2)*grid).sum(axis=1)/total
+    cols = ori[:, 2] + (patches.sum(axis=1)*grid).sum(axis=1)/total
+    return rows, cols, intensity
+
+class BraggNNPeakGrouper:
+    '''
+    Links peaks of consecutive frames (uniqueIds idStep apart) into 3D peaks.
+
+    Batches must arrive in uniqueId order (after the reorder stage). A peak
+    joins the nearest open group within maxDistance pixels that was last seen
+    at most maxGap frames earlier and has not been extended in the same frame;
+    otherwise it starts a new group. Groups not extended for more than maxGap
+    frames are closed and returned as rows of GROUP_FIELDS: intensity
+    weighted row, col and frame, frame span, summed intensity and number of
+    detections.
+
+    Peak locations come from 'ploc' when inference produced it, otherwise from
+    the intensity weighted centroid of each patch placed at its origin 'ori'.
+    '''
+
+    GROUP_FIELDS = ('row', 'col', 'frame', 'firstFrame', 'lastFrame', 'intensity', 'nDetections')
+
+    # columns of the open group table
+    LAST_ROW, LAST_COL, LAST_FRAME, FIRST_FRAME, SUM_I, SUM_IROW, SUM_ICOL, SUM_IFRAME, N_DET = range(9)
+
+    def __init__(self, maxDistance=2.0, maxGap=0, idStep=1):
+        self.logger = LoggingManager.getLogger(self.__class__.__name__)
+        self.maxDistance = maxDistance
+        self.idStep = idStep
+        self.window = idStep*(maxGap + 1)
+        self.groups = np.zeros((0, 9))
+        self.resetStats()
+
+    def _summarize(self, groups):
+        if groups.shape[0] == 0:
+            return None
+        intensity = np.where(groups[:, self.SUM_I] != 0, groups[:, self.SUM_I], 1)
+        self.nGroupsClosed += groups.shape[0]
+        return np.stack([
+            groups[:, self.SUM_IROW]/intensity,
+            groups[:, self.SUM_ICOL]/intensity,
+            groups[:, self.SUM_IFRAME]/intensity,
+            groups[:, self.FIRST_FRAME],
+            groups[:, self.LAST_FRAME],
+            groups[:, self.SUM_I],
+            groups[:, self.N_DET]
+        ], axis=1)
+
+    # add the peaks of a batch; returns the groups closed by it (or None)
+    def put(self, ddict):
+        frameId = ddict['uniqueId']
+        closing = self.groups[:, self.LAST_FRAME] < frameId - self.window
+        closed = self.groups[closing]
+        self.groups = self.groups[~closing]
+        if ddict['patches'].shape[0] == 0:
+            return self._summarize(closed)
+
+        rows, cols, intensity = peak_locations(ddict)
+        n = len(rows)
+        self.nPeaksGrouped += n
+
+        # closest pairs first, one peak per group and frame
+        assigned = np.full(n, -1)
+        eligible = np.flatnonzero(self.groups[:, self.LAST_FRAME] < frameId)
+        if len(eligible) > 0:
+            d = np.hypot(rows[:, None] - self.groups[eligible, self.LAST_ROW], cols[:, None] - self.groups[eligible, self.LAST_COL])
+            peakIdx, groupIdx = np.nonzero(d <= self.maxDistance)
+            order = np.argsort(d[peakIdx, groupIdx], kind='stable')
+            usedGroups = set()
+            for p, g in zip(peakIdx[order], groupIdx[order]):
+                if assigned[p] >= 0 or g in usedGroups:
+                    continue
+                assigned[p] = eligible[g]
+                usedGroups.add(g)
+
+        matched = assigned >= 0
+        g = assigned[matched]
+        self.groups[g, self.LAST_ROW] = rows[matched]
+        self.groups[g, self.LAST_COL] = cols[matched]
+        self.groups[g, self.LAST_FRAME] = frameId
+        self.groups[g, self.SUM_I] += intensity[matched]
+        self.groups[g, self.SUM_IROW] += intensity[matched]*rows[matched]
+        self.groups[g, self.SUM_ICOL] += intensity[matched]*cols[matched]
+        self.groups[g, self.SUM_IFRAME] += intensity[matched]*frameId
+        self.groups[g, self.N_DET] += 1
+
+        new = ~matched
+        newGroups = np.zeros((new.sum(), 9))
+        newGroups[:, self.LAST_ROW] = rows[new]
+        newGroups[:, self.LAST_COL] = cols[new]
+        newGroups[:, self.LAST_FRAME] = frameId
+        newGroups[:, self.FIRST_FRAME] = frameId
+        newGroups[:, self.SUM_I] = intensity[new]
+        newGroups[:, self.SUM_IROW] = intensity[new]*rows[new]
+        newGroups[:, self.SUM_ICOL] = intensity[new]*cols[new]
+        newGroups[:, self.SUM_IFRAME] = intensity[new]*frameId
+        newGroups[:, self.N_DET] = 1
+        self.groups = np.concatenate([self.groups, newGroups])
+        self.maxOpenGroups = max(self.maxOpenGroups, self.groups.shape[0])
+        return self._summarize(closed)
+
+    # close and return all open groups
+    def flush(self):
+        groups = self.groups
+        self.groups = np.zeros((0, 9))
+        return self._summarize(groups)
+
+    def getStats(self):
+        groupSize = 0.0
+        if self.nGroupsClosed > 0:
+            groupSize = self.nPeaksGrouped/self.nGroupsClosed
+        return {
+            'nPeaksGrouped' : self.nPeaksGrouped,
+            'nGroupsClosed' : self.nGroupsClosed,
+            'nGroupsOpen' : self.groups.shape[0],
+            'maxGroupsOpen' : self.maxOpenGroups,
+            'peaksPerGroup' : groupSize
+        }
+
+    def resetStats(self):
+        self.nPeaksGrouped = 0
+        self.nGroupsClosed = 0
+        self.maxOpenGroups = 0
@@ -0,0 +1,176 @@
+import threading
+import time
+from collections import deque
+from pvapy.utility.loggingManager import LoggingManager
+from memoryAccounting import payload_nbytes
+
+class SequenceIds:
+    '''
+    Maps the frame ids of several detectors to one sequence of ids without
+    gaps: frame k of the consumer (frameId = firstId + k*idStep) of detector d
+    has sequence id k*nDetectors + d, so that the reorder buffer, stepping by
+    one, releases frames in (frame, detector) order. Each detector has its own
+    firstId (firstId is one value for all detectors or a list with one per
+    detector), so detectors may count their frames independently. Without a
+    detector's firstId, the first frame id encoded for it is taken as the base.
+    '''
+
+    def __init__(self, nDetectors, idStep=1, firstId=None):
+        self.nDetectors = nDetectors
+        self.idStep = idStep
+        if not isinstance(firstId, (list, tuple)):
+            firstId = [firstId]*nDetectors
+        self.firstIds = {detector : fid for detector, fid in enumerate(firstId) if fid is not None}
+        self.lock = threading.Lock()
+
+    def encode(self, frameId, detector):
+        firstId = self.firstIds.get(detector)
+        if firstId is None:
+            with self.lock:
+                firstId = self.firstIds.setdefault(detector, frameId)
+        return ((frameId - firstId)//self.idStep)*self.nDetectors + detector
+
+    # frame id and detector of a sequence id
+    def decode(self, seqId):
+        k, detector = divmod(seqId, self.nDetectors)
+        return self.firstIds[detector] + k*self.idStep, detector
+
+class BraggNNReorderBuffer:
+    '''
+    Holds peak batches and releases them in uniqueId order.
+
+    Batches of a frame are released together once the batch flagged as last
+    has arrived; the last released batch of each frame carries the
+    'frameComplete' marker (False if the frame was released incomplete because
+    it was held longer than maxHoldTime). A missing frame is skipped once the
+    oldest buffered frame has been held for maxHoldTime; batches arriving for
+    frames that were already passed are released right away and flagged 'late'.
+    The late last batch of a frame that was skipped as missing carries
+    'frameComplete' (False), so that every frame is marked once. Frames are
+    identified by the idKey entry of the batches.
+    '''
+
+    # frames released incomplete that are remembered, to tell their late
+    # last batches from those of skipped frames
+    INCOMPLETE_HISTORY = 1024
+
+    def __init__(self, maxHoldTime=1.0, idStep=1, firstId=None, idKey='uniqueId'):
+        self.logger = LoggingManager.getLogger(self.__class__.__name__)
+        self.maxHoldTime = maxHoldTime
+        self.idStep = idStep
+        self.idKey = idKey
+        self.nextId = firstId
+        self.frames = {}
+        self.lateBatches = []
+        self.incompleteIds = set()
+        self.incompleteIdHistory = deque()
+        self.nBytesBuffered = 0
+        self.condition = threading.Condition()
+        self.resetStats()
+
+    def put(self, ddict):
+        frameId = ddict[self.idKey]
+        with self.condition:
+            if self.nextId is not None and frameId < self.nextId:
+                ddict['late'] = True
+                if ddict.get('lastBatch', True):
+                    if frameId in self.incompleteIds:
+                        self.incompleteIds.discard(frameId)
+                    else:
+                        ddict['frameComplete'] = False
+                self.lateBatches.append(ddict)
+                self.nLateBatches += 1
+            else:
+                frame = self.frames.get(frameId)
+                if frame is None:
+                    frame = {'arrivalTime' : time.time(), 'batches' : [], 'complete' : False, 'nBytes' : 0}
+                    self.frames[frameId] = frame
+                frame['batches'].append(ddict)
+                frame['complete'] = ddict.get('lastBatch', True)
+                nBytes = payload_nbytes(ddict)
+                frame['nBytes'] += nBytes
+                self.nBytesBuffered += nBytes
+                self.maxFramesBuffered = max(self.maxFramesBuffered, len(self.frames))
+                self.maxBytesBuffered = max(self.maxBytesBuffered, self.nBytesBuffered)
+            self.condition.notify()
+
+    # wait up to timeout seconds for releasable batches and return them in order
+    def get(self, timeout):
+        with self.condition:
+            ready = self._release(time.time())
+            if not ready:
+                self.condition.wait(timeout)
+                ready = self._release(time.time())
+            return ready
+
+    # return everything that is buffered, in order, regardless of hold time
+    def flush(self):
+        with self.condition:
+            return self._release(float('inf'))
+
+    def _release(self, now):
+        ready = self.lateBatches
+        self.lateBatches = []
+        while self.frames:
+            oldestId = min(self.frames)
+            if self.nextId is None:
+                # wait for the first frames to settle before fixing the start id
+                if now - self.frames[oldestId]['arrivalTime'] < self.maxHoldTime:
+                    break
+                self.nextId = oldestId
+            frame = self.frames.get(self.nextId)
+            if frame is None:
+                if now - self.frames[oldestId]['arrivalTime'] < self.maxHoldTime:
+                    break
+                nMissing = (oldestId - self.nextId)//self.idStep
+                self.nFramesMissing += nMissing
+                self.logger.warning(f'Frames {self.nextId} to {oldestId - self.idStep} were not received within {self.maxHoldTime} seconds, {nMissing} frames missing')
+                self.nextId = oldestId
+                continue
+            if not frame['complete'] and now - frame['arrivalTime'] < self.maxHoldTime:
+                break
+            del self.frames[self.nextId]
+            self.nBytesBuffered -= frame['nBytes']
+            frame['batches'][-1]['frameComplete'] = frame['complete']
+            if not frame['complete']:
+                self.nFramesIncomplete += 1
+                self._addIncompleteId(self.nextId)
+            self.holdTimeSum += min(now, time.time()) - frame['arrivalTime']
+            self.nFramesReleased += 1
+            ready.extend(frame['batches'])
+            self.nextId += self.idStep
+        return ready
+
+    def _addIncompleteId(self, frameId):
+        if len(self.incompleteIdHistory) >= self.INCOMPLETE_HISTORY:
+            self.incompleteIds.discard(self.incompleteIdHistory.popleft())
+        self.incompleteIdHistory.append(frameId)
+        self.incompleteIds.add(frameId)
+
+    def getStats(self):
+        holdTime = 0.0
+        if self.nFramesReleased > 0:
+            holdTime = self.holdTimeSum/self.nFramesReleased
+        with self.condition:
+            nFramesBuffered = len(self.frames)
+            nBytesBuffered = self.nBytesBuffered
+        return {
+            'nFramesReordered' : self.nFramesReleased,
+            'nFramesBuffered' : nFramesBuffered,
+            'maxFramesBuffered' : self.maxFramesBuffered,
+            'nBytesBuffered' : nBytesBuffered,
+            'maxBytesBuffered' : self.maxBytesBuffered,
+            'nFramesMissing' : self.nFramesMissing,
+            'nFramesIncomplete' : self.nFramesIncomplete,
+            'nLateBatches' : self.nLateBatches,
+            'reorderHoldTime' : holdTime
+        }
+
+    def resetStats(self):
+        self.nFramesReleased = 0
+        self.maxFramesBuffered = 0
+        self.maxBytesBuffered = self.nBytesBuffered
+        self.nFramesMissing = 0
+        self.nFramesIncomplete = 0
+        self.nLateBatches = 0
+        self.holdTimeSum = 0.0
@@ -0,0 +1,90 @@
+import threading
+import time
+import numpy as np
+from pvapy.utility.loggingManager import LoggingManager
+from braggNNPeakGrouper import peak_locations
+
+class BraggNNSummaryAggregator:
+    '''
+    Aggregates localized peak batches over time windows into a summary for
+    visualization clients: per-frame peak counts, a log-spaced intensity
+    histogram, a downsampled peak density map of the detector and the topK
+    brightest peaks. Every summary has the same, fixed size, whatever the peak
+    rate: frames beyond maxFrames in a window are counted in nFrames/nPeaks but
+    only the latest maxFrames are listed, unused frame and peak slots are
+    padded (frame id -1, NaN peaks).
+    '''
+
+    # columns of topPeaks
+    PEAK_FIELDS = ('frame', 'row', 'col', 'intensity')
+
+    def __init__(self, maxFrames=256, nBins=32, maxIntensity=1e6, densityShape=(64, 64), topK=16, detectorShape=None):
+        self.logger = LoggingManager.getLogger(self.__class__.__name__)
+        self.maxFrames = maxFrames
+        self.histogramEdges = np.concatenate([[0], np.logspace(0, np.log10(maxIntensity), nBins)]).astype(np.float32)
+        self.densityShape = tuple(densityShape)
+        self.topK = topK
+        self.detectorShape = tuple(detectorShape) if detectorShape else None
+        self.lock = threading.Lock()
+        self.nSummaries = 0
+        self._startWindow(time.time())
+
+    def _startWindow(self, now):
+        self.windowStart = now
+        self.frameCounts = {}
+        self.nPeaks = 0
+        self.histogram = np.zeros(len(self.histogramEdges) - 1, dtype=np.uint32)
+        self.density = np.zeros(self.densityShape, dtype=np.uint32)
+        self.topPeaks = np.full((self.topK, len(self.PEAK_FIELDS)), np.nan, dtype=np.float32)
+
+    # rows x cols of the detector, scaled down to densityShape; the first frame sets it if not configured
+    def setDetectorShape(self, detectorShape):
+        if self.detectorShape is None:
+            self.detectorShape = tuple(detectorShape)
+
+    def add(self, ddict):
+        frameId = ddict['uniqueId']
+        nPatches = ddict['patches'].shape[0]
+        rows, cols, intensity = peak_locations(ddict) if nPatches > 0 else (np.zeros(0),)*3
+        with self.lock:
+            self.frameCounts[frameId] = self.frameCounts.get(frameId, 0) + nPatches
+            if nPatches == 0:
+                return
+            self.nPeaks += nPatches
+            bins = np.clip(np.searchsorted(self.histogramEdges, intensity, side='right') - 1, 0, len(self.histogram) - 1)
+            np.add.at(self.histogram, bins, 1)
+            if self.detectorShape:
+                dr = np.clip((rows*self.densityShape[0]/self.detectorShape[0]).astype(int), 0, self.densityShape[0] - 1)
+                dc = np.clip((cols*self.densityShape[1]/self.detectorShape[1]).astype(int), 0, self.densityShape[1] - 1)
+                np.add.at(self.density, (dr, dc), 1)
+            peaks = np.stack([np.full(nPatches, frameId), rows, cols, intensity], axis=1).astype(np.float32)
+            candidates = np.concatenate([self.topPeaks[~np.isnan(self.topPeaks[:, 3])], peaks])
+            top = candidates[np.argsort(-candidates[:, 3], kind='stable')[:self.topK]]
+            self.topPeaks[:] = np.nan
+            self.topPeaks[:len(top)] = top
+
+    # the summary of the window that ends now; a new window starts
+    def getSummary(self):
+        now = time.time()
+        with self.lock:
+            frameIds = np.full(self.maxFrames, -1, dtype=np.int64)
+            frameCounts = np.zeros(self.maxFrames, dtype=np.uint32)
+            latest = sorted(self.frameCounts)[-self.maxFrames:]
+            frameIds[:len(latest)] = latest
+            frameCounts[:len(latest)] = [self.frameCounts[f] for f in latest]
+            summary = {
+                'summaryId' : self.nSummaries,
+                'windowStart' : self.windowStart,
+                'windowEnd' : now,
+                'nFrames' : len(self.frameCounts),
+                'nPeaks' : self.nPeaks,
+                'frameIds' : frameIds,
+                'frameCounts' : frameCounts,
+                'histogramEdges' : self.histogramEdges,
+                'histogram' : self.histogram,
+                'density' : self.density,
+                'topPeaks' : self.topPeaks
+            }
+            self.nSummaries += 1
+            self._startWindow(now)
+        return summary
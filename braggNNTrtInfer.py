@@ -18,10 +18,13 @@ class BraggNNTrtInfer:
 
     def process(self, in_mb):
         from trtUtil import inference
-        np.copyto(self.trt_hin, in_mb.astype(np.float32).ravel())
+        # the engine is built for a fixed batch size, partial batches are zero padded
+        n = in_mb.shape[0]
+        self.trt_hin[in_mb.size:] = 0
+        np.copyto(self.trt_hin[:in_mb.size], in_mb.astype(np.float32).ravel())
         pred = inference(self.trt_context, self.trt_hin, self.trt_hout, \
                          self.trt_din, self.trt_dout, self.trt_stream).reshape(-1, 2)
-        return pred
+        return pred[:n]
 
     def stop(self):
         try:
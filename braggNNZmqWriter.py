@@ -1,18 +1,31 @@
 import time
 import zmq
 from pvapy.hpc.userMpDataProcessor import UserMpDataProcessor
+from memoryAccounting import process_memory
+from workerProfiler import WorkerProfiler
 
 class BraggNNZmqWriter(UserMpDataProcessor):
 
-    def __init__(self, port):
+    def __init__(self, port, placement=None):
         UserMpDataProcessor.__init__(self)
         self.port = port
+        self.placement = placement
         self.context = None
         self.publisher = None
+        self.profiler = WorkerProfiler(self.__class__.__name__)
 
         self.resetStats()
 
+    def configure(self, configDict):
+        self.profiler.configure(configDict)
+
+    def stop(self):
+        self.profiler.stop()
+
     def process(self, mpqObject):
+        if self.placement:
+            self.placement.apply()
+        self.profiler.onProcess()
         if not self.context:
             self.context = zmq.Context()
             self.publisher = self.context.socket(zmq.PUB)
@@ -37,6 +50,7 @@ class BraggNNZmqWriter(UserMpDataProcessor):
             'nErrors' : self.nErrors,
             'publishTime' : publishTime
         }
+        statsDict.update(process_memory())
         return statsDict
 
     def resetStats(self):
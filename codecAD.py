@@ -14,13 +14,42 @@ import ctypes.util
 import os
 import numpy as np
 
+# numpy dtype to the codec parameter (pvData scalar type) used by decompress
+DTYPE_CODEC_TYPE_MAP = {
+    np.dtype("int8"): 1,
+    np.dtype("int16"): 2,
+    np.dtype("int32"): 3,
+    np.dtype("int64"): 4,
+    np.dtype("uint8"): 5,
+    np.dtype("uint16"): 6,
+    np.dtype("uint32"): 7,
+    np.dtype("uint64"): 8,
+    np.dtype("float32"): 9,
+    np.dtype("float64"): 10,
+}
+
 
 class CodecAD:
+    # codec libraries, loaded once per process and shared by all instances
+    LIBRARIES = dict()
+    CODEC_LIBRARIES = ("blosc", "decompressJPEG", "bitshuffle")
+
     def __init__(self):
         self.__codecName = "none"
         self.__data = None
         self.__compressRatio = 1.0
-        self.__saveLibrary = dict()
+        self.__saveLibrary = CodecAD.LIBRARIES
+
+    def preload(self):
+        """
+        load the codec libraries that are available, so that processes forked
+        afterwards do not have to search for them on their first frame.
+
+        Returns
+        -------
+            names of the libraries that were found
+        """
+        return [name for name in self.CODEC_LIBRARIES if self.__findLibrary(name) != None]
 
     def __findLibrary(self, name):
         lib = self.__saveLibrary.get(name)
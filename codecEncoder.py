@@ -0,0 +1,56 @@
+'''
+codecEncoder produces compressed frame payloads that CodecAD (and areaDetector
+clients) can decompress: blosc, lz4 (raw LZ4 block) and bslz4 (bitshuffle+LZ4,
+no header). The python packages blosc, lz4 and bitshuffle are only imported
+when the corresponding codec is used.
+'''
+
+import numpy as np
+from codecAD import DTYPE_CODEC_TYPE_MAP
+
+class CodecEncoder:
+
+    SUPPORTED_CODECS = ('blosc', 'lz4', 'bslz4')
+
+    def __init__(self, bloscCompressor='lz4', bloscLevel=5, bloscShuffle=True):
+        self.bloscCompressor = bloscCompressor
+        self.bloscLevel = bloscLevel
+        self.bloscShuffle = bloscShuffle
+
+    def getCodec(self, frame, codecName):
+        """
+        Returns
+        -------
+        codec : dict
+            codec structure (name and data type parameter) describing a frame compressed with codecName
+        """
+        return {'name' : codecName, 'parameters' : [{'value' : DTYPE_CODEC_TYPE_MAP[np.dtype(frame.dtype)]}]}
+
+    def compress(self, frame, codecName):
+        """
+        compress a frame with the given codec.
+
+        Parameters
+        ----------
+            frame:     numpy array of any shape, compressed in C order
+            codecName: one of SUPPORTED_CODECS
+
+        Returns
+        -------
+            payload : numpy uint8 array with the compressed bytes
+        """
+        data = np.ascontiguousarray(frame).reshape(-1)
+        if codecName == 'blosc':
+            import blosc
+            shuffle = blosc.SHUFFLE if self.bloscShuffle else blosc.NOSHUFFLE
+            payload = blosc.compress(data.tobytes(), typesize=data.itemsize, clevel=self.bloscLevel, \
+                                     shuffle=shuffle, cname=self.bloscCompressor)
+            return np.frombuffer(payload, dtype=np.uint8)
+        elif codecName == 'lz4':
+            import lz4.block
+            payload = lz4.block.compress(data.tobytes(), store_size=False)
+            return np.frombuffer(payload, dtype=np.uint8)
+        elif codecName == 'bslz4':
+            import bitshuffle
+            return bitshuffle.compress_lz4(data, 0).view(np.uint8)
+        raise Exception(codecName + " is unsupported codec")
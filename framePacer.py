@@ -0,0 +1,93 @@
+import time
+from collections import deque
+import numpy as np
+
+class FramePacer:
+    '''
+    Schedules frames at absolute times (no drift) with hybrid sleep/spin
+    waiting: sleep until spinTime before the deadline, then busy-wait.
+
+    With burstSize > 0, frames come in bursts of burstSize frames at frameRate
+    separated by burstPause seconds. A frameRate of 0 publishes as fast as
+    possible. Lateness of every publish relative to its schedule is recorded
+    for the achieved rate and jitter statistics: running sums and maxima over
+    all frames, and the p99 lateness over the last latenessWindow frames, so
+    that memory stays bounded on long runs.
+    '''
+
+    LATENESS_WINDOW = 10000
+
+    def __init__(self, frameRate, burstSize=0, burstPause=0.0, spinTime=0.002, latenessWindow=LATENESS_WINDOW):
+        self.delta_t = 1.0/frameRate if frameRate > 0 else 0
+        self.burstSize = burstSize
+        self.burstPause = burstPause
+        self.spinTime = spinTime
+        self.latenessWindow = latenessWindow
+        self.start()
+
+    def start(self, startTime=None):
+        self.startTime = time.time() if startTime is None else startTime
+        self.nFrames = 0
+        self.scheduledTime = self.startTime
+        self.nPublished = 0
+        self.firstPublishTime = None
+        self.lastPublishTime = None
+        self.intervalSum = 0.0
+        self.intervalSquareSum = 0.0
+        self.latenessSum = 0.0
+        self.maxLateness = 0.0
+        self.recentLateness = deque(maxlen=self.latenessWindow)
+
+    def getScheduledTime(self, n):
+        if self.burstSize > 0:
+            nBursts, k = divmod(n, self.burstSize)
+            return self.startTime + nBursts*(self.burstSize*self.delta_t + self.burstPause) + k*self.delta_t
+        return self.startTime + n*self.delta_t
+
+    # block until the next frame is due; returns its scheduled time
+    def wait(self):
+        return self.waitUntil(self.getScheduledTime(self.nFrames))
+
+    # block until the given absolute time, for schedules other than a fixed
+    # rate (e.g. replaying recorded arrival times)
+    def waitUntil(self, scheduledTime):
+        self.scheduledTime = scheduledTime
+        self.nFrames += 1
+        delay = self.scheduledTime - time.time() - self.spinTime
+        if delay > 0:
+            time.sleep(delay)
+        while time.time() < self.scheduledTime:
+            pass
+        return self.scheduledTime
+
+    def record(self, publishTime=None):
+        if publishTime is None:
+            publishTime = time.time()
+        if self.lastPublishTime is None:
+            self.firstPublishTime = publishTime
+        else:
+            interval = publishTime - self.lastPublishTime
+            self.intervalSum += interval
+            self.intervalSquareSum += interval*interval
+        self.lastPublishTime = publishTime
+        lateness = publishTime - self.scheduledTime
+        self.latenessSum += lateness
+        self.maxLateness = lateness if self.nPublished == 0 else max(self.maxLateness, lateness)
+        self.recentLateness.append(lateness)
+        self.nPublished += 1
+
+    def getStats(self):
+        n = self.nPublished
+        stats = {'nFrames' : n, 'frameRate' : 0.0, 'intervalJitter' : 0.0,
+                 'meanLateness' : 0.0, 'p99Lateness' : 0.0, 'maxLateness' : 0.0}
+        if n > 1:
+            duration = self.lastPublishTime - self.firstPublishTime
+            if duration > 0:
+                stats['frameRate'] = (n - 1)/duration
+            meanInterval = self.intervalSum/(n - 1)
+            stats['intervalJitter'] = max(self.intervalSquareSum/(n - 1) - meanInterval*meanInterval, 0.0)**0.5
+        if n > 0:
+            stats['meanLateness'] = self.latenessSum/n
+            stats['p99Lateness'] = float(np.percentile(self.recentLateness, 99))
+            stats['maxLateness'] = self.maxLateness
+        return stats
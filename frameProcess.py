@@ -1,7 +1,9 @@
 # ToDo wrap into a class from Process
+# cv2 and h5py are imported by the functions that use them, so that importing
+# this module does not load them at startup
 
 import numpy as np
-import cv2, logging, multiprocessing, time, h5py
+import logging, multiprocessing, time
 from codecAD import CodecAD
 
 # cv2 based geometric center connected component as center for crop
@@ -64,18 +66,22 @@ def frame_peak_patches_cv2(frame, psz, angle, min_intensity=0, max_r=None, min_s
     return patches, peak_ori, big_peaks
 
 
+def load_dark_frame(dark_h5):
+    if dark_h5 is None:
+        logging.info("no dark h5 file supplied, assume background was removed on DAQ")
+        return None
+    import h5py
+    with h5py.File(dark_h5, 'r') as fp:
+        dark_fr = fp['frames'][:]
+    return dark_fr.mean(axis=0)
+
+# dark_fr is the mean dark frame (see load_dark_frame), loaded once by the parent
 def frame_process_worker_func(frame_tq, psz, patch_tq, mbsz, offset_recover, min_intensity, \
-                              max_r=None, min_sz=1, frame_writer=None, dark_h5=None):
+                              max_r=None, min_sz=1, frame_writer=None, dark_fr=None):
     logging.info(f"frame process worker {multiprocessing.current_process().name} starting now")
     codecAD = CodecAD()
     patch_list = []
     patch_ori_list = []
-    if dark_h5 is not None:
-        with h5py.File(dark, 'r') as fp:
-            dark_fr = fp['frames'][:]
-        dark_fr = dark_fr[:].mean(axis=0)
-    else:
-        logging.info("no dark h5 file supplied, assume background was removed on DAQ")
 
     while True:
         try:
@@ -102,7 +108,7 @@ def frame_process_worker_func(frame_tq, psz, patch_tq, mbsz, offset_recover, min
 
         # dark is not removed, thus remove here
         # min_intensity will deal with negative pixels
-        if dark_h5 is not None:
+        if dark_fr is not None:
             frame = frame - dark_fr
 
         # dark was removed on EPICS server
@@ -0,0 +1,235 @@
+'''
+Frame sources for driving the pipeline offline (benchmarks, replay, reprocessing).
+Each source exposes nFrames, shape, dtype, chunkSize (number of frames that are
+best read together), getFrame(idx) returning a 2D array and getFrames(start, stop)
+returning a 3D array. getTruth(indices) returns the ground truth peaks of the
+given frames (see syntheticPeaks) when the source has it, and None otherwise.
+'''
+
+import os
+import numpy as np
+import h5py
+from syntheticPeaks import SyntheticPeakGenerator, TRUTH_FIELDS, concat_truth
+
+class H5FrameSource:
+
+    # frames are read from a 3D dataset (the format used by tools/daq-simu-pva.py)
+    def __init__(self, fileName, dataset='frames', preload=True):
+        self.fileName = fileName
+        self.h5fd = h5py.File(fileName, 'r')
+        self.dset = self.h5fd[dataset]
+        self.nFrames, ny, nx = self.dset.shape
+        self.shape = (ny, nx)
+        self.dtype = self.dset.dtype
+        self.chunkSize = self.dset.chunks[0] if self.dset.chunks else 1
+        self.truth = None
+        if 'truth' in self.h5fd:
+            self.truth = {key : self.h5fd['truth'][key][:] for key in TRUTH_FIELDS}
+        self.frames = None
+        if preload:
+            self.frames = self.dset[:]
+            self.close()
+
+    def getFrame(self, idx):
+        idx = idx % self.nFrames
+        if self.frames is not None:
+            return self.frames[idx]
+        return self.dset[idx]
+
+    def getFrames(self, start, stop):
+        if self.frames is not None:
+            return self.frames[start:stop]
+        return self.dset[start:stop]
+
+    def getTruth(self, indices):
+        if self.truth is None:
+            return None
+        truths = []
+        for idx in indices:
+            selected = self.truth['frame'] == idx % self.nFrames
+            truth = {key : value[selected] for key, value in self.truth.items()}
+            truth['frame'] = np.full(len(truth['row']), idx, dtype=np.int64)
+            truths.append(truth)
+        return concat_truth(truths)
+
+    def close(self):
+        if self.h5fd is not None:
+            self.h5fd.close()
+            self.h5fd = None
+
+    def describe(self):
+        return {'type' : 'h5', 'fileName' : self.fileName, 'nFrames' : self.nFrames,
+                'shape' : list(self.shape), 'dtype' : str(self.dtype)}
+
+class SparseH5FrameSource:
+
+    # frames archived by BraggNNSparseHdfWriter (CSR indptr/indices/values);
+    # dense frames or regions are rebuilt on demand, pixels that were not
+    # stored are zero (fill)
+    def __init__(self, fileName, fill=0):
+        self.fileName = fileName
+        self.h5fd = h5py.File(fileName, 'r')
+        self.shape = tuple(int(n) for n in self.h5fd.attrs['shape'])
+        self.indptr = self.h5fd['indptr'][:]
+        self.frameIds = self.h5fd['frame_ids'][:]
+        self.indices = self.h5fd['indices']
+        self.values = self.h5fd['values']
+        self.nFrames = len(self.frameIds)
+        self.dtype = self.values.dtype
+        self.fill = fill
+        self.chunkSize = 1
+
+    # index of the frame with the given uniqueId, None if not archived
+    def findFrame(self, frameId):
+        matches = np.flatnonzero(self.frameIds == frameId)
+        return int(matches[0]) if len(matches) > 0 else None
+
+    def getSparse(self, idx):
+        idx = idx % self.nFrames
+        start, stop = self.indptr[idx], self.indptr[idx + 1]
+        return self.indices[start:stop], self.values[start:stop]
+
+    def getFrame(self, idx):
+        indices, values = self.getSparse(idx)
+        frame = np.full(self.shape[0]*self.shape[1], self.fill, dtype=self.dtype)
+        frame[indices] = values
+        return frame.reshape(self.shape)
+
+    def getFrames(self, start, stop):
+        return np.array([self.getFrame(idx) for idx in range(start, stop)])
+
+    # dense [row0:row1, col0:col1] region of a frame
+    def getRegion(self, idx, row0, row1, col0, col1):
+        indices, values = self.getSparse(idx)
+        rows, cols = np.divmod(indices.astype(np.int64), self.shape[1])
+        inside = (rows >= row0) & (rows < row1) & (cols >= col0) & (cols < col1)
+        region = np.full((row1 - row0, col1 - col0), self.fill, dtype=self.dtype)
+        region[rows[inside] - row0, cols[inside] - col0] = values[inside]
+        return region
+
+    def getTruth(self, indices):
+        return None
+
+    def close(self):
+        if self.h5fd is not None:
+            self.h5fd.close()
+            self.h5fd = None
+
+    def describe(self):
+        return {'type' : 'sparse', 'fileName' : self.fileName, 'nFrames' : self.nFrames,
+                'shape' : list(self.shape), 'dtype' : str(self.dtype), 'nPixels' : int(self.indptr[-1])}
+
+class SyntheticFrameSource:
+
+    # nFrames distinct frames are generated up-front and cycled through; each
+    # one has nPeaks pseudo-Voigt peaks (syntheticPeaks.SyntheticPeakGenerator)
+    # of FWHM 2.355*peakSigma on a noisy background. fwhmSpread, etaRange and
+    # intensitySpread widen the peak size, shape and amplitude distributions.
+    def __init__(self, nFrames=16, nx=2048, ny=2048, dtype='uint16', nPeaks=200, peakSigma=1.5, peakIntensity=1000, background=10, seed=0, \
+                 fwhmSpread=0.0, etaRange=(0.0, 0.0), intensitySpread=1.0, readNoise=0.0):
+        fwhm = 2*np.sqrt(2*np.log(2))*peakSigma
+        self.nFrames = nFrames
+        self.shape = (ny, nx)
+        self.dtype = np.dtype(dtype)
+        self.nPeaks = nPeaks
+        self.peakSigma = peakSigma
+        self.peakIntensity = peakIntensity
+        self.background = background
+        self.seed = seed
+        self.chunkSize = 1
+        self.generator = SyntheticPeakGenerator(nx=nx, ny=ny, dtype=dtype, nPeaks=nPeaks, fwhm=(fwhm, fwhm + fwhmSpread), \
+                                                eta=etaRange, amplitude=(peakIntensity, peakIntensity*intensitySpread), \
+                                                background=background, readNoise=readNoise, seed=seed)
+        self.frames = []
+        self.truths = []
+        for i in range(nFrames):
+            frame, truth = self.generator.generate(i)
+            self.frames.append(frame)
+            self.truths.append(truth)
+
+    def getFrame(self, idx):
+        return self.frames[idx % self.nFrames]
+
+    def getFrames(self, start, stop):
+        return np.array([self.getFrame(idx) for idx in range(start, stop)])
+
+    # ground truth of the given frame indices, with 'frame' set to the index
+    def getTruth(self, indices):
+        truths = []
+        for idx in indices:
+            truth = dict(self.truths[idx % self.nFrames])
+            truth['frame'] = np.full(len(truth['row']), idx, dtype=np.int64)
+            truths.append(truth)
+        return concat_truth(truths)
+
+    def close(self):
+        pass
+
+    def describe(self):
+        description = {'type' : 'synthetic', 'nFrames' : self.nFrames, 'shape' : list(self.shape), 'dtype' : str(self.dtype)}
+        description.update(self.generator.describe())
+        return description
+
+class RawFrameSource:
+
+    # memory-mapped frames: a .npy file, or a raw file of (nFrames, ny, nx)
+    # frames of the given dtype after an optional header of offset bytes
+    def __init__(self, fileName, shape=None, dtype='uint16', offset=0):
+        self.fileName = fileName
+        if fileName.endswith('.npy'):
+            self.frames = np.load(fileName, mmap_mode='r')
+        else:
+            ny, nx = shape
+            frameBytes = ny*nx*np.dtype(dtype).itemsize
+            nFrames = (os.path.getsize(fileName) - offset)//frameBytes
+            self.frames = np.memmap(fileName, dtype=dtype, mode='r', offset=offset, shape=(nFrames, ny, nx))
+        self.nFrames = self.frames.shape[0]
+        self.shape = self.frames.shape[1:]
+        self.dtype = self.frames.dtype
+        self.chunkSize = 1
+
+    def getFrame(self, idx):
+        return np.asarray(self.frames[idx % self.nFrames])
+
+    def getFrames(self, start, stop):
+        return np.asarray(self.frames[start:stop])
+
+    def getTruth(self, indices):
+        return None
+
+    def close(self):
+        self.frames = None
+
+    def describe(self):
+        return {'type' : 'raw', 'fileName' : self.fileName, 'nFrames' : self.nFrames,
+                'shape' : list(self.shape), 'dtype' : str(self.dtype)}
+
+class ImageDirFrameSource:
+
+    # one detector image per file (any format fabio reads), in file name order
+    def __init__(self, directory):
+        import fabio
+        self.fabio = fabio
+        self.directory = directory
+        self.files = sorted([os.path.join(directory, f) for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))])
+        self.nFrames = len(self.files)
+        frame = self.getFrame(0)
+        self.shape = frame.shape
+        self.dtype = frame.dtype
+        self.chunkSize = 1
+
+    def getFrame(self, idx):
+        return self.fabio.open(self.files[idx % self.nFrames]).data
+
+    def getFrames(self, start, stop):
+        return np.array([self.getFrame(idx) for idx in range(start, stop)])
+
+    def getTruth(self, indices):
+        return None
+
+    def close(self):
+        pass
+
+    def describe(self):
+        return {'type' : 'directory', 'directory' : self.directory, 'nFrames' : self.nFrames,
+                'shape' : list(self.shape), 'dtype' : str(self.dtype)}
@@ -1,4 +1,4 @@
-import logging, time, threading, torch
+import logging, time, threading
 import numpy as np
 
 class inferBraggNNtrt(threading.Thread):
@@ -40,6 +40,7 @@ class inferBraggNNtrt(threading.Thread):
 
 class inferBraggNNTorch(threading.Thread):
     def __init__(self, script_pth, tq_patch, peak_writer, zmq_writer=None):
+        import torch
         threading.Thread.__init__(self)
         self.daemon = True
         self.tq_patch = tq_patch
@@ -57,6 +58,7 @@ class inferBraggNNTorch(threading.Thread):
         logging.info("PyTorch Inference engine initialization completed!")
 
     def run(self, ):
+        import torch
         while True:
             in_mb, ori_mb, frm_id = self.tq_patch.get()
             batch_tick = time.time()
@@ -1,20 +1,20 @@
 import time, queue, sys, os, multiprocessing, threading
 from collections import OrderedDict
 import argparse, logging, yaml
-import pvaccess as pva
-
-from pvaccess import Channel
 import numpy as np 
 from multiprocessing import Process, Queue
 
-from inferBraggNN import inferBraggNNtrt, inferBraggNNTorch
-from frameProcess import frame_process_worker_func
-from asyncWriter import asyncPVAPub #, asyncHDFWriter, asyncZMQWriter
+from frameProcess import frame_process_worker_func, load_dark_frame
 
 from pvaClient import pvaClient
-from trtUtil import scriptpth2onnx
 
+# pvaccess, torch, tensorrt, cv2 and h5py are imported on the paths that use them; the
+# frame workers are forked after the dark frame and inference engine are
+# loaded, so they start warm
 def main(params):
+    launch_tick = time.time()
+    from pvaccess import Channel
+    from asyncWriter import asyncPVAPub #, asyncHDFWriter, asyncZMQWriter
     logging.info(f"listen on {params['frame']['pvkey']} for frames")
     c = Channel(params['frame']['pvkey'])
     c.setMonitorMaxQueueLength(-1)
@@ -41,26 +41,36 @@ def main(params):
     frame_writer = None
 
     # initialize pva, it pushes frames into tq_frame
-    pva_client = pvaClient(tq_frame=tq_frame, dtype=params['frame']['datatype'])
+    recorder = None
+    if params['frame'].get('record'):
+        from streamRecorder import StreamRecorder
+        recorder = StreamRecorder(params['frame']['record'], maxQueued=params['frame'].get('record_queue', 1000))
+    pva_client = pvaClient(tq_frame=tq_frame, dtype=params['frame']['datatype'], recorder=recorder)
 
     # initialize inference engine, which consumes patches from tq_patch
     if params['infer']['tensorrt']:
+        from inferBraggNN import inferBraggNNtrt
+        from trtUtil import scriptpth2onnx
         onnx_fn = scriptpth2onnx(pth=params['model']['model_fname'], mbsz=params['infer']['mbsz'], psz=params['model']['psz'])
         infer_engine = inferBraggNNtrt(mbsz=params['infer']['mbsz'], onnx_mdl=onnx_fn, tq_patch=tq_patch, \
                                        peak_writer=writer, zmq_writer=None)
     else:
+        from inferBraggNN import inferBraggNNTorch
         infer_engine = inferBraggNNTorch(script_pth=params['model']['model_fname'], tq_patch=tq_patch, \
                                          peak_writer=writer, zmq_writer=None)
     infer_engine.start()
 
-    # start a pool of processes to digest frame from tq_frame and push patches into tq_patch
+    # start a pool of processes to digest frame from tq_frame and push patches into tq_patch;
+    # the dark frame is loaded once, workers share it
+    dark_fr = load_dark_frame(params['frame']['dark_h5'])
     for _ in range(params['frame']['nproc']):
         p = Process(target=frame_process_worker_func, \
                     args=(tq_frame, params['model']['psz'], tq_patch, params['infer']['mbsz'], \
                           params['frame']['offset_recover'], params['frame']['min_intensity'], \
-                          params['frame']['max_radius'], params['frame']['min_peak_sz'], frame_writer, params['frame']['dark_h5']),
+                          params['frame']['max_radius'], params['frame']['min_peak_sz'], frame_writer, dark_fr),
                     daemon=True)
         p.start()
+    logging.info("pipeline started in %.3f seconds" % (time.time() - launch_tick))
 
     c.subscribe('monitor', pva_client.monitor)
     c.startMonitor('')
@@ -87,6 +97,8 @@ def main(params):
     time.sleep(1) # give processes seconds to exit
     c.stopMonitor()
     c.unsubscribe('monitor')
+    if recorder is not None:
+        recorder.stop()
 
 
 if __name__ == '__main__':
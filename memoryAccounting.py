@@ -0,0 +1,102 @@
+'''
+Memory accounting for the pipeline: items and bytes in flight per queue, and
+resident memory per process.
+
+TrackedQueue is a multiprocessing queue that counts the items and payload
+bytes (numpy arrays, bytes, and containers of them) put but not yet taken,
+with high-water marks; the counters are shared, so producers and consumers in
+different processes see the same values. process_memory() reads the RSS and
+peak RSS of the calling process from /proc. Memory thresholds are configured
+in yaml:
+
+memory:
+  warn_rss: 0.8          # total RSS of this consumer's processes; fraction of physical memory if <= 1, bytes otherwise
+  warn_queue_bytes: 1e9  # bytes in flight in any one queue or buffer
+'''
+
+import multiprocessing as mp
+import multiprocessing.queues
+import os
+import numpy as np
+
+QUEUE_STATS_FIELDS = ('nItems', 'nBytes', 'maxItems', 'maxBytes')
+
+def payload_nbytes(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if isinstance(obj, memoryview):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(payload_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(payload_nbytes(v) for v in obj)
+    return 0
+
+# rss and peak rss (VmHWM) of the calling process in bytes
+def process_memory():
+    memory = {'rss' : 0, 'peakRss' : 0}
+    try:
+        with open('/proc/self/status', 'r') as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    memory['rss'] = int(line.split()[1])*1024
+                elif line.startswith('VmHWM:'):
+                    memory['peakRss'] = int(line.split()[1])*1024
+    except OSError:
+        pass
+    return memory
+
+def physical_memory():
+    return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+
+class TrackedQueue(multiprocessing.queues.Queue):
+
+    def __init__(self, maxsize=-1, name=None):
+        multiprocessing.queues.Queue.__init__(self, maxsize, ctx=mp.get_context())
+        self.name = name
+        # nItems, nBytes, maxItems, maxBytes
+        self.counters = mp.Array('q', len(QUEUE_STATS_FIELDS))
+
+    def __getstate__(self):
+        return multiprocessing.queues.Queue.__getstate__(self) + (self.name, self.counters)
+
+    def __setstate__(self, state):
+        multiprocessing.queues.Queue.__setstate__(self, state[:-2])
+        self.name, self.counters = state[-2:]
+
+    def _count(self, nItems, nBytes):
+        with self.counters.get_lock():
+            counters = self.counters
+            counters[0] += nItems
+            counters[1] += nBytes
+            counters[2] = max(counters[2], counters[0])
+            counters[3] = max(counters[3], counters[1])
+
+    # counted before the item is queued, so that a consumer never sees it uncounted
+    def put(self, obj, block=True, timeout=None):
+        nBytes = payload_nbytes(obj)
+        self._count(1, nBytes)
+        try:
+            multiprocessing.queues.Queue.put(self, obj, block, timeout)
+        except BaseException:
+            self._count(-1, -nBytes)
+            raise
+
+    def get(self, block=True, timeout=None):
+        obj = multiprocessing.queues.Queue.get(self, block, timeout)
+        self._count(-1, -payload_nbytes(obj))
+        return obj
+
+    def getStats(self, keyPrefix=None):
+        keyPrefix = keyPrefix or f'{self.name}_'
+        with self.counters.get_lock():
+            values = list(self.counters)
+        return {f'{keyPrefix}{field}' : value for field, value in zip(QUEUE_STATS_FIELDS, values)}
+
+    # high-water marks restart from the current contents
+    def resetStats(self):
+        with self.counters.get_lock():
+            self.counters[2] = self.counters[0]
+            self.counters[3] = self.counters[1]
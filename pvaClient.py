@@ -2,12 +2,14 @@ import logging
 from multiprocessing import Queue
 
 class pvaClient:
-    def __init__(self, tq_frame, dtype):
+    # recorder (streamRecorder.StreamRecorder), if given, logs frames as received
+    def __init__(self, tq_frame, dtype, recorder=None):
         self.frames_processed = 0
         self.base_seq_id = None
         self.recv_frames = 0
         self.tq_frame = tq_frame
         self.dtype = dtype
+        self.recorder = recorder
 
     # this function will be triggered to call by pva when there is a new frame
     def monitor(self, pv):
@@ -22,13 +24,16 @@ class pvaClient:
         cols  = dims[1]['size']
         codec = pv["codec"]
         if len(codec['name']) > 0:
-            data_codec   = pv['value'][0]['ubyteValue']
+            fieldKey     = 'ubyteValue'
             compressed   = pv["compressedSize"]
             uncompressed = pv["uncompressedSize"]
         else:
+            fieldKey     = self.dtype
             compressed   = None
             uncompressed = None
-            data_codec   = pv['value'][0][self.dtype]
+        data_codec = pv['value'][0][fieldKey]
+        if self.recorder is not None:
+            self.recorder.record(frm_id, data_codec, codec, compressed, uncompressed, (rows, cols), fieldKey)
 
         self.tq_frame.put((frm_id, data_codec, compressed, uncompressed, codec, rows, cols))
         logging.info("received frame %d, total frame received: %d, should have received: %d; %d frames pending process" % (\
@@ -0,0 +1,79 @@
+'''
+Local stand-ins for the pvAccess objects used by BraggNNInferImageProcessor,
+so that the processing pipeline can be driven without a PVA server/client.
+'''
+
+import time
+import numpy as np
+from codecAD import DTYPE_CODEC_TYPE_MAP
+
+class StandInNtNdArray:
+
+    PVA_TYPE_KEY_MAP = {
+        np.dtype('uint8')   : 'ubyteValue',
+        np.dtype('int8')    : 'byteValue',
+        np.dtype('uint16')  : 'ushortValue',
+        np.dtype('int16')   : 'shortValue',
+        np.dtype('uint32')  : 'uintValue',
+        np.dtype('int32')   : 'intValue',
+        np.dtype('uint64')  : 'ulongValue',
+        np.dtype('int64')   : 'longValue',
+        np.dtype('float32') : 'floatValue',
+        np.dtype('float64') : 'doubleValue'
+    }
+
+    # frame: 2D (ny, nx) array; if codecName is given, payload holds the
+    # compressed bytes and frame is only used for its shape and dtype
+    def __init__(self, uniqueId, frame, codecName='', payload=None, timeStamp=None):
+        ny, nx = frame.shape
+        dtype = np.dtype(frame.dtype)
+        if codecName:
+            value = np.frombuffer(payload, dtype=np.uint8)
+            fieldKey = 'ubyteValue'
+            compressedSize = value.nbytes
+        else:
+            value = frame.reshape(-1)
+            fieldKey = self.PVA_TYPE_KEY_MAP[dtype]
+            compressedSize = frame.nbytes
+        if timeStamp is None:
+            timeStamp = time.time()
+        self.fieldKey = fieldKey
+        self.fields = {
+            'uniqueId' : uniqueId,
+            'dimension' : [{'size' : nx}, {'size' : ny}],
+            'codec' : {'name' : codecName, 'parameters' : [{'value' : DTYPE_CODEC_TYPE_MAP[dtype]}]},
+            'compressedSize' : compressedSize,
+            'uncompressedSize' : frame.nbytes,
+            'value' : [{fieldKey : value}],
+            'timeStamp' : {'secondsPastEpoch' : int(timeStamp), 'nanoseconds' : int((timeStamp % 1)*1e9)}
+        }
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    def __setitem__(self, key, value):
+        self.fields[key] = value
+
+    def getSelectedUnionFieldName(self):
+        return self.fieldKey
+
+class StandInPvaServer:
+
+    def __init__(self):
+        self.records = {}
+        self.nUpdates = 0
+        self.lastUpdateTime = 0
+
+    def addRecord(self, channel, pvObject):
+        self.records[channel] = pvObject
+
+    def update(self, channel, pvObject):
+        self.records[channel] = pvObject
+        self.nUpdates += 1
+        self.lastUpdateTime = time.time()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
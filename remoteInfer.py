@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+'''
+Remote inference over ZMQ: frame processing nodes without accelerators ship
+their patch batches to an inference node, which localizes them with the usual
+engines (braggNNInferEngine.py, including model routes).
+
+infer:
+  remote:
+    address: tcp://infer-node:5560  # RemoteInferServer of the inference node
+    credits: 4                      # batches in flight per producer (capped by the server)
+    timeout: 10                     # seconds to wait for credit or results before giving up
+
+Batches are sent as three message parts, a BATCH_HEADER and the raw patch
+(N, 1, psz, psz, in their own dtype) and origin (N, 3 float32) buffers, without
+pickling or copies. Flow control is credit based: a producer may only have as
+many batches in flight as it was granted credits (CREDIT, in reply to HELLO),
+and every RESULT returns one credit; a slow server thus holds the producers
+back, instead of queueing batches without bound. If the server does not answer
+for 'timeout' seconds, the batches in flight and those submitted until the
+server answers again are passed on without locations.
+
+Results carry the (N, 2) locations relative to the patch size, like
+engine.process(). A server started with a publish port sends the localized
+batches (the ddicts of the peak outputs, with 'uniqueId' and 'producer') to
+the writers over ZMQ PUB instead, in the format of BraggNNZmqWriter, and only
+returns empty RESULTs to the producers. A batch the server cannot decode or
+localize is answered with a FAILED RESULT, which returns its credit; the
+producer drops that batch.
+
+Inference node:
+    python remoteInfer.py -cfg config/sim.sf.yaml -bind tcp://*:5560 [-publish_port 5679]
+'''
+
+import argparse, os, socket, struct, sys, threading, time
+import numpy as np
+import yaml
+import zmq
+from pvapy.utility.loggingManager import LoggingManager
+from braggNNInferEngine import create_infer_engines, get_model_routes, peak_batch
+
+MAGIC = b'EBRI'
+# magic, message type, flags, batch sequence number, frame id (uniqueId),
+# number of patches (credits for CREDIT), patch size, patch dtype (numpy dtype.str)
+BATCH_HEADER = struct.Struct('<4sBBqqIH8s')
+HELLO, CREDIT, BATCH, RESULT = range(4)
+LAST_BATCH, HAS_LOCATIONS, FORWARDED, FAILED = 1, 2, 4, 8
+
+def encode_header(msgType, flags=0, seq=0, frameId=0, n=0, psz=0, dtype=''):
+    return BATCH_HEADER.pack(MAGIC, msgType, flags, seq, frameId, n, psz, dtype.encode())
+
+def decode_header(buffer):
+    magic, msgType, flags, seq, frameId, n, psz, dtype = BATCH_HEADER.unpack(buffer)
+    if magic != MAGIC:
+        raise Exception('Not a remote inference message')
+    return msgType, flags, seq, frameId, n, psz, dtype.rstrip(b'\0').decode()
+
+def encode_batch(seq, frameId, lastBatch, in_mb, ori_mb):
+    in_mb = np.ascontiguousarray(in_mb)
+    header = encode_header(BATCH, LAST_BATCH if lastBatch else 0, seq, frameId, in_mb.shape[0], in_mb.shape[-1], in_mb.dtype.str)
+    return [header, in_mb, np.ascontiguousarray(ori_mb, dtype=np.float32)]
+
+def decode_batch(frames):
+    msgType, flags, seq, frameId, n, psz, dtype = decode_header(frames[0])
+    in_mb = np.frombuffer(frames[1], dtype=np.dtype(dtype)).reshape((n, 1, psz, psz))
+    ori_mb = np.frombuffer(frames[2], dtype=np.float32).reshape((n, 3))
+    return seq, frameId, bool(flags & LAST_BATCH), in_mb, ori_mb
+
+class RemoteInferClient:
+
+    def __init__(self, address, credits=4, timeout=10.0, name=None):
+        self.logger = LoggingManager.getLogger(self.__class__.__name__)
+        self.address = address
+        self.requestedCredits = credits
+        self.timeout = timeout
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}'
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(address)
+        # seq => (in_mb, ori_mb, frameId, lastBatch, send time)
+        self.pending = {}
+        self.seq = 0
+        self.credits = 0
+        # until the server fails to answer in time
+        self.available = True
+        self.resetStats()
+        self._hello()
+
+    def _hello(self):
+        self.socket.send_multipart([encode_header(HELLO, n=self.requestedCredits), self.name.encode()])
+
+    # batches given back by the server (or given up on) since the last call, as
+    # (in_mb, ori_mb, frameId, lastBatch, pred, forwarded); pred is None if
+    # the batch was not localized
+    def poll(self, timeout=0):
+        results = []
+        while self.socket.poll(int(1000*timeout)):
+            timeout = 0
+            frames = self.socket.recv_multipart(copy=False)
+            msgType, flags, seq, frameId, n, psz, dtype = decode_header(frames[0].buffer)
+            replyTime = time.time()
+            if msgType == CREDIT:
+                # a (re)grant replaces whatever was outstanding before
+                self.logger.debug(f'Remote inference server {self.address} granted {n} credits')
+                results += self._expire()
+                self.credits = n
+                self.available = True
+            elif msgType == RESULT:
+                if seq not in self.pending:
+                    continue
+                in_mb, ori_mb, frameId, lastBatch, sendTime = self.pending.pop(seq)
+                self.credits += 1
+                if flags & FAILED:
+                    self.nBatchesFailed += 1
+                    self.logger.error(f'Remote inference server {self.address} failed to process batch {seq} of frame {frameId}, batch is dropped')
+                    continue
+                pred = None
+                if flags & HAS_LOCATIONS:
+                    pred = np.frombuffer(frames[1].buffer, dtype=np.float32).reshape((n, 2))
+                self.nBatchesReturned += 1
+                self.roundTripTimeSum += replyTime - sendTime
+                results.append((in_mb, ori_mb, frameId, lastBatch, pred, bool(flags & FORWARDED)))
+        return results
+
+    # batches in flight are given up on, and returned without locations
+    def _expire(self):
+        results = [(in_mb, ori_mb, frameId, lastBatch, None, False) for in_mb, ori_mb, frameId, lastBatch, sendTime in self.pending.values()]
+        self.nBatchesExpired += len(results)
+        self.pending = {}
+        return results
+
+    # sends a batch once a credit is available, returning the results received
+    # meanwhile; if the server does not answer in time, the batch is returned
+    # right away without locations
+    def submit(self, in_mb, ori_mb, frameId, lastBatch):
+        results = self.poll()
+        if self.credits == 0 and self.available:
+            t0 = time.time()
+            while self.credits == 0 and time.time() - t0 < self.timeout:
+                results += self.poll(timeout=max(0, self.timeout - (time.time() - t0)))
+            self.creditWaitTimeSum += time.time() - t0
+            if self.credits == 0:
+                self.logger.error(f'Remote inference server {self.address} is not responding, batches are passed on without locations')
+                self.available = False
+                results += self._expire()
+                self._hello()
+        if self.credits == 0:
+            self.nBatchesNotSent += 1
+            results.append((in_mb, ori_mb, frameId, lastBatch, None, False))
+            return results
+        self.seq += 1
+        self.socket.send_multipart(encode_batch(self.seq, frameId, lastBatch, in_mb, ori_mb), copy=False)
+        self.pending[self.seq] = (in_mb, ori_mb, frameId, lastBatch, time.time())
+        self.credits -= 1
+        self.nBatchesSent += 1
+        self.nBytesSent += in_mb.nbytes + ori_mb.nbytes + BATCH_HEADER.size
+        return results
+
+    def getNumPending(self):
+        return len(self.pending)
+
+    # waits for the batches in flight; those not returned in time are given up on
+    def flush(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        results = []
+        t0 = time.time()
+        while self.pending and time.time() - t0 < timeout:
+            results += self.poll(timeout=max(0, timeout - (time.time() - t0)))
+        return results + self._expire()
+
+    def close(self):
+        self.socket.close()
+        self.context.term()
+
+    def getStats(self):
+        roundTripTime = 0.0
+        if self.nBatchesReturned > 0:
+            roundTripTime = self.roundTripTimeSum/self.nBatchesReturned
+        return {
+            'nRemoteBatchesSent' : self.nBatchesSent,
+            'nRemoteBatchesReturned' : self.nBatchesReturned,
+            'nRemoteBatchesExpired' : self.nBatchesExpired,
+            'nRemoteBatchesFailed' : self.nBatchesFailed,
+            'nRemoteBatchesNotSent' : self.nBatchesNotSent,
+            'nRemoteBytesSent' : self.nBytesSent,
+            'remoteRoundTripTime' : roundTripTime,
+            'remoteCreditWaitTime' : self.creditWaitTimeSum
+        }
+
+    def resetStats(self):
+        self.nBatchesSent = 0
+        self.nBatchesReturned = 0
+        self.nBatchesExpired = 0
+        self.nBatchesFailed = 0
+        self.nBatchesNotSent = 0
+        self.nBytesSent = 0
+        self.roundTripTimeSum = 0.0
+        self.creditWaitTimeSum = 0.0
+
+class RemoteInferServer:
+
+    POLL_TIME = 0.1
+
+    def __init__(self, params, address, credits=4, publishPort=None):
+        self.logger = LoggingManager.getLogger(self.__class__.__name__)
+        self.params = params
+        self.address = address
+        self.credits = credits
+        self.publishPort = publishPort
+        self.outputPsz = max(get_model_routes(params))
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(address)
+        self.publisher = None
+        if publishPort:
+            self.publisher = self.context.socket(zmq.PUB)
+            self.publisher.bind(f'tcp://*:{publishPort}')
+        # producer identity => name given in HELLO
+        self.producers = {}
+        self.missingPsz = set()
+        self.isDone = False
+        self.resetStats()
+
+    def _reply(self, identity, header, *parts):
+        self.socket.send_multipart([identity, header, *parts], copy=False)
+
+    def _localize(self, identity, frames):
+        seq, frameId, lastBatch, in_mb, ori_mb = decode_batch([f.buffer for f in frames])
+        psz = in_mb.shape[-1]
+        engine = self.engines.get(psz)
+        if engine is None and psz not in self.missingPsz:
+            self.missingPsz.add(psz)
+            self.logger.warning(f'No inference engine for patch size {psz}, batches are returned without locations')
+        t0 = time.time()
+        pred = engine.process(in_mb) if engine is not None and len(in_mb) > 0 else None
+        self.inferTimeSum += time.time() - t0
+        self.nBatchesProcessed += 1
+        self.nPatchesProcessed += len(in_mb)
+        producer = self.producers.get(identity, identity.hex())
+        if self.publisher:
+            ddict = peak_batch(in_mb, ori_mb, pred, self.outputPsz)
+            ddict.update({'ori' : ori_mb, 'uniqueId' : frameId, 'lastBatch' : lastBatch, 'producer' : producer})
+            self.publisher.send_pyobj(ddict)
+            self._reply(identity, encode_header(RESULT, FORWARDED, seq, frameId, len(in_mb), psz))
+        elif pred is not None:
+            pred = np.ascontiguousarray(pred, dtype=np.float32)
+            self._reply(identity, encode_header(RESULT, HAS_LOCATIONS, seq, frameId, len(in_mb), psz), pred)
+        else:
+            self._reply(identity, encode_header(RESULT, 0, seq, frameId, len(in_mb), psz))
+
+    def run(self):
+        # engines are created in the serving thread (TensorRT contexts are per thread)
+        self.engines = create_infer_engines(self.params)
+        self.logger.info(f'Serving inference for patch sizes {list(self.engines)} on {self.address}' + \
+                         (f', publishing results on port {self.publishPort}' if self.publisher else ''))
+        try:
+            while not self.isDone:
+                if not self.socket.poll(int(1000*self.POLL_TIME)):
+                    continue
+                identity, *frames = self.socket.recv_multipart(copy=False)
+                identity = identity.bytes
+                try:
+                    msgType, flags, seq, frameId, n, psz, dtype = decode_header(frames[0].buffer)
+                    if msgType == HELLO:
+                        n = min(n or self.credits, self.credits)
+                        self.producers[identity] = frames[1].bytes.decode() if len(frames) > 1 else identity.hex()
+                        self.logger.info(f'Producer {self.producers[identity]} connected, {n} credits')
+                        self._reply(identity, encode_header(CREDIT, n=n))
+                    elif msgType == BATCH:
+                        try:
+                            self._localize(identity, frames)
+                        except Exception:
+                            # the producer gets its credit back and drops the batch
+                            self._reply(identity, encode_header(RESULT, FAILED, seq, frameId, n, psz))
+                            raise
+                except Exception as ex:
+                    self.nErrors += 1
+                    self.logger.error(f'Cannot process message from {self.producers.get(identity, identity.hex())}: {ex}')
+        finally:
+            for engine in self.engines.values():
+                if engine is not None:
+                    engine.stop()
+
+    def stop(self):
+        self.isDone = True
+
+    def close(self):
+        self.socket.close()
+        if self.publisher:
+            self.publisher.close()
+        self.context.term()
+
+    def getStats(self):
+        inferTime = 0.0
+        if self.nBatchesProcessed > 0:
+            inferTime = self.inferTimeSum/self.nBatchesProcessed
+        return {
+            'nProducers' : len(self.producers),
+            'nBatchesProcessed' : self.nBatchesProcessed,
+            'nPatchesProcessed' : self.nPatchesProcessed,
+            'inferTime' : inferTime,
+            'nErrors' : self.nErrors
+        }
+
+    def resetStats(self):
+        self.nBatchesProcessed = 0
+        self.nPatchesProcessed = 0
+        self.inferTimeSum = 0.0
+        self.nErrors = 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serve BraggNN inference to remote frame processing nodes')
+    parser.add_argument('-cfg',       type=str, required=True, help='yaml config file (infer and model sections)')
+    parser.add_argument('-bind',      type=str, default='tcp://*:5560', help='address producers connect to')
+    parser.add_argument('-credits',   type=int, default=4, help='max batches in flight per producer')
+    parser.add_argument('-publish_port', type=int, default=None, help='publish results to the writers on this port instead of returning them')
+    parser.add_argument('-report_period', type=float, default=10, help='seconds between stats reports; <=0 for no reports')
+
+    args, unparsed = parser.parse_known_args()
+    if len(unparsed) > 0:
+        print('Unrecognized argument(s): \n%s \nProgram exiting ... ... ' % '\n'.join(unparsed))
+        exit(0)
+
+    params = yaml.load(open(args.cfg, 'r'), Loader=yaml.CLoader)
+    server = RemoteInferServer(params, args.bind, credits=args.credits, publishPort=args.publish_port)
+    if args.report_period > 0:
+        def report():
+            while not server.isDone:
+                time.sleep(args.report_period)
+                print(server.getStats(), file=sys.stderr)
+        threading.Thread(target=report, daemon=True).start()
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    server.close()
+    print(server.getStats(), file=sys.stderr)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+'''
+Offline reprocessing of archived scans.
+
+Frames are read directly from disk (an h5 frames dataset read in chunk-aligned
+blocks, a sparse frame archive, a memory-mapped raw/.npy file, or a directory
+of detector images) by a pool of processes running BraggNNFrameProcessor;
+patch batches are localized by the configured inference engine and written to
+an h5 peaks file.
+
+Progress is recorded per block of frames in <output>.progress.json, so an
+interrupted run continues from where it stopped with -resume.
+'''
+
+import argparse, json, logging, multiprocessing as mp, os, queue, sys, time
+import numpy as np
+import h5py
+import yaml
+
+from autotune import apply_tuning
+from braggNNFrameProcessor import BraggNNFrameProcessor
+from braggNNHdfWriter import BraggNNHdfWriter
+from braggNNInferEngine import create_infer_engines, get_model_routes, localize_batch
+from frameSource import H5FrameSource, RawFrameSource, ImageDirFrameSource, SparseH5FrameSource
+
+def open_source(args):
+    if args.raw:
+        return RawFrameSource(args.ifn, shape=args.raw_shape, dtype=args.raw_dtype, offset=args.raw_offset)
+    if os.path.isdir(args.ifn):
+        return ImageDirFrameSource(args.ifn)
+    with h5py.File(args.ifn, 'r') as h5fd:
+        isSparse = 'indptr' in h5fd
+    if isSparse:
+        return SparseH5FrameSource(args.ifn)
+    return H5FrameSource(args.ifn, dataset=args.dataset, preload=False)
+
+def get_tasks(start, stop, framesPerTask, chunkSize):
+    # task boundaries are multiples of the (chunk aligned) task size, so that
+    # every read covers whole h5 chunks and blocks are the same across resumes
+    framesPerTask = max(1, -(-framesPerTask // chunkSize)) * chunkSize
+    tasks = []
+    for t0 in range((start // framesPerTask)*framesPerTask, stop, framesPerTask):
+        tasks.append((max(t0, start), min(t0 + framesPerTask, stop)))
+    return tasks
+
+def frame_worker(args, params, task_q, patch_q):
+    source = open_source(args)
+    ny, nx = source.shape
+    routes = get_model_routes(params)
+    # sparse archives hold pixels that were already dark subtracted / offset
+    # recovered, they must not be corrected again
+    corrected = isinstance(source, SparseH5FrameSource)
+    processor = BraggNNFrameProcessor(
+        psz=max(routes),
+        psz_routes=list(routes),
+        mbsz=params['infer']['mbsz'],
+        offset_recover=0 if corrected else params['frame']['offset_recover'],
+        min_intensity=params['frame']['min_intensity'],
+        max_radius=params['frame']['max_radius'],
+        min_peak_sz=params['frame']['min_peak_sz'],
+        dark_h5=None if corrected else params['frame']['dark_h5'],
+        patch_q=patch_q, write_q=None,
+        sparse=params['frame'].get('sparse', False))
+    codec = {'name' : ''}
+    while True:
+        task = task_q.get()
+        if task is None:
+            break
+        start, stop = task
+        frames = source.getFrames(start, stop)
+        for i, frame in enumerate(frames):
+            processor.process((start + i, np.array(frame).reshape(-1), None, None, codec, ny, nx))
+        # the marker follows the task's batches through the same queue
+        patch_q.put((None, None, task, None))
+    source.close()
+
+class Progress:
+
+    def __init__(self, fileName, resume):
+        self.fileName = fileName
+        self.completed = []
+        if resume and os.path.exists(fileName):
+            with open(fileName, 'r') as fp:
+                self.completed = [tuple(t) for t in json.load(fp)['completed']]
+
+    def isCompleted(self, task):
+        return task in self.completed
+
+    def add(self, task):
+        self.completed.append(task)
+        tmpName = self.fileName + '.tmp'
+        with open(tmpName, 'w') as fp:
+            json.dump({'completed' : sorted(self.completed)}, fp)
+        os.replace(tmpName, self.fileName)
+
+def run(args):
+    params = yaml.load(open(args.cfg, 'r'), Loader=yaml.CLoader)
+    if params['infer'].get('autotune'):
+        apply_tuning(params)
+    source = open_source(args)
+    nFrames, chunkSize = source.nFrames, source.chunkSize
+    logging.info(f"{nFrames} frames of {source.shape} {source.dtype} in {args.ifn}, chunk of {chunkSize} frames")
+    source.close()
+
+    stop = nFrames if args.stop is None else min(args.stop, nFrames)
+    progress = Progress(args.output + '.progress.json', args.resume)
+    tasks = [t for t in get_tasks(args.start, stop, args.frames_per_task, chunkSize) if not progress.isCompleted(t)]
+    logging.info(f"{len(tasks)} blocks of frames to process, {len(progress.completed)} blocks already done")
+
+    task_q = mp.Queue()
+    patch_q = mp.Queue(maxsize=args.max_batches_queued)
+    for task in tasks:
+        task_q.put(task)
+    workers = []
+    for i in range(args.nproc):
+        task_q.put(None)
+        p = mp.Process(target=frame_worker, args=(args, params, task_q, patch_q), daemon=True)
+        p.start()
+        workers.append(p)
+
+    engines = create_infer_engines(params)
+    psz = max(engines)
+    writer = BraggNNHdfWriter('peak', fileName=args.output, compression=False, fileMode='a' if args.resume else 'w')
+
+    # results are kept per frame until the block they belong to is complete,
+    # then written in frame order
+    pending = {}
+    nTasksDone = 0
+    nFramesDone = 0
+    nPatches = 0
+    inferTimeSum = 0.0
+    t0 = time.time()
+    while nTasksDone < len(tasks):
+        try:
+            in_mb, ori_mb, frm_id, lastBatch = patch_q.get(timeout=1)
+        except queue.Empty:
+            if not any(p.is_alive() for p in workers):
+                logging.error('all frame workers exited before finishing')
+                break
+            continue
+        if in_mb is None:
+            start, stop = frm_id
+            for fid in range(start, stop):
+                for ddict in pending.pop(fid, []):
+                    writer.process(ddict)
+            if writer.h5fd is not None:
+                writer.h5fd.flush()
+            progress.add(frm_id)
+            nTasksDone += 1
+            nFramesDone += stop - start
+            elapsed = time.time() - t0
+            logging.info(f"frames {start}-{stop-1} done, {nFramesDone/elapsed:.1f} frames/s, {nPatches/elapsed:.1f} patches/s")
+            continue
+        if in_mb.shape[0] == 0:
+            continue
+        tick = time.time()
+        ddict = localize_batch(engines, in_mb, ori_mb, psz)
+        inferTimeSum += time.time() - tick
+        if 'ploc' not in ddict:
+            ddict['ploc'] = ori_mb
+        pending.setdefault(frm_id, []).append(ddict)
+        nPatches += in_mb.shape[0]
+
+    for p in workers:
+        p.join(timeout=1)
+    writer.stop()
+    for engine in engines.values():
+        if engine is not None:
+            engine.stop()
+    elapsed = time.time() - t0
+    summary = {
+        'nFrames' : nFramesDone,
+        'nPatches' : nPatches,
+        'elapsed' : elapsed,
+        'frameRate' : nFramesDone/elapsed if elapsed > 0 else 0.0,
+        'patchRate' : nPatches/elapsed if elapsed > 0 else 0.0,
+        'inferTime' : inferTimeSum
+    }
+    logging.info(f"done: {json.dumps(summary)}")
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='offline Bragg peak reprocessing of archived scans')
+    parser.add_argument('-cfg',       type=str, required=True, help='yaml config file (frame, model and infer sections are used)')
+    parser.add_argument('-ifn',       type=str, required=True, help='h5 file, raw/.npy file, or directory of detector images')
+    parser.add_argument('-output',    type=str, required=True, help='h5 file for peaks')
+    parser.add_argument('-dataset',   type=str, default='frames', help='name of the frames dataset in the h5 file')
+    parser.add_argument('-raw',       action='store_true', help='input is a raw (or .npy) file, memory-mapped')
+    parser.add_argument('-raw_shape', type=int, nargs=2, default=None, help='ny nx of raw frames')
+    parser.add_argument('-raw_dtype', type=str, default='uint16', help='data type of raw frames')
+    parser.add_argument('-raw_offset',type=int, default=0, help='header bytes to skip in the raw file')
+    parser.add_argument('-nproc',     type=int, default=mp.cpu_count(), help='number of frame processing processes')
+    parser.add_argument('-frames_per_task', type=int, default=64, help='frames per block, rounded up to whole h5 chunks')
+    parser.add_argument('-max_batches_queued', type=int, default=1024, help='bound on patch batches waiting for inference')
+    parser.add_argument('-start',     type=int, default=0, help='first frame index to process')
+    parser.add_argument('-stop',      type=int, default=None, help='frame index to stop at (exclusive)')
+    parser.add_argument('-resume',    action='store_true', help='skip blocks recorded as done and append to the output')
+    parser.add_argument('-verbose',   type=int, default=1, help='non-zero to print logs to stdout')
+
+    args, unparsed = parser.parse_known_args()
+    if len(unparsed) > 0:
+        print('Unrecognized argument(s): \n%s \nProgram exiting ... ... ' % '\n'.join(unparsed))
+        exit(0)
+
+    logging.basicConfig(filename='edgeBragg-reprocess.log', level=logging.INFO,\
+                        format='%(asctime)s %(levelname)s %(module)s: %(message)s',)
+    if args.verbose != 0:
+        logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+    run(args)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+'''
+Stitches the shard files written by several consumers (output.shard, e.g.
+peaks.shard1.h5 ... peaks.shard4.h5) into one file that presents them, via
+HDF5 virtual datasets, as a single frame-ordered output; no data is copied.
+
+Rows are ordered by frame id (the angle column of 'ori'/'ploc' for peak files,
+'angle' for dense frame files), and within a frame by shard and row. Datasets
+with one row per peak/frame are mapped run by run in that order; other datasets
+(e.g. 'groups') are concatenated in shard order. Sparse frame archives
+(BraggNNSparseHdfWriter) get a real, recomputed 'indptr' and 'frame_ids', and
+virtual 'indices'/'values', so that frameSource.SparseH5FrameSource reads the
+stitched file as it reads a single archive.
+
+The stitched file also holds the index: 'index/runs' rows of (shard, first
+source row, first row, number of rows), with the shard file names in the
+'shards' attribute. Shard files are referenced relative to the stitched file,
+so they should be kept (or moved) together with it.
+
+    python stitchShards.py -o peaks.h5 peaks.shard*.h5
+'''
+
+import argparse, json, os, sys
+import numpy as np
+import h5py
+
+# datasets holding the frame id of every row, in order of preference
+FRAME_ID_KEYS = ('ori', 'ploc', 'angle')
+
+def shard_frame_ids(h5fd):
+    for key in FRAME_ID_KEYS:
+        if key in h5fd:
+            return h5fd[key][:, 0].astype(np.int64), key
+    raise Exception(f'{h5fd.filename} has none of the frame id datasets {FRAME_ID_KEYS}')
+
+# frame-ordered runs of consecutive source rows: arrays of shard index, first
+# source row, first destination row and number of rows
+def frame_order_runs(frameIdsList):
+    frameIds = np.concatenate(frameIdsList)
+    shard = np.concatenate([np.full(len(ids), s, dtype=np.int64) for s, ids in enumerate(frameIdsList)])
+    row = np.concatenate([np.arange(len(ids), dtype=np.int64) for ids in frameIdsList])
+    if len(frameIds) == 0:
+        return (np.zeros(0, dtype=np.int64),)*4
+    order = np.lexsort((row, shard, frameIds))
+    shard, row = shard[order], row[order]
+    starts = np.concatenate([[0], np.flatnonzero((np.diff(shard) != 0) | (np.diff(row) != 1)) + 1])
+    counts = np.diff(np.concatenate([starts, [len(order)]]))
+    return shard[starts], row[starts], starts, counts
+
+def _virtual_dataset(outFd, key, sourcePaths, shapes, dtype, runs):
+    nRows = int(sum(count for _, _, _, count in runs))
+    layout = h5py.VirtualLayout(shape=(nRows,) + tuple(next(iter(shapes.values()))[1:]), dtype=dtype)
+    sources = {}
+    for s, src, dst, count in runs:
+        if s not in sources:
+            sources[s] = h5py.VirtualSource(sourcePaths[s], key, shape=shapes[s])
+        layout[dst:dst + count] = sources[s][src:src + count]
+    outFd.create_virtual_dataset(key, layout)
+
+def _write_index(outFd, relPaths, runs):
+    index = outFd.require_group('index')
+    index.create_dataset('runs', data=np.array(runs, dtype=np.int64).reshape((-1, 4)))
+    index.attrs['columns'] = ['shard', 'source_row', 'row', 'count']
+    outFd.attrs['shards'] = relPaths
+
+def stitch_dense(shardFds, relPaths, outFd):
+    frameIdsList, idKey = [], None
+    for h5fd in shardFds:
+        frameIds, idKey = shard_frame_ids(h5fd)
+        frameIdsList.append(frameIds)
+    shard, src, dst, count = frame_order_runs(frameIdsList)
+    runs = list(zip(shard.tolist(), src.tolist(), dst.tolist(), count.tolist()))
+    keys = sorted(set(key for h5fd in shardFds for key, item in h5fd.items() if isinstance(item, h5py.Dataset)))
+    ordered, concatenated = [], []
+    for key in keys:
+        present = [s for s, h5fd in enumerate(shardFds) if key in h5fd]
+        shapes = {s : shardFds[s][key].shape for s in present}
+        dtype = shardFds[present[0]][key].dtype
+        if len(present) == len(shardFds) and all(shapes[s][0] == len(frameIdsList[s]) for s in present):
+            _virtual_dataset(outFd, key, relPaths, shapes, dtype, runs)
+            ordered.append(key)
+        else:
+            # not one row per frame id, e.g. groups; concatenated in shard order
+            offsets = np.cumsum([0] + [shapes[s][0] for s in present])
+            _virtual_dataset(outFd, key, relPaths, shapes, dtype, \
+                             [(s, 0, int(offsets[i]), shapes[s][0]) for i, s in enumerate(present)])
+            concatenated.append(key)
+    _write_index(outFd, relPaths, runs)
+    return {'format' : 'dense', 'frameIdKey' : idKey, 'nRows' : int(count.sum()), 'nRuns' : len(runs), \
+            'orderedDatasets' : ordered, 'concatenatedDatasets' : concatenated}
+
+def stitch_sparse(shardFds, relPaths, outFd):
+    frameIdsList = [h5fd['frame_ids'][:] for h5fd in shardFds]
+    indptrs = [h5fd['indptr'][:] for h5fd in shardFds]
+    shard, src, dst, count = frame_order_runs(frameIdsList)
+    # frame runs become pixel runs
+    pixelRuns, indptr, frameIds = [], [np.zeros(1, dtype=np.int64)], []
+    nPixels = 0
+    for s, r, n in zip(shard.tolist(), src.tolist(), count.tolist()):
+        shardPtr = indptrs[s]
+        start, stop = int(shardPtr[r]), int(shardPtr[r + n])
+        pixelRuns.append((s, start, nPixels, stop - start))
+        indptr.append(nPixels + shardPtr[r + 1:r + n + 1] - start)
+        frameIds.append(frameIdsList[s][r:r + n])
+        nPixels += stop - start
+    for key, value in shardFds[0].attrs.items():
+        outFd.attrs[key] = value
+    outFd.create_dataset('frame_ids', data=np.concatenate(frameIds) if frameIds else np.zeros(0, dtype=np.int64))
+    outFd.create_dataset('indptr', data=np.concatenate(indptr))
+    for key in ('indices', 'values'):
+        shapes = {s : h5fd[key].shape for s, h5fd in enumerate(shardFds)}
+        _virtual_dataset(outFd, key, relPaths, shapes, shardFds[0][key].dtype, pixelRuns)
+    _write_index(outFd, relPaths, list(zip(shard.tolist(), src.tolist(), dst.tolist(), count.tolist())))
+    return {'format' : 'sparse', 'nRows' : int(count.sum()), 'nRuns' : len(pixelRuns), 'nPixels' : nPixels}
+
+def stitch(shardFiles, outFile):
+    outDir = os.path.dirname(os.path.abspath(outFile))
+    relPaths = [os.path.relpath(os.path.abspath(f), outDir) for f in shardFiles]
+    shardFds = [h5py.File(f, 'r') for f in shardFiles]
+    try:
+        with h5py.File(outFile, 'w') as outFd:
+            if all('indptr' in h5fd for h5fd in shardFds):
+                summary = stitch_sparse(shardFds, relPaths, outFd)
+            else:
+                summary = stitch_dense(shardFds, relPaths, outFd)
+    finally:
+        for h5fd in shardFds:
+            h5fd.close()
+    summary.update({'output' : outFile, 'shards' : relPaths})
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='present per-consumer shard files as one frame-ordered file (HDF5 virtual datasets)')
+    parser.add_argument('shards',     type=str, nargs='+', help='shard files, e.g. peaks.shard*.h5')
+    parser.add_argument('-o',         type=str, required=True, help='stitched file')
+
+    args, unparsed = parser.parse_known_args()
+    if len(unparsed) > 0:
+        print('Unrecognized argument(s): \n%s \nProgram exiting ... ... ' % '\n'.join(unparsed))
+        exit(0)
+    if os.path.abspath(args.o) in [os.path.abspath(f) for f in args.shards]:
+        print(f'{args.o} is one of the shards')
+        exit(1)
+
+    json.dump(stitch(sorted(args.shards), args.o), sys.stdout, indent=2)
+    print()
@@ -0,0 +1,149 @@
+'''
+Sequential log of a raw detector stream, as BraggNNInferImageProcessor.process()
+or pvaClient.monitor receive it: payload bytes exactly as received (compressed
+or not), codec, sizes, dimensions, uniqueId and arrival time of every frame.
+
+StreamRecorder never blocks the caller: frames are handed to a writer thread
+through a bounded queue (only a reference to the received array is kept) and
+are dropped, and counted, if the writer falls behind. StreamLogReader reads a
+log back; streamReplayer.py republishes it over PVA.
+
+File layout: MAGIC, then per frame a RECORD_HEADER followed by the payload.
+'''
+
+import queue, struct, threading, time, mmap
+import numpy as np
+from pvapy.utility.loggingManager import LoggingManager
+from pvaStandIn import StandInNtNdArray
+
+MAGIC = b'EBRAGGS1'
+# uniqueId, arrival time, compressedSize, uncompressedSize, sizes of dimension 0 and 1,
+# codec name, codec data type, value field key, payload size
+RECORD_HEADER = struct.Struct('<qdqqII16si16sq')
+FIELD_KEY_DTYPE_MAP = {key : dtype for dtype, key in StandInNtNdArray.PVA_TYPE_KEY_MAP.items()}
+
+class StreamRecorder:
+
+    def __init__(self, fileName, maxQueued=1000, bufferSize=8*1024*1024):
+        self.logger = LoggingManager.getLogger(self.__class__.__name__)
+        self.fileName = fileName
+        self.fp = open(fileName, 'wb', buffering=bufferSize)
+        self.fp.write(MAGIC)
+        self.record_q = queue.Queue(maxsize=maxQueued)
+        self.nFramesRecorded = 0
+        self.nFramesDropped = 0
+        self.nBytesRecorded = 0
+        # payload bytes waiting for the writer thread
+        self.nBytesQueued = 0
+        self.maxBytesQueued = 0
+        self.writerThread = threading.Thread(target=self._writer, daemon=True)
+        self.writerThread.start()
+        self.logger.debug(f'Recording stream to {fileName}')
+
+    # codec is the received codec structure ({'name', 'parameters' : [{'value'}]}),
+    # dims the sizes of the received dimensions in their order, fieldKey the
+    # value union field the payload came from
+    def record(self, uniqueId, payload, codec, compressedSize, uncompressedSize, dims, fieldKey, arrivalTime=None):
+        if arrivalTime is None:
+            arrivalTime = time.time()
+        try:
+            self.record_q.put_nowait((uniqueId, arrivalTime, payload, codec, compressedSize, uncompressedSize, dims, fieldKey))
+            self.nBytesQueued += payload.nbytes
+            self.maxBytesQueued = max(self.maxBytesQueued, self.nBytesQueued)
+        except queue.Full:
+            self.nFramesDropped += 1
+
+    def _writer(self):
+        while True:
+            item = self.record_q.get()
+            if item is None:
+                break
+            uniqueId, arrivalTime, payload, codec, compressedSize, uncompressedSize, dims, fieldKey = item
+            self.nBytesQueued -= payload.nbytes
+            try:
+                data = np.ascontiguousarray(payload)
+                codecType = codec['parameters'][0]['value'] if codec['parameters'] else 0
+                self.fp.write(RECORD_HEADER.pack(uniqueId, arrivalTime, compressedSize or 0, uncompressedSize or 0, dims[0], dims[1], \
+                                                 codec['name'].encode(), codecType, fieldKey.encode(), data.nbytes))
+                self.fp.write(data.data)
+                self.nFramesRecorded += 1
+                self.nBytesRecorded += RECORD_HEADER.size + data.nbytes
+            except Exception as ex:
+                self.logger.error(f'Cannot record frame {uniqueId}: {ex}')
+
+    def stop(self):
+        if self.fp is None:
+            return
+        self.record_q.put(None)
+        self.writerThread.join()
+        self.fp.close()
+        self.fp = None
+        self.logger.debug(f'Recorded {self.nFramesRecorded} frames ({self.nBytesRecorded/1e6:.1f} MB) to {self.fileName}, {self.nFramesDropped} dropped')
+
+    def getStats(self):
+        return {
+            'nFramesRecorded' : self.nFramesRecorded,
+            'nFramesNotRecorded' : self.nFramesDropped,
+            'nBytesRecorded' : self.nBytesRecorded,
+            'nRecordBytesQueued' : self.nBytesQueued,
+            'maxRecordBytesQueued' : self.maxBytesQueued
+        }
+
+class StreamLogReader:
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.fp = open(fileName, 'rb')
+        self.buffer = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise Exception(f'{fileName} is not a stream log')
+        # offsets of all records, so that frames can be read in any order
+        self.offsets = []
+        offset = len(MAGIC)
+        while offset + RECORD_HEADER.size <= len(self.buffer):
+            header = RECORD_HEADER.unpack_from(self.buffer, offset)
+            if offset + RECORD_HEADER.size + header[-1] > len(self.buffer):
+                break
+            self.offsets.append(offset)
+            offset += RECORD_HEADER.size + header[-1]
+        self.nFrames = len(self.offsets)
+
+    # frame i as a dict; 'value' is a read-only view of the payload
+    def getRecord(self, i):
+        offset = self.offsets[i]
+        uniqueId, arrivalTime, compressedSize, uncompressedSize, dim0, dim1, codecName, codecType, fieldKey, nbytes = \
+            RECORD_HEADER.unpack_from(self.buffer, offset)
+        fieldKey = fieldKey.rstrip(b'\0').decode()
+        value = np.frombuffer(self.buffer, dtype=FIELD_KEY_DTYPE_MAP[fieldKey], count=nbytes//FIELD_KEY_DTYPE_MAP[fieldKey].itemsize, \
+                              offset=offset + RECORD_HEADER.size)
+        return {
+            'uniqueId' : uniqueId,
+            'arrivalTime' : arrivalTime,
+            'compressedSize' : compressedSize,
+            'uncompressedSize' : uncompressedSize,
+            'dims' : (dim0, dim1),
+            'codec' : {'name' : codecName.rstrip(b'\0').decode(), 'parameters' : [{'value' : codecType}]},
+            'fieldKey' : fieldKey,
+            'value' : value
+        }
+
+    def __iter__(self):
+        for i in range(self.nFrames):
+            yield self.getRecord(i)
+
+    def close(self):
+        try:
+            self.buffer.close()
+        except BufferError:
+            # records still in use keep the mapping alive
+            pass
+        self.fp.close()
+
+    def describe(self):
+        description = {'type' : 'streamLog', 'fileName' : self.fileName, 'nFrames' : self.nFrames}
+        if self.nFrames > 1:
+            first, last = self.getRecord(0), self.getRecord(self.nFrames - 1)
+            duration = last['arrivalTime'] - first['arrivalTime']
+            description.update({'dims' : list(first['dims']), 'codec' : first['codec']['name'], 'duration' : duration, \
+                                'frameRate' : (self.nFrames - 1)/duration if duration > 0 else 0.0})
+        return description
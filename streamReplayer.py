@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+'''
+Republishes a stream log (streamRecorder.py) over a local PVA server, with
+the recorded payloads, codecs, sizes and uniqueIds, either with the recorded
+inter-arrival timing (optionally sped up), at a fixed frame rate, or as fast
+as possible. NtNdArrays are built by a producer thread ahead of the pacing
+thread, so that building them does not disturb the timing.
+'''
+
+import argparse, queue, threading, time
+import pvaccess as pva
+from framePacer import FramePacer
+from streamRecorder import StreamLogReader
+
+class StreamReplayer:
+
+    def __init__(self, fileName, channelName, timing='original', speed=1.0, frameRate=0, nLoops=1, prefetch=64, \
+                 startDelay=1.0, spinTime=0.002, reportFrequency=0):
+        self.reader = StreamLogReader(fileName)
+        self.channelName = channelName
+        self.timing = timing
+        self.speed = speed
+        self.nLoops = nLoops
+        self.startDelay = startDelay
+        self.reportFrequency = reportFrequency
+        self.frame_q = queue.Queue(maxsize=prefetch)
+        self.pacer = FramePacer(frameRate if timing == 'rate' else 0, spinTime=spinTime)
+        self.isDone = False
+        self.nPublishedBytes = 0
+        self.server = pva.PvaServer()
+        self.server.addRecord(self.channelName, pva.NtNdArray())
+        if self.reader.nFrames == 0:
+            raise Exception(f'No frames in {fileName}')
+        self.firstArrivalTime = self.reader.getRecord(0)['arrivalTime']
+        self.duration = self.reader.getRecord(self.reader.nFrames - 1)['arrivalTime'] - self.firstArrivalTime
+
+    def makeNtNdArray(self, record):
+        nda = pva.NtNdArray()
+        nda['uniqueId'] = record['uniqueId']
+        codec = record['codec']
+        nda['codec'] = pva.PvCodec(codec['name'], pva.PvInt(codec['parameters'][0]['value']))
+        nda['compressedSize'] = record['compressedSize']
+        nda['uncompressedSize'] = record['uncompressedSize']
+        dim0, dim1 = record['dims']
+        nda['dimension'] = [pva.PvDimension(dim0, 0, dim0, 1, False), pva.PvDimension(dim1, 0, dim1, 1, False)]
+        nda['descriptor'] = 'Replayed Image'
+        nda['value'] = {record['fieldKey'] : record['value']}
+        return nda
+
+    def producer(self):
+        for loop in range(self.nLoops):
+            for record in self.reader:
+                if self.isDone:
+                    return
+                # loops continue the recorded timeline
+                offset = loop*(self.duration + self.getMeanInterval()) + record['arrivalTime'] - self.firstArrivalTime
+                self.frame_q.put((offset, record['compressedSize'], self.makeNtNdArray(record)))
+        self.frame_q.put(None)
+
+    def getMeanInterval(self):
+        if self.reader.nFrames > 1:
+            return self.duration/(self.reader.nFrames - 1)
+        return 0.0
+
+    def publisher(self):
+        time.sleep(self.startDelay)
+        self.pacer.start()
+        while not self.isDone:
+            item = self.frame_q.get()
+            if item is None:
+                break
+            offset, nbytes, nda = item
+            if self.timing == 'original':
+                self.pacer.waitUntil(self.pacer.startTime + offset/self.speed)
+            else:
+                self.pacer.wait()
+            self.server.update(self.channelName, nda)
+            self.pacer.record()
+            self.nPublishedBytes += nbytes
+            nPublished = self.pacer.nFrames
+            if self.reportFrequency > 0 and nPublished % self.reportFrequency == 0:
+                stats = self.pacer.getStats()
+                print('Published %d frames (frame rate: %.4f fps, lateness: %.1f us mean, %.1f us max)' % \
+                      (nPublished, stats['frameRate'], 1e6*stats['meanLateness'], 1e6*stats['maxLateness']))
+        self.isDone = True
+
+    def start(self):
+        self.server.start()
+        self.producerThread = threading.Thread(target=self.producer, daemon=True)
+        self.producerThread.start()
+        self.publisherThread = threading.Thread(target=self.publisher, daemon=True)
+        self.publisherThread.start()
+
+    def stop(self):
+        self.isDone = True
+        self.server.stop()
+        stats = self.pacer.getStats()
+        print('\nReplayed frames: %d @ %.4f fps' % (stats['nFrames'], stats['frameRate']))
+        if stats['nFrames'] > 1 and stats['frameRate'] > 0:
+            runtime = (stats['nFrames'] - 1)/stats['frameRate']
+            print('Replayed data: %.3f MB/s' % (self.nPublishedBytes/runtime/1e6))
+        print('Lateness: %.1f us mean, %.1f us p99, %.1f us max' % \
+              (1e6*stats['meanLateness'], 1e6*stats['p99Lateness'], 1e6*stats['maxLateness']))
+
+def main():
+    parser = argparse.ArgumentParser(description='republish a recorded detector stream over PVA')
+    parser.add_argument('--input-file', '-if', type=str, dest='input_file', required=True, help='Stream log written by StreamRecorder (frame: record: in the config)')
+    parser.add_argument('--channel-name', '-cn', type=str, dest='channel_name', default='simulation:pva:test', help='Server PVA channel name (default: simulation:pva:test)')
+    parser.add_argument('--timing', '-t', type=str, dest='timing', default='original', choices=['original', 'rate', 'max'], help='Recorded arrival timing, fixed --frame-rate, or as fast as possible (default: original)')
+    parser.add_argument('--speed', '-s', type=float, dest='speed', default=1.0, help='Speed-up of the recorded timing (default: 1)')
+    parser.add_argument('--frame-rate', '-fps', type=float, dest='frame_rate', default=20, help='Frames per second with --timing rate (default: 20 fps)')
+    parser.add_argument('--n-loops', '-nl', type=int, dest='n_loops', default=1, help='Number of times the log is replayed (default: 1)')
+    parser.add_argument('--prefetch', '-pf', type=int, dest='prefetch', default=64, help='Number of frames prepared ahead of publishing (default: 64)')
+    parser.add_argument('--start-delay', '-sd', type=float, dest='start_delay', default=3.0, help='Start delay in seconds (default: 3 seconds)')
+    parser.add_argument('--spin-time', '-st', type=float, dest='spin_time', default=0.002, help='Busy-wait for this many seconds before each publish (default: 0.002)')
+    parser.add_argument('--report-frequency', '-rf', type=int, dest='report_frequency', default=100, help='Report every this many frames; <=0 for no reports (default: 100)')
+
+    args, unparsed = parser.parse_known_args()
+    if len(unparsed) > 0:
+        print('Unrecognized argument(s): %s' % ' '.join(unparsed))
+        exit(1)
+
+    replayer = StreamReplayer(args.input_file, args.channel_name, timing=args.timing, speed=args.speed, frameRate=args.frame_rate, \
+                              nLoops=args.n_loops, prefetch=args.prefetch, startDelay=args.start_delay, spinTime=args.spin_time, \
+                              reportFrequency=args.report_frequency)
+    print(f'Replaying {replayer.reader.describe()}')
+    replayer.start()
+    try:
+        while replayer.publisherThread.is_alive():
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    replayer.stop()
+
+if __name__ == '__main__':
+    main()
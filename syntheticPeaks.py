@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+'''
+Synthetic Bragg peak frames with known ground truth.
+
+Peaks are pseudo-Voigt profiles (eta*Lorentzian + (1-eta)*Gaussian of the same
+FWHM) placed at uniformly random sub-pixel positions, with FWHM, mixing factor
+and amplitude drawn from configurable ranges, on a constant background with
+optional Poisson (shot) and Gaussian (read) noise. All peaks of a frame are
+rendered at once with numpy.
+
+Ground truth is a dict of 1D arrays (see TRUTH_FIELDS); row/col are in pixel
+coordinates, pixel (r, c) being centered at (r, c). It is stored in a 'truth'
+group next to the 'frames' dataset, so generated scans can be streamed by the
+daq-simu tools and replayed by the benchmarks. match_peaks() compares found
+peak locations against it.
+
+Run as a script to write a scan file, e.g.
+    python syntheticPeaks.py -o scan.h5 -nf 100 -density 500
+'''
+
+import argparse
+import numpy as np
+import h5py
+
+TRUTH_FIELDS = ('frame', 'row', 'col', 'amplitude', 'fwhm', 'eta')
+
+class SyntheticPeakGenerator:
+
+    # density is in peaks per megapixel (used when nPeaks is None); fwhm, eta and
+    # amplitude are (min, max) ranges, amplitudes are drawn log-uniformly;
+    # noise is 'poisson', 'gaussian' (readNoise sigma only) or 'none'
+    def __init__(self, nx=2048, ny=2048, dtype='uint16', nPeaks=None, density=50, fwhm=(2.0, 4.0), eta=(0.0, 0.5), \
+                 amplitude=(200, 5000), background=10, noise='poisson', readNoise=0.0, seed=0):
+        self.shape = (ny, nx)
+        self.dtype = np.dtype(dtype)
+        self.nPeaks = nPeaks if nPeaks is not None else int(round(density*nx*ny/1e6))
+        self.fwhm = fwhm
+        self.eta = eta
+        self.amplitude = amplitude
+        self.background = background
+        self.noise = noise
+        self.readNoise = readNoise
+        self.seed = seed
+        # lorentzian tails are cut where they drop below ~1% of the amplitude
+        self.halfWidth = int(np.ceil(2.5*max(fwhm)))
+        self.rng = np.random.default_rng(seed)
+
+    def generateTruth(self, frameId=0):
+        ny, nx = self.shape
+        n = self.nPeaks
+        hw = self.halfWidth
+        logAmp = self.rng.uniform(np.log(self.amplitude[0]), np.log(self.amplitude[1]), size=n)
+        return {
+            'frame' : np.full(n, frameId, dtype=np.int64),
+            'row' : self.rng.uniform(hw, ny - hw - 1, size=n),
+            'col' : self.rng.uniform(hw, nx - hw - 1, size=n),
+            'amplitude' : np.exp(logAmp),
+            'fwhm' : self.rng.uniform(self.fwhm[0], self.fwhm[1], size=n),
+            'eta' : self.rng.uniform(self.eta[0], self.eta[1], size=n)
+        }
+
+    def render(self, truth):
+        ny, nx = self.shape
+        hw = self.halfWidth
+        offsets = np.arange(-hw, hw + 1)
+        rows = np.round(truth['row']).astype(np.int64)[:, None] + offsets
+        cols = np.round(truth['col']).astype(np.int64)[:, None] + offsets
+        dr2 = (rows - truth['row'][:, None])**2
+        dc2 = (cols - truth['col'][:, None])**2
+        # (nPeaks, window, window) squared distances normalized by fwhm/2
+        x2 = (dr2[:, :, None] + dc2[:, None, :]) * (4/truth['fwhm']**2)[:, None, None]
+        eta = truth['eta'][:, None, None]
+        profile = eta/(1 + x2) + (1 - eta)*np.exp(-np.log(2)*x2)
+        values = truth['amplitude'][:, None, None]*profile
+        index = (rows[:, :, None]*nx + cols[:, None, :]).ravel()
+        signal = np.bincount(index, weights=values.ravel(), minlength=ny*nx).reshape(self.shape)
+        frame = signal + self.background
+        if self.noise == 'poisson':
+            frame = self.rng.poisson(frame).astype(np.float64)
+        if self.noise != 'none' and self.readNoise > 0:
+            frame += self.rng.normal(0, self.readNoise, size=self.shape)
+        info = np.iinfo(self.dtype) if self.dtype.kind in 'iu' else np.finfo(self.dtype)
+        if self.dtype.kind in 'iu':
+            frame = np.round(frame)
+        return np.clip(frame, info.min, info.max).astype(self.dtype)
+
+    # returns (frame, truth)
+    def generate(self, frameId=0):
+        truth = self.generateTruth(frameId)
+        return self.render(truth), truth
+
+    def describe(self):
+        return {'nPeaks' : self.nPeaks, 'fwhm' : list(self.fwhm), 'eta' : list(self.eta),
+                'amplitude' : list(self.amplitude), 'background' : self.background,
+                'noise' : self.noise, 'readNoise' : self.readNoise, 'seed' : self.seed}
+
+def concat_truth(truths):
+    return {key : np.concatenate([t[key] for t in truths]) for key in TRUTH_FIELDS}
+
+def write_truth(h5fd, truth, group='truth'):
+    grp = h5fd.require_group(group)
+    for key in TRUTH_FIELDS:
+        if key in grp:
+            del grp[key]
+        grp.create_dataset(key, data=truth[key])
+
+def read_truth(fileName, group='truth'):
+    with h5py.File(fileName, 'r') as h5fd:
+        return {key : h5fd[group][key][:] for key in TRUTH_FIELDS}
+
+def match_peaks(truth, frames, rows, cols, maxDistance=2.0):
+    '''
+    One-to-one matching (closest pairs first) of found peaks against the
+    ground truth, within maxDistance pixels and the same frame. Recall is
+    relative to all truth peaks given, so truth should only cover the frames
+    that were processed. Returns counts, recall/precision and localization
+    error statistics in pixels.
+    '''
+    frames = np.asarray(frames, dtype=np.int64)
+    rows = np.asarray(rows, dtype=np.float64)
+    cols = np.asarray(cols, dtype=np.float64)
+    pairs = []
+    for frameId in np.unique(frames):
+        fidx = np.nonzero(frames == frameId)[0]
+        tidx = np.nonzero(truth['frame'] == frameId)[0]
+        if len(tidx) == 0:
+            continue
+        # truth sorted by row so that each found peak only looks at a band of rows
+        order = tidx[np.argsort(truth['row'][tidx])]
+        truthRows = truth['row'][order]
+        lo = np.searchsorted(truthRows, rows[fidx] - maxDistance)
+        hi = np.searchsorted(truthRows, rows[fidx] + maxDistance)
+        for f, a, b in zip(fidx, lo, hi):
+            if a == b:
+                continue
+            t = order[a:b]
+            d = np.hypot(truth['row'][t] - rows[f], truth['col'][t] - cols[f])
+            near = d <= maxDistance
+            pairs.extend(zip(d[near], t[near], np.full(near.sum(), f)))
+    pairs.sort()
+    usedTruth, usedFound, errors = set(), set(), []
+    for d, t, f in pairs:
+        if t in usedTruth or f in usedFound:
+            continue
+        usedTruth.add(t)
+        usedFound.add(f)
+        errors.append(d)
+    errors = np.array(errors)
+    nTruth = len(truth['frame'])
+    nMatched = len(errors)
+    return {
+        'nTruth' : nTruth,
+        'nFound' : len(rows),
+        'nMatched' : nMatched,
+        'recall' : nMatched/nTruth if nTruth > 0 else 0.0,
+        'precision' : nMatched/len(rows) if len(rows) > 0 else 0.0,
+        'meanError' : float(errors.mean()) if nMatched > 0 else None,
+        'rmsError' : float(np.sqrt((errors**2).mean())) if nMatched > 0 else None,
+        'p90Error' : float(np.percentile(errors, 90)) if nMatched > 0 else None
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='write synthetic Bragg peak frames with ground truth to an h5 file')
+    parser.add_argument('-o',         type=str, required=True, help='output h5 file (frames dataset and truth group)')
+    parser.add_argument('-nf',        type=int, default=16, help='number of frames')
+    parser.add_argument('-nx',        type=int, default=2048, help='frame width')
+    parser.add_argument('-ny',        type=int, default=2048, help='frame height')
+    parser.add_argument('-dtype',     type=str, default='uint16', help='frame data type')
+    parser.add_argument('-density',   type=float, default=50, help='peaks per megapixel')
+    parser.add_argument('-fwhm',      type=float, nargs=2, default=[2.0, 4.0], help='range of peak FWHM in pixels')
+    parser.add_argument('-eta',       type=float, nargs=2, default=[0.0, 0.5], help='range of the Lorentzian fraction')
+    parser.add_argument('-amplitude', type=float, nargs=2, default=[200, 5000], help='range of peak amplitudes (log-uniform)')
+    parser.add_argument('-background',type=float, default=10, help='constant background level')
+    parser.add_argument('-noise',     type=str, default='poisson', choices=['poisson', 'gaussian', 'none'], help='noise model')
+    parser.add_argument('-read_noise',type=float, default=0.0, help='gaussian read noise sigma')
+    parser.add_argument('-seed',      type=int, default=0, help='random seed')
+
+    args, unparsed = parser.parse_known_args()
+    if len(unparsed) > 0:
+        print('Unrecognized argument(s): \n%s \nProgram exiting ... ... ' % '\n'.join(unparsed))
+        exit(0)
+
+    generator = SyntheticPeakGenerator(nx=args.nx, ny=args.ny, dtype=args.dtype, density=args.density, fwhm=args.fwhm, \
+                                       eta=args.eta, amplitude=args.amplitude, background=args.background, \
+                                       noise=args.noise, readNoise=args.read_noise, seed=args.seed)
+    truths = []
+    with h5py.File(args.o, 'w') as h5fd:
+        dset = h5fd.create_dataset('frames', shape=(args.nf, args.ny, args.nx), dtype=generator.dtype, chunks=(1, args.ny, args.nx))
+        for i in range(args.nf):
+            frame, truth = generator.generate(i)
+            dset[i] = frame
+            truths.append(truth)
+        write_truth(h5fd, concat_truth(truths))
+    print(f'{args.nf} frames with {generator.nPeaks} peaks each written to {args.o}')
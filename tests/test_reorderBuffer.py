@@ -0,0 +1,71 @@
+import numpy as np
+from braggNNReorderBuffer import BraggNNReorderBuffer, SequenceIds
+
+def batch(sequenceIds, frameId, detector):
+    return {
+        'uniqueId' : frameId,
+        'sequenceId' : sequenceIds.encode(frameId, detector),
+        'detector' : detector,
+        'patches' : np.zeros((1, 1, 15, 15), dtype=np.float32),
+        'lastBatch' : True
+    }
+
+def released(buffer):
+    return [(ddict['uniqueId'], ddict['detector']) for ddict in buffer.flush()]
+
+def test_two_detectors_release_in_frame_detector_order():
+    sequenceIds = SequenceIds(2, idStep=1, firstId=0)
+    buffer = BraggNNReorderBuffer(maxHoldTime=0, idStep=1, firstId=0, idKey='sequenceId')
+    # detectors interleaved and out of order
+    for frameId, detector in [(1, 1), (0, 0), (2, 0), (1, 0), (0, 1), (2, 1)]:
+        buffer.put(batch(sequenceIds, frameId, detector))
+    assert released(buffer) == [(0, 0), (0, 1), (1, 0), (1, 1), (2, 0), (2, 1)]
+    stats = buffer.getStats()
+    assert stats['nFramesMissing'] == 0
+    assert stats['nLateBatches'] == 0
+
+def test_two_detectors_with_id_step():
+    # every 3rd frame, starting at frame 10, as one of three consumers sees them
+    sequenceIds = SequenceIds(2, idStep=3, firstId=10)
+    buffer = BraggNNReorderBuffer(maxHoldTime=0, idStep=1, firstId=0, idKey='sequenceId')
+    for frameId, detector in [(16, 0), (13, 1), (10, 1), (13, 0), (10, 0), (16, 1)]:
+        buffer.put(batch(sequenceIds, frameId, detector))
+    assert released(buffer) == [(10, 0), (10, 1), (13, 0), (13, 1), (16, 0), (16, 1)]
+    assert buffer.getStats()['nFramesMissing'] == 0
+
+def test_sequence_ids_round_trip():
+    sequenceIds = SequenceIds(3, idStep=2)
+    seqIds = [sequenceIds.encode(frameId, detector) for frameId in (100, 102, 98) for detector in range(3)]
+    assert seqIds[:3] == [0, 1, 2]
+    assert [sequenceIds.decode(s) for s in seqIds] == [(f, d) for f in (100, 102, 98) for d in range(3)]
+
+def test_late_frames_are_marked_once():
+    buffer = BraggNNReorderBuffer(maxHoldTime=0, idStep=1, firstId=0)
+    # frame 0 is skipped as missing, frame 2 is released without its last batch
+    buffer.put({'uniqueId' : 1, 'lastBatch' : True})
+    buffer.put({'uniqueId' : 2, 'lastBatch' : False})
+    buffer.flush()
+    buffer.put({'uniqueId' : 0, 'lastBatch' : False})
+    buffer.put({'uniqueId' : 0, 'lastBatch' : True})
+    buffer.put({'uniqueId' : 2, 'lastBatch' : True})
+    late = buffer.flush()
+    assert all(ddict['late'] for ddict in late)
+    assert ['frameComplete' in ddict for ddict in late] == [False, True, False]
+    stats = buffer.getStats()
+    assert stats['nFramesMissing'] == 1
+    assert stats['nFramesIncomplete'] == 1
+
+def test_two_detectors_counting_independently():
+    # detector 0 counts from 0, detector 1 from 1
+    sequenceIds = SequenceIds(2, idStep=1, firstId=[0, 1])
+    buffer = BraggNNReorderBuffer(maxHoldTime=0, idStep=1, firstId=0, idKey='sequenceId')
+    for frameId, detector in [(2, 1), (0, 0), (1, 0), (1, 1), (3, 1), (2, 0)]:
+        buffer.put(batch(sequenceIds, frameId, detector))
+    assert released(buffer) == [(0, 0), (1, 1), (1, 0), (2, 1), (2, 0), (3, 1)]
+    assert buffer.getStats()['nFramesMissing'] == 0
+
+def test_detector_bases_taken_from_first_frames():
+    sequenceIds = SequenceIds(2)
+    assert [sequenceIds.encode(f, 0) for f in (100, 101, 102)] == [0, 2, 4]
+    assert [sequenceIds.encode(f, 1) for f in (5, 6, 7)] == [1, 3, 5]
+    assert sequenceIds.decode(3) == (6, 1)
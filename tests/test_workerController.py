@@ -0,0 +1,60 @@
+import glob, os, time
+import multiprocessing as mp
+from pvapy.hpc.userMpDataProcessor import UserMpDataProcessor
+from braggNNFrameProcessor import BraggNNFrameProcessor
+from memoryAccounting import TrackedQueue
+from workerController import WorkerController
+
+def wait_for(condition, timeout=10):
+    t0 = time.time()
+    while not condition() and time.time() - t0 < timeout:
+        time.sleep(0.05)
+    return condition()
+
+def frame_processor_controller(workerId, frame_q, patch_q):
+    frameProcessor = BraggNNFrameProcessor(psz=15, mbsz=8, offset_recover=0, min_intensity=0, max_radius=None, min_peak_sz=1, \
+                                           dark_h5=None, patch_q=patch_q, write_q=None)
+    return WorkerController(workerId, frameProcessor, frame_q)
+
+def test_profiler_command_reaches_frame_processor(tmp_path):
+    controller = frame_processor_controller('frameProcessor.1', mp.Queue(), mp.Queue())
+    controller.start()
+    try:
+        controller.configure({'profiler' : 'start', 'profilerMode' : 'sample', 'profilerDir' : str(tmp_path), \
+                              'profilerName' : 'frameProcessor.1-test'})
+        time.sleep(0.5)
+        controller.configure({'profiler' : 'stop'})
+        assert wait_for(lambda: glob.glob(os.path.join(tmp_path, 'frameProcessor.1-test.*.collapsed')))
+    finally:
+        controller.stop()
+
+class FrameCollector(UserMpDataProcessor):
+
+    def __init__(self, output_q):
+        UserMpDataProcessor.__init__(self)
+        self.output_q = output_q
+
+    def process(self, mpqObject):
+        time.sleep(0.005)
+        self.output_q.put(mpqObject)
+
+def test_retired_worker_leaves_queued_frames_to_the_pool():
+    nFrames = 300
+    frame_q = TrackedQueue(name='frameQueue')
+    output_q = mp.Queue()
+    controllers = [WorkerController(f'frameProcessor.{i+1}', FrameCollector(output_q), frame_q) for i in range(2)]
+    for frameId in range(nFrames):
+        frame_q.put(frameId)
+    for controller in controllers:
+        controller.start()
+    received = []
+    try:
+        time.sleep(0.2)
+        controllers[1].retire()
+        assert frame_q.qsize() > 0
+        while len(received) < nFrames:
+            received.append(output_q.get(timeout=10))
+    finally:
+        for controller in controllers:
+            controller.stop()
+    assert sorted(received) == list(range(nFrames))
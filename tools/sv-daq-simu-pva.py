@@ -6,13 +6,17 @@ still puzzling here.
 '''
 
 
-import time, threading, queue, h5py, argparse
+import time, threading, queue, h5py, argparse, os, sys
 import numpy as np
 import pvaccess as pva
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from codecAD import DTYPE_CODEC_TYPE_MAP
+from codecEncoder import CodecEncoder
+
 class daqSimuEPICS:
 
-    def __init__(self, h5, daq_freq, nf, nx, ny, runtime, channel_name, start_delay):
+    def __init__(self, h5, daq_freq, nf, nx, ny, runtime, channel_name, start_delay, codec=''):
         self.arraySize = None
         self.delta_t = 1.0/daq_freq
         self.runtime = runtime
@@ -25,8 +29,14 @@ class daqSimuEPICS:
 
         self.rows, self.cols = self.frames.shape[-2:]
 
+        # frames are compressed once, when the frame map is built
+        self.codec = codec
+        self.encoder = CodecEncoder()
+        self.compressed_bytes = 0
+        self.frame_map_ready = threading.Event()
+
         self.channel_name = channel_name
-        self.n_generated_frames = nf
+        self.n_generated_frames = min(nf, self.frames.shape[0])
         self.daq_freq = daq_freq
         self.server = pva.PvaServer()
         self.server.addRecord(self.channel_name, pva.NtNdArray())
@@ -46,18 +56,33 @@ class daqSimuEPICS:
             else:
                 nda = pva.NtNdArray(extraFieldsPvObject.getStructureDict())
 
+            frame = self.frames[frame_id]
             nda['uniqueId'] = frame_id
-            nda['codec'] = pva.PvCodec('pvapyc', pva.PvInt(14))
             dims = [pva.PvDimension(self.rows, 0, self.rows, 1, False), \
                     pva.PvDimension(self.cols, 0, self.cols, 1, False)]
             nda['dimension'] = dims
             nda['descriptor'] = 'PvaPy Simulated Image'
-            nda['value'] = {'ushortValue': self.frames[frame_id].flatten()}
+            nda['uncompressedSize'] = frame.nbytes
+            if self.codec:
+                payload = self.encoder.compress(frame, self.codec)
+                nda['codec'] = pva.PvCodec(self.codec, pva.PvInt(DTYPE_CODEC_TYPE_MAP[np.dtype(frame.dtype)]))
+                nda['compressedSize'] = payload.nbytes
+                nda['value'] = {'ubyteValue': payload}
+                self.compressed_bytes += payload.nbytes
+            else:
+                nda['codec'] = pva.PvCodec('pvapyc', pva.PvInt(14))
+                nda['compressedSize'] = frame.nbytes
+                nda['value'] = {'ushortValue': frame.flatten()}
+                self.compressed_bytes += frame.nbytes
             if extraFieldsPvObject is not None:
                 nda.set(extraFieldsPvObject)
             self.frame_map[frame_id] = nda
+        if self.codec:
+            print('codec %s compression ratio: %.2f' % (self.codec, self.frames[:self.n_generated_frames].nbytes/self.compressed_bytes))
+        self.frame_map_ready.set()
 
     def frame_publisher(self):
+        self.frame_map_ready.wait()
         entry_time = time.time()
         cached_frame_id = self.current_frame_id % self.n_generated_frames
         frame = self.frame_map[cached_frame_id]
@@ -106,6 +131,9 @@ class daqSimuEPICS:
         rate = runtime/(self.n_published_frames - 1)
         print('\nServer runtime: %.4f seconds' % (runtime))
         print('Published frames: %6d @ %.4f fps' % (self.n_published_frames, rate))
+        if runtime > 0:
+            frame_bytes = self.compressed_bytes/self.n_generated_frames
+            print('Published data: %.3f MB/s (codec: %s)' % (self.n_published_frames*frame_bytes/runtime/1e6, self.codec or 'none'))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='simulate data streaming from detector using EPICS')
@@ -117,13 +145,14 @@ if __name__ == '__main__':
     parser.add_argument('-rt', type=float, default=300, help='server runtime in seconds')
     parser.add_argument('-cn', type=str, default='pvapy:image', help='server channel name')
     parser.add_argument('-sd', type=float, default=10.0, help='server start delay')
+    parser.add_argument('-codec', type=str, default='', choices=['', 'blosc', 'lz4', 'bslz4'], help='codec to publish compressed frames with, uncompressed by default')
 
     args, unparsed = parser.parse_known_args()
     if len(unparsed) > 0:
         print('Unrecognized argument(s): \n%s \nProgram exiting ... ... ' % '\n'.join(unparsed))
         exit(0)
 
-    daq = daqSimuEPICS(h5=args.ifn, daq_freq=args.fps, nf=args.nf, nx=args.nx, ny=args.ny, runtime=args.rt, channel_name=args.cn, start_delay=args.sd)
+    daq = daqSimuEPICS(h5=args.ifn, daq_freq=args.fps, nf=args.nf, nx=args.nx, ny=args.ny, runtime=args.rt, channel_name=args.cn, start_delay=args.sd, codec=args.codec)
 
     daq.start()
     runtime = args.rt + 2*args.sd
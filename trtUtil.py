@@ -1,8 +1,9 @@
-import pycuda.driver as cuda
-import tensorrt as trt
-import logging, torch
+# tensorrt, pycuda and torch are imported by the functions that use them, so
+# that importing this module stays cheap
+import logging
 
 def engine_build_from_onnx(onnx_mdl):
+    import tensorrt as trt
     EXPLICIT_BATCH = 1 << (int)(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH)
     TRT_LOGGER = trt.Logger(trt.Logger.ERROR)
     builder = trt.Builder(TRT_LOGGER)
@@ -24,6 +25,8 @@ def engine_build_from_onnx(onnx_mdl):
     return builder.build_engine(network, config)
 
 def mem_allocation(engine):
+    import pycuda.driver as cuda
+    import tensorrt as trt
     # Determine dimensions and create page-locked memory buffers (i.e. won't be swapped to disk) to hold host inputs/outputs.
     in_sz = trt.volume(engine.get_binding_shape(0)) * engine.max_batch_size
     h_input  = cuda.pagelocked_empty(in_sz, dtype='float32')
@@ -41,6 +44,7 @@ def mem_allocation(engine):
     return h_input, h_output, d_input, d_output, stream
 
 def inference(context, h_input, h_output, d_input, d_output, stream):
+    import pycuda.driver as cuda
     # Transfer input data to the GPU.
     cuda.memcpy_htod_async(d_input, h_input, stream)
 
@@ -57,6 +61,7 @@ def inference(context, h_input, h_output, d_input, d_output, stream):
     return h_output
 
 def scriptpth2onnx(pth, mbsz, psz):
+    import torch
     model = torch.jit.load(pth, map_location='cpu')
     if psz != model.input_psz.item():
         logging.error(f"The provided torchScript model is trained for patch size of {model.input_psz.item()}!")
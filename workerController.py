@@ -0,0 +1,101 @@
+'''
+Worker processes with a control channel owned by this repo.
+
+pvapy's UserMpWorkerController.configure() cannot be used to update workers
+at runtime (on pvapy 5.6 it is declared without self, as is
+UserMpWorker.configure(), and raises TypeError). WorkerController keeps the
+pvapy controller for starting, stopping and statistics, and sends
+configuration updates through a control queue of its own, which the worker
+polls between frames, so that updates are applied within WAIT_TIME even when
+no data arrives. Updates are not acknowledged; errors are logged by the worker.
+
+pvapy's stop() empties the input queue, which is shared by the workers of a
+pool (e.g. the frame processors). retire() stops one worker of a pool instead:
+the worker finishes the item it is processing, puts back an item taken after
+the request, and leaves the input queue to the remaining workers.
+'''
+
+import queue
+import multiprocessing as mp
+from pvapy.hpc.userMpWorker import UserMpWorker
+from pvapy.hpc.userMpWorkerController import UserMpWorkerController
+from pvapy.hpc.hpcController import HpcController
+
+class ControlledWorker(UserMpWorker):
+
+    def __init__(self, workerId, userMpDataProcessor, commandRequestQueue, commandResponseQueue, inputDataQueue, controlQueue, \
+                 retireEvent, retiredEvent, logLevel=None, logFile=None):
+        UserMpWorker.__init__(self, workerId, userMpDataProcessor, commandRequestQueue, commandResponseQueue, inputDataQueue, logLevel, logFile)
+        self.controlQueue = controlQueue
+        self.retireEvent = retireEvent
+        self.retiredEvent = retiredEvent
+
+    def configure(self, configDict):
+        self.userMpDataProcessor.configure(configDict)
+
+    # applies the control commands received since the last call
+    def _checkControl(self):
+        while True:
+            try:
+                request = self.controlQueue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                if request.get('command') == HpcController.CONFIGURE_COMMAND:
+                    self.configure(request.get('configDict'))
+            except Exception as ex:
+                self.logger.error(f'Cannot configure worker {self.workerId}: {ex}')
+
+    # a retired worker leaves the shared input queue alone
+    def stop(self):
+        if self.retireEvent.is_set() and not self.isStopped:
+            self.isStopped = True
+            self.userMpDataProcessor.stop()
+            return self.getStats()
+        return UserMpWorker.stop(self)
+
+    def run(self):
+        self.logger.debug(f'Data processing thread for worker {self.workerId} starting')
+        self.rpThread.start()
+        while not self.isStopped and not self.retireEvent.is_set():
+            self._checkControl()
+            try:
+                inputData = self.inputDataQueue.get(block=True, timeout=HpcController.WAIT_TIME)
+                if self.retireEvent.is_set():
+                    self.inputDataQueue.put(inputData)
+                    break
+                self.process(inputData)
+            except queue.Empty:
+                pass
+            except Exception as ex:
+                self.logger.error(f'Data processing error: {ex}')
+        if self.retireEvent.is_set():
+            self.retiredEvent.set()
+        self.logger.debug(f'Data processing thread for worker {self.workerId} is exiting')
+
+class WorkerController(UserMpWorkerController):
+
+    # seconds a retiring worker is given to finish the item it is processing
+    RETIRE_TIME = 10.0
+
+    def __init__(self, workerId, userMpDataProcessor, inputDataQueue, logLevel=None, logFile=None):
+        UserMpWorkerController.__init__(self, workerId, userMpDataProcessor, inputDataQueue, logLevel, logFile)
+        self.controlQueue = mp.Queue()
+        self.retireEvent = mp.Event()
+        self.retiredEvent = mp.Event()
+        self.uwProcess = ControlledWorker(workerId, userMpDataProcessor, self.commandRequestQueue, self.commandResponseQueue, \
+                                          inputDataQueue, self.controlQueue, self.retireEvent, self.retiredEvent, logLevel, logFile)
+
+    def configure(self, configDict):
+        try:
+            if not self.isStopped:
+                self.controlQueue.put({'command' : self.CONFIGURE_COMMAND, 'configDict' : configDict})
+        except Exception as ex:
+            self.logger.error(f'Cannot configure worker {self.workerId}: {ex}')
+
+    # stops the worker without emptying the input queue; returns its stats like stop()
+    def retire(self, statsKeyPrefix=None, timeout=RETIRE_TIME):
+        self.retireEvent.set()
+        if not self.isStopped and not self.retiredEvent.wait(timeout):
+            self.logger.warning(f'Worker {self.workerId} did not finish processing within {timeout} seconds')
+        return self.stop(statsKeyPrefix)
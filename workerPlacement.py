@@ -0,0 +1,182 @@
+'''
+CPU placement and thread caps per worker role, configured in yaml:
+
+placement:
+  main:            {cpus: "0-1"}                  # this process: pvapy callbacks, reorder/pva threads
+  infer:           {cpus: "2-5", threads: 4}      # inference thread and its torch pool
+  frame_processor: {numa: 0, cores_per_worker: 1, threads: 1}
+  writer:          {numa: 1, threads: 1}
+
+cpus is a cpu list ("0-7,16-23" or a list of ids), numa one or more NUMA
+nodes whose cpus are used; with cores_per_worker, worker i of a role gets its
+own slice of the role's cpus (round-robin) instead of sharing all of them.
+threads caps the OpenCV, BLAS/OpenMP and torch thread pools of the role's
+processes (BLAS at runtime needs threadpoolctl; without it only the
+*_NUM_THREADS environment variables are set, which affects processes started
+later). Roles that are not configured are left alone, except that with 'main'
+configured they are placed on all cpus, so that they do not inherit the main
+process placement.
+
+Placements are applied by the worker itself (apply() in the first process()
+call of a UserMpDataProcessor, applyToThread() for the inference thread),
+since the workers run in their own processes.
+'''
+
+import os, sys
+from pvapy.utility.loggingManager import LoggingManager
+
+BLAS_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+def parse_cpu_list(cpus):
+    if isinstance(cpus, int):
+        return [cpus]
+    if not isinstance(cpus, str):
+        return sorted(set(int(c) for c in cpus))
+    cpuList = set()
+    for part in cpus.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpuList.update(range(int(first), int(last) + 1))
+        else:
+            cpuList.add(int(part))
+    return sorted(cpuList)
+
+def numa_cpus(nodes):
+    if isinstance(nodes, int):
+        nodes = [nodes]
+    cpuList = []
+    for node in nodes:
+        with open(f'/sys/devices/system/node/node{node}/cpulist', 'r') as fp:
+            cpuList += parse_cpu_list(fp.read())
+    return sorted(set(cpuList))
+
+def format_cpu_list(cpus):
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(f'{a}-{b}' if a != b else f'{a}' for a, b in ranges)
+
+def limit_threads(threads, torchThreads=True):
+    try:
+        import cv2
+        cv2.setNumThreads(threads)
+    except ImportError:
+        pass
+    for var in BLAS_ENV_VARS:
+        os.environ[var] = str(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except ImportError:
+        pass
+    if torchThreads and 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(threads)
+
+class WorkerPlacement:
+
+    def __init__(self, role, cpus=None, threads=None):
+        self.role = role
+        self.cpus = cpus
+        self.threads = threads
+        self.appliedPid = None
+
+    # pins all threads of the calling process and caps its thread pools; once per process
+    def apply(self):
+        if self.appliedPid == os.getpid():
+            return
+        self.appliedPid = os.getpid()
+        logger = LoggingManager.getLogger(self.__class__.__name__)
+        if self.cpus:
+            for tid in os.listdir('/proc/self/task'):
+                try:
+                    os.sched_setaffinity(int(tid), self.cpus)
+                except OSError as ex:
+                    logger.warning(f'Cannot pin thread {tid} to cpus {format_cpu_list(self.cpus)}: {ex}')
+        if self.threads:
+            limit_threads(self.threads)
+        logger.debug(f'{self.role} process {self.appliedPid} runs on cpus {format_cpu_list(os.sched_getaffinity(0))}, threads: {self.threads}')
+
+    # pins the calling thread (and threads it starts later); torch threads
+    # are capped by the inference engine (infer.threads) if set there
+    def applyToThread(self, torchThreads=True):
+        if self.cpus:
+            os.sched_setaffinity(0, self.cpus)
+        if self.threads:
+            limit_threads(self.threads, torchThreads=torchThreads)
+
+    def describe(self):
+        return {
+            'cpus' : format_cpu_list(self.cpus) if self.cpus else None,
+            'threads' : self.threads
+        }
+
+class PlacementPolicy:
+
+    ROLES = ('main', 'infer', 'frame_processor', 'writer')
+
+    def __init__(self, placementParams):
+        self.logger = LoggingManager.getLogger(self.__class__.__name__)
+        self.params = placementParams or {}
+        for role in self.params:
+            if role not in self.ROLES:
+                raise Exception(f'Unknown placement role: {role}')
+        self.roleCpus = {}
+        for role, roleParams in self.params.items():
+            roleParams = roleParams or {}
+            if roleParams.get('cpus') is not None:
+                cpus = parse_cpu_list(roleParams['cpus'])
+            elif roleParams.get('numa') is not None:
+                cpus = numa_cpus(roleParams['numa'])
+            else:
+                cpus = None
+            if cpus:
+                missing = set(cpus) - os.sched_getaffinity(0)
+                if missing:
+                    self.logger.warning(f'Placement of {role} includes cpus not available to this process: {format_cpu_list(missing)}')
+                    cpus = [cpu for cpu in cpus if cpu not in missing] or None
+            self.roleCpus[role] = cpus
+        # cpus of the unconfigured roles; processes and threads would otherwise
+        # inherit the main role's placement from the process that starts them
+        self.allCpus = sorted(os.sched_getaffinity(0))
+
+    def isConfigured(self, role):
+        return role in self.params
+
+    def getPlacement(self, role, index=0):
+        if role not in self.params:
+            if 'main' in self.params:
+                return WorkerPlacement(role, cpus=self.allCpus)
+            return None
+        roleParams = self.params[role] or {}
+        cpus = self.roleCpus[role]
+        coresPerWorker = roleParams.get('cores_per_worker')
+        if cpus and coresPerWorker:
+            nSlices = max(1, len(cpus) // coresPerWorker)
+            start = (index % nSlices)*coresPerWorker
+            cpus = cpus[start:start + coresPerWorker]
+        return WorkerPlacement(role, cpus=cpus, threads=roleParams.get('threads'))
+
+    # effective placement of each configured role, and threads per cpu for
+    # roles whose worker count is given (nWorkersMap: role => number of workers)
+    def describe(self, nWorkersMap={}):
+        description = {}
+        for role in self.params:
+            roleParams = self.params[role] or {}
+            nWorkers = nWorkersMap.get(role, 1)
+            cpus = self.roleCpus[role]
+            workers = [self.getPlacement(role, i).describe()['cpus'] for i in range(nWorkers)]
+            description[role] = {
+                'cpus' : format_cpu_list(cpus) if cpus else None,
+                'nWorkers' : nWorkers,
+                'workerCpus' : workers if roleParams.get('cores_per_worker') else None,
+                'threads' : roleParams.get('threads')
+            }
+            if cpus and roleParams.get('threads'):
+                description[role]['threadsPerCpu'] = nWorkers*roleParams['threads']/len(cpus)
+        return description
@@ -0,0 +1,199 @@
+'''
+On-demand profiling of a worker (process or thread), driven through configure().
+
+Two modes are supported:
+  sample   - a background thread samples the python stacks of the target
+             thread(s) every interval seconds; very low overhead
+  cprofile - cProfile is enabled in the processing thread on its next
+             onProcess() call; exact call counts, higher overhead
+
+Each capture writes a flamegraph compatible collapsed-stack file
+(<dir>/<name>.<pid>.<time>.collapsed); cprofile captures also write the raw
+pstats (.prof) file.
+'''
+
+import cProfile, collections, os, pstats, sys, threading, time
+from pvapy.utility.loggingManager import LoggingManager
+
+class WorkerProfiler:
+
+    DEFAULT_INTERVAL = 0.005
+    MAX_STACK_DEPTH = 128
+
+    def __init__(self, name):
+        self.logger = LoggingManager.getLogger(self.__class__.__name__)
+        self.name = name
+        self.mode = None
+        self.outputDir = '.'
+        self.interval = self.DEFAULT_INTERVAL
+        self.threadIds = None
+        self.lock = threading.Lock()
+        self.samplerThread = None
+        self.stopTimer = None
+        self.samples = None
+        self.nSamples = 0
+        self.cProfile = None
+        self.cProfileThreadId = None
+        self.stopRequested = False
+        self.startTime = 0
+
+    def isActive(self):
+        return self.mode is not None
+
+    # handles the profiler keys of a configuration update:
+    # profiler=start|stop, profilerMode, profilerDuration, profilerInterval, profilerDir, profilerName
+    def configure(self, configDict, threadIds=None):
+        command = configDict.get('profiler')
+        if not command:
+            return
+        if configDict.get('profilerName'):
+            self.name = configDict['profilerName']
+        if command == 'start':
+            self.start(mode=configDict.get('profilerMode', 'sample'),
+                       duration=float(configDict.get('profilerDuration', 0)),
+                       outputDir=configDict.get('profilerDir', '.'),
+                       interval=float(configDict.get('profilerInterval', self.DEFAULT_INTERVAL)),
+                       threadIds=threadIds)
+        elif command == 'stop':
+            self.stop()
+        else:
+            self.logger.warning(f'Unknown profiler command: {command}')
+
+    def start(self, mode='sample', duration=0, outputDir='.', interval=DEFAULT_INTERVAL, threadIds=None):
+        with self.lock:
+            if self.mode is not None:
+                self.logger.warning(f'Profiler {self.name} is already running in {self.mode} mode')
+                return
+            if mode not in ('sample', 'cprofile'):
+                self.logger.warning(f'Unknown profiler mode: {mode}')
+                return
+            self.mode = mode
+            self.outputDir = outputDir
+            self.interval = interval
+            self.threadIds = threadIds
+            self.stopRequested = False
+            self.startTime = time.time()
+            if mode == 'sample':
+                self.samples = collections.Counter()
+                self.nSamples = 0
+                self.samplerThread = threading.Thread(target=self._sampler, daemon=True)
+                self.samplerThread.start()
+            if duration > 0:
+                self.stopTimer = threading.Timer(duration, self.stop)
+                self.stopTimer.daemon = True
+                self.stopTimer.start()
+        self.logger.debug(f'Profiler {self.name} started in {mode} mode, duration: {duration} seconds')
+
+    def stop(self):
+        with self.lock:
+            if self.mode is None:
+                return
+            if self.stopTimer is not None:
+                self.stopTimer.cancel()
+                self.stopTimer = None
+            if self.mode == 'sample':
+                self.mode = None
+                self.samplerThread.join()
+                self.samplerThread = None
+                self._writeCollapsed(self.samples, 'samples')
+                self.samples = None
+            elif self.cProfile is None or self.cProfileThreadId == threading.get_ident():
+                self._stopCProfile()
+            else:
+                # cProfile must be disabled from the thread it runs in
+                self.stopRequested = True
+
+    # called by the profiled worker from its processing thread
+    def onProcess(self):
+        if self.mode != 'cprofile':
+            return
+        with self.lock:
+            if self.mode != 'cprofile':
+                return
+            if self.cProfile is None:
+                self.cProfile = cProfile.Profile()
+                self.cProfileThreadId = threading.get_ident()
+                self.cProfile.enable()
+            elif self.stopRequested:
+                self._stopCProfile()
+
+    def _stopCProfile(self):
+        self.mode = None
+        self.stopRequested = False
+        if self.cProfile is None:
+            self.logger.warning(f'Profiler {self.name} stopped before any data was processed')
+            return
+        self.cProfile.disable()
+        fileName = self._getFileName('prof')
+        self.cProfile.dump_stats(fileName)
+        self.logger.debug(f'Profiler {self.name} wrote {fileName}')
+        self._writeCollapsed(self._pstatsToCollapsed(pstats.Stats(self.cProfile)), 'us')
+        self.cProfile = None
+        self.cProfileThreadId = None
+
+    def _sampler(self):
+        ownId = threading.get_ident()
+        while self.mode == 'sample':
+            threadNames = {t.ident : t.name for t in threading.enumerate()}
+            for threadId, frame in sys._current_frames().items():
+                if threadId == ownId:
+                    continue
+                if self.threadIds is not None and threadId not in self.threadIds:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(threadNames.get(threadId, str(threadId)))
+                self.samples[';'.join(reversed(stack))] += 1
+            self.nSamples += 1
+            time.sleep(self.interval)
+
+    # call graph of a cProfile run as collapsed stacks, time in microseconds;
+    # the time of a function shared by several callers is split by the time
+    # spent under each caller
+    def _pstatsToCollapsed(self, stats):
+        callees = collections.defaultdict(dict)
+        roots = []
+        for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+            if not callers:
+                roots.append(func)
+            for caller, edge in callers.items():
+                callees[caller][func] = edge[3]
+
+        def label(func):
+            fileName, line, name = func
+            return f'{name} ({os.path.basename(fileName)}:{line})'
+
+        collapsed = collections.Counter()
+
+        def walk(func, path, scale):
+            cc, nc, tt, ct, callers = stats.stats[func]
+            path = path + [func]
+            selfTime = int(1e6*tt*scale)
+            if selfTime > 0:
+                collapsed[';'.join(label(f) for f in path)] += selfTime
+            if len(path) >= self.MAX_STACK_DEPTH:
+                return
+            for callee, edgeTime in callees[func].items():
+                calleeTime = stats.stats[callee][3]
+                if callee in path or calleeTime <= 0:
+                    continue
+                walk(callee, path, scale*edgeTime/calleeTime)
+
+        for func in roots:
+            walk(func, [], 1.0)
+        return collapsed
+
+    def _getFileName(self, extension):
+        timeStr = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.startTime))
+        return os.path.join(self.outputDir, f'{self.name}.{os.getpid()}.{timeStr}.{extension}')
+
+    def _writeCollapsed(self, collapsed, unit):
+        os.makedirs(self.outputDir, exist_ok=True)
+        fileName = self._getFileName('collapsed')
+        with open(fileName, 'w') as fp:
+            for stack, count in collapsed.items():
+                fp.write(f'{stack} {count}\n')
+        self.logger.debug(f'Profiler {self.name} wrote {len(collapsed)} stacks ({unit}) to {fileName}')